@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Along-track consistency filter for ATL06 land ice segments.
+
+NumPy port of matlab/ATL06_AT_filter.m. Each segment's height is
+projected 20 m forward and back along its fitted slope (dh_fit_dx) and
+compared with the heights of its neighbours; segments that disagree
+with either neighbour by more than a threshold are rejected, as are
+segments whose predecessor is rejected.
+
+Run as a script to benchmark against a per-segment loop on a synthetic
+track:
+
+    python atl06_filter.py [nsegments]
+
+"""
+
+import sys
+import time
+
+import numpy as np
+
+# Distance (m) from a segment center to its neighbours' centers
+SEGMENT_DX = 20.0
+
+
+def atl06_at_filter(h_li, dh_fit_dx, threshold, dx=SEGMENT_DX):
+    """
+        Along-track filter for ATL06 segments.
+
+        h_li and dh_fit_dx are ordered along track on axis 0 (other axes,
+        e.g. beams, are filtered independently). Returns a boolean array
+        of the segments that pass. The first two segments of a track
+        never pass, as in ATL06_AT_filter.m.
+    """
+
+    h = np.asarray(h_li, dtype=np.float64)
+    slope = np.asarray(dh_fit_dx, dtype=np.float64)
+
+    # Height projected to the next segment minus its height, and height
+    # projected back to the previous segment minus its height
+    delta1 = np.full(h.shape, np.nan)
+    delta2 = np.full(h.shape, np.nan)
+    delta1[:-1] = h[:-1] + dx * slope[:-1] - h[1:]
+    delta2[1:] = h[1:] - dx * slope[1:] - h[:-1]
+
+    with np.errstate(invalid='ignore'):
+        good = (np.maximum(np.abs(delta1), np.abs(delta2)) < threshold) \
+            & np.isfinite(delta1 + delta2)
+
+    # A segment also needs a good predecessor
+    good[1:] = good[1:] & good[:-1]
+
+    return good
+
+
+def atl06_at_filter_loop(h_li, dh_fit_dx, threshold, dx=SEGMENT_DX):
+    """ Per-segment reference version of atl06_at_filter (1-D only). """
+
+    n = len(h_li)
+    passed = [False] * n
+    for i in range(1, n - 1):
+        d1 = h_li[i] + dx * dh_fit_dx[i] - h_li[i + 1]
+        d2 = h_li[i] - dx * dh_fit_dx[i] - h_li[i - 1]
+        passed[i] = bool(max(abs(d1), abs(d2)) < threshold
+                         and np.isfinite(d1 + d2))
+
+    good = np.zeros(n, dtype=bool)
+    for i in range(1, n):
+        good[i] = passed[i] and passed[i - 1]
+    return good
+
+
+def synthetic_track(n=1000000, blunders=0.01, seed=0):
+    """
+        A track of n segments 20 m apart over a smooth surface, with
+        noise and a fraction of blunders. Returns (h_li, dh_fit_dx).
+    """
+    rng = np.random.default_rng(seed)
+    x = np.arange(n) * SEGMENT_DX
+    h = 1000 + 200 * np.sin(x / 50e3) + 20 * np.sin(x / 3e3)
+    slope = 200 / 50e3 * np.cos(x / 50e3) + 20 / 3e3 * np.cos(x / 3e3)
+    h_li = (h + rng.normal(0, 0.1, n)).astype(np.float32)
+    dh_fit_dx = (slope + rng.normal(0, 0.001, n)).astype(np.float32)
+    bad = rng.random(n) < blunders
+    h_li[bad] += rng.normal(0, 50, bad.sum()).astype(np.float32)
+    return h_li, dh_fit_dx
+
+
+def benchmark(n=1000000, threshold=2.0):
+    """ Time the vectorized and the per-segment filter on n segments. """
+
+    h_li, dh_fit_dx = synthetic_track(n)
+
+    t0 = time.time()
+    good = atl06_at_filter(h_li, dh_fit_dx, threshold)
+    t_vec = time.time() - t0
+
+    t0 = time.time()
+    good_loop = atl06_at_filter_loop(h_li, dh_fit_dx, threshold)
+    t_loop = time.time() - t0
+
+    print('%d segments, threshold %.1f m, %.2f%% kept' %
+          (n, threshold, 100.0 * good.mean()))
+    print('vectorized: %9.4f s' % t_vec)
+    print('loop:       %9.4f s' % t_loop)
+    print('speedup:    %9.1fx' % (t_loop / t_vec))
+    print('mismatches: %d' % np.sum(good != good_loop))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Appendable HDF5 store for filtered ATL06 points.
+
+Instead of two small _A.h5/_D.h5 files per granule, readATL06 can
+append every granule to one store (or a few shards). Layout:
+
+    /points/<var>       lon, lat, h_li, t_yr, beam; one row per point
+    /granules/name      granule file name
+    /granules/start     first row of the granule in /points
+    /granules/stop      one past the last row
+    /runs/granule       row in /granules of each run
+    /runs/beam          beam index (1-6) of each run
+    /runs/asc           1 for ascending, 0 for descending runs
+    /runs/start         first row of the run in /points
+    /runs/stop          one past the last row
+
+A run is a contiguous ascending or descending stretch of one beam (see
+readATL06.track_segments), so any granule/beam/asc-desc subset is a
+set of slices of /points found from the small /runs table.
+
+All datasets are chunked, compressed and resizable.
+
+A granule's points and runs are appended before its /granules row, and
+its name is written last, so a granule is only in the store once its
+name is.  Rows that a crash left past the last named granule are
+removed when the store is next opened for writing.
+
+"""
+
+import os
+
+import h5py
+import numpy as np
+
+# Point variables and their dtypes
+POINT_VARS = [('lon', 'f8'), ('lat', 'f8'), ('h_li', 'f4'),
+              ('t_yr', 'f8'), ('beam', 'i1')]
+
+# Run table columns and their dtypes
+RUN_VARS = [('granule', 'i4'), ('beam', 'i1'), ('asc', 'i1'),
+            ('start', 'i8'), ('stop', 'i8')]
+
+# Rows per chunk
+CHUNK = 65536
+
+
+def shard_names(store, nshards=1):
+    """ File names of the shards of a store. """
+    if nshards <= 1:
+        return [store]
+    root, ext = os.path.splitext(store)
+    return ['%s_%02d%s' % (root, k, ext or '.h5') for k in range(nshards)]
+
+
+def shard_name(store, ifile, nshards=1):
+    """ Name of the shard of store that ifile goes to. """
+    names = shard_names(store, nshards)
+    # Stable across runs and processes, unlike hash()
+    k = sum(bytearray(os.path.basename(ifile).encode('utf-8'))) % len(names)
+    return names[k]
+
+
+def _create(fo):
+    """ Create the empty datasets of a new store. """
+    for var, dtype in POINT_VARS:
+        fo.create_dataset('points/' + var, shape=(0,), maxshape=(None,),
+                          dtype=dtype, chunks=(CHUNK,), compression='gzip',
+                          shuffle=True)
+    for var, dtype in RUN_VARS:
+        fo.create_dataset('runs/' + var, shape=(0,), maxshape=(None,),
+                          dtype=dtype, chunks=(4096,), compression='gzip')
+    fo.create_dataset('granules/name', shape=(0,), maxshape=(None,),
+                      dtype=h5py.string_dtype(), chunks=(1024,))
+    for var in ('start', 'stop'):
+        fo.create_dataset('granules/' + var, shape=(0,), maxshape=(None,),
+                          dtype='i8', chunks=(1024,))
+
+
+def _append(dset, values):
+    """ Append values to a resizable 1-D dataset. """
+    n = dset.shape[0]
+    dset.resize((n + len(values),))
+    dset[n:] = values
+
+
+def granule_names(store):
+    """ Names of the granules in a store (empty if it doesn't exist). """
+    if not os.path.isfile(store):
+        return []
+    with h5py.File(store, 'r') as fo:
+        return list(fo['granules/name'].asstr()[:])
+
+
+class StoreWriter(object):
+    """
+        A store (or shard) open for appending granules.
+
+        The file stays open and the names of its granules are kept in
+        memory, so appending a season of granules doesn't reread the
+        name list for each one. Opening the store removes any rows left
+        past the last named granule by an interrupted append. Use as a
+        context manager, or call close.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.fo = h5py.File(store, 'a')
+
+        # New store
+        if 'points' not in self.fo:
+            _create(self.fo)
+
+        self.names = list(self.fo['granules/name'].asstr()[:])
+        self.name_set = set(self.names)
+        self._truncate()
+
+    def _truncate(self):
+        """ Drop rows of a granule whose name was never written. """
+        fo = self.fo
+        ngran = len(self.names)
+        npoints = int(fo['granules/stop'][ngran - 1]) if ngran else 0
+        for var in ('start', 'stop'):
+            fo['granules/' + var].resize((ngran,))
+        for var, dtype in POINT_VARS:
+            if fo['points/' + var].shape[0] > npoints:
+                fo['points/' + var].resize((npoints,))
+        # runs are in granule order, so the runs to keep are a prefix
+        nruns = min(fo['runs/' + var].shape[0] for var, dtype in RUN_VARS)
+        nruns = int(np.searchsorted(fo['runs/granule'][:nruns], ngran))
+        for var, dtype in RUN_VARS:
+            if fo['runs/' + var].shape[0] > nruns:
+                fo['runs/' + var].resize((nruns,))
+
+    def __contains__(self, name):
+        return name in self.name_set
+
+    def append(self, name, out, runs):
+        """
+            Append the filtered points of one granule.
+
+            out holds the POINT_VARS arrays and runs the beam, asc,
+            start and stop of each run, relative to out (see
+            readATL06.filter_granule). Granules already in the store are
+            skipped. Returns True if the granule was appended.
+        """
+        if name in self.name_set:
+            return False
+
+        fo = self.fo
+        offset = fo['points/lat'].shape[0]
+        igran = len(self.names)
+
+        for var, dtype in POINT_VARS:
+            _append(fo['points/' + var], out[var])
+
+        nruns = len(runs['start'])
+        _append(fo['runs/granule'], np.full(nruns, igran))
+        _append(fo['runs/beam'], runs['beam'])
+        _append(fo['runs/asc'], runs['asc'])
+        _append(fo['runs/start'], runs['start'] + offset)
+        _append(fo['runs/stop'], runs['stop'] + offset)
+
+        _append(fo['granules/start'], [offset])
+        _append(fo['granules/stop'], [offset + len(out['lat'])])
+
+        # The name goes last: it marks the granule as complete
+        _append(fo['granules/name'], [name])
+        fo.flush()
+
+        self.names.append(name)
+        self.name_set.add(name)
+        return True
+
+    def close(self):
+        self.fo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def append_granule(store, name, out, runs):
+    """
+        Append the filtered points of one granule to a store (see
+        StoreWriter.append). Returns True if the granule was appended.
+    """
+
+    with StoreWriter(store) as writer:
+        return writer.append(name, out, runs)
+
+
+def read_store(store, granules=None, beams=None, asc=None, variables=None):
+    """
+        Read a subset of a store.
+
+        granules is a list of granule names, beams a list of beam
+        indices (1-6) and asc True/False for ascending/descending runs;
+        None selects everything. Only the matching slices of /points are
+        read. Returns a dict of arrays.
+    """
+
+    if variables is None:
+        variables = [var for var, dtype in POINT_VARS]
+
+    with h5py.File(store, 'r') as fo:
+
+        # Select runs from the run table
+        run = {var: fo['runs/' + var][:] for var, dtype in RUN_VARS}
+        keep = np.ones(len(run['start']), dtype=bool)
+        if granules is not None:
+            names = fo['granules/name'].asstr()[:]
+            igran = np.flatnonzero(np.isin(names, granules))
+            keep &= np.isin(run['granule'], igran)
+        if beams is not None:
+            keep &= np.isin(run['beam'], beams)
+        if asc is not None:
+            keep &= run['asc'] == int(asc)
+
+        # Merge adjacent runs into fewer, larger reads
+        starts, stops = run['start'][keep], run['stop'][keep]
+        if len(starts):
+            new = np.append(True, starts[1:] != stops[:-1])
+            last = np.append(new[1:], True)
+            starts, stops = starts[new], stops[last]
+
+        out = {}
+        for var in variables:
+            dset = fo['points/' + var]
+            out[var] = np.concatenate([dset[i0:i1] for i0, i1 in zip(starts, stops)]
+                                      or [np.zeros(0, dtype=dset.dtype)])
+
+    return out
@@ -0,0 +1,318 @@
+"""Benchmark the photon height and ATL06 pipelines on synthetic granules.
+
+Synthetic ATL03 and ATL06 granules (see synthetic_granule.py) are
+written at several sizes, and each stage below is timed on each size:
+
+total_along_track_distance, make_signal_conf_mask
+    photon_height.py helpers on one ground track.
+write_data_txt, write_data_h5
+    Writing one ground track's photons.
+photon_heights, photon_heights_window, photon_heights_bins
+    photon_height.py end to end: whole track, windows of segments and
+    20 m bin statistics.
+read_atl06, filter_granule, process_file, store_files
+    The readATL06.py pipeline on all six beams.
+
+Every stage runs in a fresh process, so stages don't share caches or
+memory high-water marks.  The time is the best of several runs.  Peak
+memory is reported two ways: the tracemalloc peak, which covers NumPy
+arrays and Python objects but not HDF5's own buffers, and the growth
+of the process's peak resident set size during the first run, which
+covers everything.
+
+Results can be saved as JSON and compared with a saved baseline; stages
+slower than the baseline by more than the tolerance are reported and
+the script exits with status 1.
+
+    python benchmark_suite.py -n 10000 100000 -o baseline.json
+    python benchmark_suite.py -n 10000 100000 -c baseline.json
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import h5py
+import numpy as np
+
+from photon_height import (make_signal_conf_mask, photon_heights, read_track,
+                           total_along_track_distance, write_data)
+from readATL06 import filter_granule, process_file, read_atl06, store_files
+from stage_metrics import peak_rss
+from synthetic_granule import granule_name, write_atl03, write_atl06
+
+# Ground track of the single-track ATL03 stages.
+TRACK = "gt1l"
+
+# Default sizes, in segments per ground track.
+SIZES = (10000, 100000, 500000)
+
+
+def _open(paths):
+    return (h5py.File(paths["atl03"], "r"),)
+
+
+def _read_photons(paths):
+    distance, height, attrs = read_track(paths["atl03"], TRACK, 3)
+    return (os.path.join(paths["workdir"], "photons"), distance, height)
+
+
+def _along_track(f_in):
+    dist_ph_along = f_in[TRACK + "/heights/dist_ph_along"][...]
+    total_along_track_distance(f_in, TRACK, dist_ph_along)
+
+
+def _conf_mask(f_in):
+    make_signal_conf_mask(f_in, TRACK, 3)
+
+
+def _write_data(out_format):
+    def run(outroot, distance, height):
+        write_data(outroot + "." + out_format, distance, height,
+                   overwrite=True, out_format=out_format)
+    return run
+
+
+def _photon_heights(**kwargs):
+    def run(paths):
+        photon_heights(paths["atl03"], TRACK,
+                       os.path.join(paths["workdir"], "heights"), 3,
+                       overwrite=True, out_format="h5", **kwargs)
+    return run
+
+
+def _read_atl06(paths):
+    read_atl06(paths["atl06"])
+
+
+def _filter_granule(paths):
+    filter_granule(paths["atl06"], at_threshold=2.0)
+
+
+def _process_file(paths):
+    process_file(paths["atl06"], paths["workdir"])
+
+
+def _store_files(paths):
+    store = os.path.join(paths["workdir"], "store.h5")
+    if os.path.exists(store):
+        os.remove(store)
+    store_files([paths["atl06"]], store)
+
+
+def _paths(paths):
+    return (paths,)
+
+
+# name: (setup, run).  setup(paths) returns the arguments of run, and
+# is not timed.
+STAGES = {
+    "total_along_track_distance": (_open, _along_track),
+    "make_signal_conf_mask": (_open, _conf_mask),
+    "write_data_txt": (_read_photons, _write_data("txt")),
+    "write_data_h5": (_read_photons, _write_data("h5")),
+    "photon_heights": (_paths, _photon_heights()),
+    "photon_heights_window": (_paths, _photon_heights(window=10000)),
+    "photon_heights_bins": (_paths, _photon_heights(bin_width=20.0)),
+    "read_atl06": (_paths, _read_atl06),
+    "filter_granule": (_paths, _filter_granule),
+    "process_file": (_paths, _process_file),
+    "store_files": (_paths, _store_files),
+}
+
+
+def run_stage(name, paths, repeat=3):
+    """Time one stage in this process.
+
+    Returns
+    -------
+    result : dict
+        seconds (best of repeat runs), peak_mb (tracemalloc peak of a
+        separate run) and rss_mb (growth of the peak resident set size
+        over its value after setup, during the first run).
+
+    """
+    setup, run = STAGES[name]
+    repeat = max(repeat, 1)
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        args = setup(paths)
+        rss0 = peak_rss(reset=True)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run(*args)
+            times.append(time.perf_counter() - start)
+            if len(times) == 1:
+                rss = peak_rss() - rss0
+
+        tracemalloc.start()
+        run(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"seconds": min(times), "peak_mb": peak / 1e6, "rss_mb": rss}
+
+
+def make_granules(workdir, n_segments, seed=0):
+    """Write synthetic ATL03 and ATL06 granules for one size."""
+    sizedir = os.path.join(workdir, str(n_segments))
+    os.makedirs(sizedir)
+    paths = {"workdir": sizedir,
+             "atl03": os.path.join(sizedir, granule_name("ATL03")),
+             "atl06": os.path.join(sizedir, granule_name("ATL06"))}
+    n_photons = write_atl03(paths["atl03"], n_segments=n_segments,
+                            tracks=(TRACK,), seed=seed)
+    write_atl06(paths["atl06"], n_segments=n_segments, seed=seed)
+    return paths, n_photons
+
+
+def run_suite(sizes=SIZES, stages=None, repeat=3, workdir=None, verbose=True):
+    """Run the benchmark stages on granules of each size.
+
+    Parameters
+    ----------
+    sizes : sequence of int, optional
+        Segments per ground track of each granule size.
+    stages : sequence of str, optional
+        Stage names from STAGES.  Default is all stages.
+    repeat : int, optional
+        Timed runs of each stage; the best is kept.
+    workdir : str, optional
+        Directory for the granules and outputs, kept afterwards.
+        Default is a temporary directory that is removed.
+    verbose : bool, optional
+        Print each result as it comes.
+
+    Returns
+    -------
+    results : list of dict
+        stage, segments, photons, seconds, peak_mb and rss_mb of every
+        stage and size.
+
+    """
+    stages = list(STAGES) if stages is None else stages
+    keep = workdir is not None
+    workdir = workdir if keep else tempfile.mkdtemp(prefix="icesat2_bench_")
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for n_segments in sizes:
+            start = time.perf_counter()
+            paths, n_photons = make_granules(workdir, n_segments)
+            if verbose:
+                print("%d segments, %d photons in %s: written in %.1f s"
+                      % (n_segments, n_photons, TRACK,
+                         time.perf_counter() - start))
+            for name in stages:
+                with ProcessPoolExecutor(max_workers=1,
+                                         mp_context=context) as pool:
+                    result = pool.submit(run_stage, name, paths,
+                                         repeat).result()
+                result.update(stage=name, segments=n_segments,
+                              photons=n_photons)
+                results.append(result)
+                if verbose:
+                    print("    %-28s %9.3f s %9.1f MB peak %9.1f MB rss"
+                          % (name, result["seconds"], result["peak_mb"],
+                             result["rss_mb"]))
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Return the results slower than a baseline by more than tolerance.
+
+    Results are matched with the baseline by stage and size.  Each
+    regression is (stage, segments, seconds, baseline seconds).
+
+    """
+    base = {(r["stage"], r["segments"]): r["seconds"] for r in baseline}
+    regressions = []
+    for r in results:
+        old = base.get((r["stage"], r["segments"]))
+        if old is not None and r["seconds"] > old * (1 + tolerance):
+            regressions.append((r["stage"], r["segments"], r["seconds"], old))
+    return regressions
+
+
+def cl_args(description):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, nargs="+", default=list(SIZES),
+                        help="granule sizes in segments per ground track, "
+                             "default is %s"
+                             % " ".join(str(n) for n in SIZES))
+    parser.add_argument("-s", type=str, nargs="+", default=None,
+                        choices=list(STAGES), metavar="STAGE",
+                        help="stages to run, default is all: " +
+                             ", ".join(STAGES))
+    parser.add_argument("-r", type=int, default=3,
+                        help="timed runs of each stage, default is 3")
+    parser.add_argument("-d", type=str, default=None,
+                        help="keep the granules and outputs in this "
+                             "directory")
+    parser.add_argument("-o", type=str, default=None,
+                        help="save the results to this JSON file")
+    parser.add_argument("-c", type=str, default=None,
+                        help="compare with the results in this JSON file")
+    parser.add_argument("-t", type=float, default=0.25,
+                        help="with -c, fraction by which a stage may be "
+                             "slower than the baseline, default is 0.25")
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmark suite."""
+    args = cl_args(__doc__)
+    if args.d is not None and not os.path.isdir(args.d):
+        os.makedirs(args.d)
+
+    results = run_suite(sizes=args.n, stages=args.s, repeat=args.r,
+                        workdir=args.d)
+
+    if args.o is not None:
+        meta = {"python": platform.python_version(),
+                "numpy": np.__version__, "h5py": h5py.__version__,
+                "hdf5": h5py.version.hdf5_version,
+                "machine": platform.machine(), "node": platform.node(),
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        with open(args.o, "w") as f_out:
+            json.dump({"meta": meta, "results": results}, f_out, indent=1)
+        print("saved results to", args.o)
+
+    status = 0
+    if args.c is not None:
+        with open(args.c) as f_in:
+            baseline = json.load(f_in)["results"]
+        regressions = compare(results, baseline, tolerance=args.t)
+        for stage, n_segments, seconds, old in regressions:
+            print("regression: %s at %d segments, %.3f s vs %.3f s"
+                  % (stage, n_segments, seconds, old))
+        if regressions:
+            status = 1
+        else:
+            print("no regressions against", args.c)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""Detector dead-time simulation for ATLAS photon events.
+
+Python port of matlab/deadtime2_fast.m.  Each photon is assigned at
+random to one of n_det detectors.  Per detector:
+
+* the analog detector is paralyzable: a photon passes it if it comes
+  more than t_dead_analog after the previous photon (recorded or not),
+  and the first photon of every pulse always passes;
+* the digital electronics are non-paralyzable, with two channels that
+  take events in turn: an event that passed the analog detector is
+  recorded if it comes more than the dead time of the next channel
+  after the last recorded event.  The first event of a pulse is always
+  recorded.
+
+Two things differ from the MATLAB code.  The time since the last
+recorded event is measured from event times, where deadtime2_fast.m
+sums the photon spacings of the events that passed the analog
+detector only (missing the time of the photons it blocked).  And the
+channel that takes the first event of each pulse is drawn at random
+for every pulse and detector, as the MATLAB comments say it should be,
+rather than following the parity of all earlier events.  That makes
+every pulse of every detector independent, so all of them are followed
+at once.
+
+Events that passed the analog detector are more than t_dead_analog
+apart, so the next event recorded after any event is at most
+ceil(t_dead_digital / t_dead_analog) events later (the MATLAB maxPhtn
+look-ahead).  deadtime follows the chains of recorded events from the
+start of every pulse of every detector in parallel, finding the next
+recorded event of all chains at once with that many vectorized
+comparisons, so the work and memory grow with the number of recorded
+events rather than with photons times the look-ahead.
+
+Run as a script to benchmark against the per-photon reference:
+
+    python deadtime.py [n_pulses]
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import time
+
+import numpy as np
+
+
+def draw_detectors(n_photons, n_det, rng=None):
+    """Assign photons to detectors and draw their start channels.
+
+    Both are drawn with one call, so deadtime and deadtime_reference
+    see the same values for the same seed.
+
+    Parameters
+    ----------
+    n_photons : int
+        Number of photons.
+    n_det : int
+        Number of detectors.
+    rng : numpy.random.Generator, int or None, optional
+        Random generator, or a seed for one.
+
+    Returns
+    -------
+    det : NumPy array of int16
+        Detector of each photon, 1 to n_det.
+    channel : NumPy array of int8
+        Channel (0 or 1) that takes the event if the photon is the first
+        of its detector in a pulse.
+
+    """
+    rng = np.random.default_rng(rng)
+    draw = rng.integers(0, 2 * n_det, n_photons, dtype=np.int16)
+    return draw // 2 + 1, (draw % 2).astype(np.int8)
+
+
+def deadtime(t, pulse, n_det, t_dead_analog, t_dead_digital_ch1,
+             t_dead_digital_ch2, rng=None):
+    """Simulate detector dead time.
+
+    Parameters
+    ----------
+    t : NumPy array
+        Photon times.
+    pulse : NumPy array
+        Pulse of each photon.  Photons must be sorted by pulse, then by
+        time.
+    n_det : int
+        Number of detectors.
+    t_dead_analog : float
+        Dead time of the analog detectors, in the units of t.
+    t_dead_digital_ch1, t_dead_digital_ch2 : float
+        Dead times of the two digital channels.
+    rng : numpy.random.Generator, int or None, optional
+        Random generator, or a seed for one.
+
+    Returns
+    -------
+    recorded : NumPy array of bool
+        True for photons that are recorded.
+    det : NumPy array of int16
+        Detector of each photon, 1 to n_det.
+
+    Raises
+    ------
+    ValueError
+        t_dead_analog is not positive.
+
+    """
+    if t_dead_analog <= 0:
+        raise ValueError("t_dead_analog must be positive")
+    t = np.asarray(t, dtype=np.float64)
+    pulse = np.asarray(pulse)
+    n = len(t)
+
+    det, channel = draw_detectors(n, n_det, rng)
+    recorded = np.zeros(n, dtype=bool)
+    if n == 0:
+        return recorded, det
+
+    # Photons of each detector together, still by pulse and time
+    order = np.argsort(det, kind="stable")
+    t_d = t[order]
+    new = np.ones(n, dtype=bool)
+    new[1:] = (det[order][1:] != det[order][:-1]) | \
+        (pulse[order][1:] != pulse[order][:-1])
+
+    # Analog detector: more than t_dead_analog after the previous photon
+    passed = new.copy()
+    passed[1:] |= np.diff(t_d) > t_dead_analog
+    events = np.flatnonzero(passed)
+    t_e = t_d[events]
+    first = new[events]
+    n_e = len(events)
+
+    # Digital electronics: follow the recorded events from the start of
+    # every pulse, finding the next one of every chain at once
+    dead = np.array([t_dead_digital_ch1, t_dead_digital_ch2])
+    max_phtn = int(np.ceil(dead.max() / t_dead_analog))
+    recorded_e = np.zeros(n_e, dtype=bool)
+    current = np.flatnonzero(first)
+    ch = channel[order][events[current]]
+    while len(current):
+        recorded_e[current] = True
+        t_end = t_e[current] + dead[ch]
+        nxt = np.full(len(current), n_e, dtype=np.int64)
+        # The nearest candidate is tested last, so it wins
+        for offset in range(max_phtn, 0, -1):
+            cand = np.minimum(current + offset, n_e - 1)
+            hit = (current + offset < n_e) & (first[cand] | (t_e[cand] > t_end))
+            nxt[hit] = cand[hit]
+        # Chains end at the next pulse, which starts its own
+        keep = nxt < n_e
+        keep[keep] = ~first[nxt[keep]]
+        current = nxt[keep]
+        ch = 1 - ch[keep]
+
+    recorded[order[events[recorded_e]]] = True
+    return recorded, det
+
+
+def deadtime_reference(t, pulse, n_det, t_dead_analog, t_dead_digital_ch1,
+                       t_dead_digital_ch2, rng=None):
+    """Simulate detector dead time one photon at a time.
+
+    Same model, arguments and results as deadtime, for testing and
+    benchmarking.
+
+    """
+    n = len(t)
+    det, channel = draw_detectors(n, n_det, rng)
+    dead = (t_dead_digital_ch1, t_dead_digital_ch2)
+    recorded = np.zeros(n, dtype=bool)
+
+    last_t = {}
+    last_pulse = {}
+    last_recorded = {}
+    next_ch = {}
+    for k in range(n):
+        d = det[k]
+        is_first = last_pulse.get(d) != pulse[k]
+        passed = is_first or t[k] - last_t[d] > t_dead_analog
+        last_t[d] = t[k]
+        last_pulse[d] = pulse[k]
+        if not passed:
+            continue
+        if is_first:
+            next_ch[d] = channel[k]
+        elif t[k] - last_recorded[d] <= dead[next_ch[d]]:
+            continue
+        else:
+            next_ch[d] = 1 - next_ch[d]
+        recorded[k] = True
+        last_recorded[d] = t[k]
+    return recorded, det
+
+
+def synthetic_pulses(n_pulses=20000, mean_photons=50, spread=1.5e-9, rng=0):
+    """Return photon times and pulses of a saturated surface return.
+
+    Each pulse has a Poisson number of photons with normally distributed
+    times, sorted by pulse and then time.
+
+    """
+    rng = np.random.default_rng(rng)
+    count = rng.poisson(mean_photons, n_pulses)
+    pulse = np.repeat(np.arange(n_pulses), count)
+    t = rng.normal(0, spread, len(pulse))
+    order = np.lexsort((t, pulse))
+    return t[order], pulse[order]
+
+
+def benchmark(n_pulses=20000, n_det=16, t_dead_analog=1.0e-9,
+              t_dead_digital=(3.2e-9, 2.9e-9), seed=1):
+    """Time deadtime against deadtime_reference on synthetic pulses."""
+    t, pulse = synthetic_pulses(n_pulses)
+    args = (t, pulse, n_det, t_dead_analog) + tuple(t_dead_digital)
+
+    t0 = time.time()
+    recorded, det = deadtime(*args, rng=seed)
+    t_vec = time.time() - t0
+
+    t0 = time.time()
+    recorded_ref, det_ref = deadtime_reference(*args, rng=seed)
+    t_ref = time.time() - t0
+
+    print("%d photons in %d pulses, %d detectors, %.1f%% recorded"
+          % (len(t), n_pulses, n_det, 100.0 * recorded.mean()))
+    print("vectorized: %9.4f s" % t_vec)
+    print("reference:  %9.4f s" % t_ref)
+    print("speedup:    %9.1fx" % (t_ref / t_vec))
+    print("mismatches: %d" % (np.sum(recorded != recorded_ref) +
+                              np.sum(det != det_ref)))
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,172 @@
+"""Longitude/latitude footprints of projected DEMs.
+
+The footprint of a polar stereographic DEM is not a box in longitude
+and latitude, and transforming only two of its corners can give a box
+many times larger than the DEM, or one that misses part of it.  Here
+the four edges of the raster are densified and every vertex is
+transformed, giving a polygon that follows the DEM's outline.  If the
+DEM covers a pole, the polygon runs along the edge through 360 degrees
+of longitude and is closed through the pole.
+
+The polygon can be passed to region.in_polygon to clip points locally,
+and polygon_param and polygon_bbox give the EGI/CMR query parameters.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+
+import numpy as np
+
+from region import read_polygon
+
+# Raster file extensions read_footprint passes to dem_footprint
+DEM_EXTENSIONS = (".tif", ".tiff", ".vrt", ".img")
+
+
+def dem_footprint(dem_file, n_edge=100):
+    """Return the longitude/latitude outline of a DEM.
+
+    Parameters
+    ----------
+    dem_file : str
+        Name of a raster file GDAL can read.
+    n_edge : int, optional
+        Number of vertices along each edge of the raster.
+
+    Returns
+    -------
+    polygon : NumPy array
+        (4 * n_edge, 2) array of counter-clockwise vertex longitudes and
+        latitudes, plus two pole vertices if the DEM covers a pole.
+
+    Raises
+    ------
+    IOError
+        GDAL can't open the file.
+
+    """
+    from osgeo import gdal, gdalconst, osr
+
+    ds = gdal.Open(dem_file, gdalconst.GA_ReadOnly)
+    if ds is None:
+        raise IOError("can't open " + dem_file)
+    gt = ds.GetGeoTransform()
+    proj = ds.GetProjection()
+
+    # Outer pixel edges, walked around the raster
+    s = np.linspace(0, 1, n_edge, endpoint=False)
+    ii = np.concatenate((s, np.ones(n_edge), 1 - s, np.zeros(n_edge)))
+    jj = np.concatenate((np.zeros(n_edge), s, np.ones(n_edge), 1 - s))
+    ii *= ds.RasterXSize
+    jj *= ds.RasterYSize
+    x = gt[0] + gt[1] * ii + gt[2] * jj
+    y = gt[3] + gt[4] * ii + gt[5] * jj
+    ds = None
+
+    ll_ref = osr.SpatialReference()
+    ll_ref.ImportFromEPSG(4326)
+    dem_ref = osr.SpatialReference()
+    dem_ref.ImportFromWkt(proj)
+    # GDAL 3 returns EPSG:4326 as latitude, longitude unless told otherwise
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+        ll_ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dem_ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    xform = osr.CoordinateTransformation(dem_ref, ll_ref)
+    ll = np.array(xform.TransformPoints(np.c_[x, y, np.zeros_like(x)]))
+
+    return footprint_polygon(ll[:, 0], ll[:, 1])
+
+
+def footprint_polygon(lon, lat):
+    """Return a polygon from an outline's longitudes and latitudes.
+
+    Longitudes are unwrapped so the polygon has no 360 degree jumps.  An
+    outline whose longitude winds once around the globe encloses a
+    pole, and is closed through it.
+
+    Parameters
+    ----------
+    lon, lat : NumPy array
+        Outline vertices in degrees, in order.
+
+    Returns
+    -------
+    polygon : NumPy array
+        (N, 2) array of counter-clockwise vertex longitudes and
+        latitudes.
+
+    """
+    lon = np.degrees(np.unwrap(np.radians(lon)))
+    closing = (lon[0] - lon[-1] + 180) % 360 - 180
+    winding = lon[-1] - lon[0] + closing
+    if abs(winding) > 180:
+        pole = 90.0 if np.mean(lat) > 0 else -90.0
+        lon = np.append(lon, [lon[0] + winding] * 2 + [lon[0]])
+        lat = np.append(lat, [lat[0], pole, pole])
+
+    # Start the polygon's longitudes between -180 and 180
+    lon = lon - 360 * np.floor((lon.min() + 180) / 360)
+
+    polygon = np.c_[lon, lat]
+    area = np.sum(lon * np.roll(lat, -1) - np.roll(lon, -1) * lat)
+    if area < 0:
+        polygon = polygon[::-1]
+    return polygon
+
+
+def covers_pole(polygon):
+    """Return True if a footprint polygon was closed through a pole."""
+    return bool(np.any(np.abs(polygon[:, 1]) == 90))
+
+
+def polygon_bbox(polygon):
+    """Return the (west, south, east, north) bounds of a polygon.
+
+    West is greater than east for a polygon that crosses the
+    antimeridian, as CMR expects.
+
+    """
+    if covers_pole(polygon):
+        west, east = -180.0, 180.0
+    else:
+        west, east = polygon[:, 0].min(), polygon[:, 0].max()
+        if east - west >= 360:
+            west, east = -180.0, 180.0
+        elif east > 180:
+            west, east = west, east - 360
+    return west, polygon[:, 1].min(), east, polygon[:, 1].max()
+
+
+def polygon_param(polygon, max_vertices=200):
+    """Return a polygon as an EGI/CMR 'polygon' query parameter.
+
+    The polygon is thinned to at most max_vertices vertices, wrapped to
+    longitudes between -180 and 180 and closed, as
+    'lon1,lat1,lon2,lat2,...,lon1,lat1'.  Returns None for a polygon
+    through a pole, which CMR can't take; query with polygon_bbox then.
+
+    """
+    if covers_pole(polygon):
+        return None
+    step = int(np.ceil(len(polygon) / max_vertices))
+    ring = polygon[::step]
+    ring = np.vstack((ring, ring[:1]))
+    lon = (ring[:, 0] + 180) % 360 - 180
+    return ",".join("%.4f,%.4f" % (x, y) for x, y in zip(lon, ring[:, 1]))
+
+
+def read_footprint(filename, n_edge=100):
+    """Return a region polygon from a DEM or a polygon text file.
+
+    Files with an extension in DEM_EXTENSIONS are read with
+    dem_footprint, anything else with region.read_polygon.
+
+    """
+    if os.path.splitext(filename)[1].lower() in DEM_EXTENSIONS:
+        return dem_footprint(filename, n_edge=n_edge)
+    return read_polygon(filename)
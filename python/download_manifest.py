@@ -0,0 +1,148 @@
+#! /usr/bin/env python3
+"""
+Manifest of NSIDC EGI downloads, so interrupted or repeated queries
+don't start over from page 1.
+
+The manifest is a JSON file in the output directory that records, for
+each query (its parameters without the token), the next page to fetch,
+whether the query is complete and when it was last run, and for each
+granule on disk its size, mtime and CRC.  nsidc_download.download_pages
+resumes a query at its first incomplete page, and extract_h5 skips
+granules the manifest already knows without reading them back.
+
+A refresh reruns a completed query for the granules acquired since its
+last run, as a new query whose time range starts at the last run.
+Working out the refresh doesn't change the manifest; the refresh is
+recorded when its download starts, so a dry run leaves no trace.
+"""
+
+import datetime
+import json
+import os
+import threading
+
+# Default manifest name, in the output directory
+MANIFEST = 'NSIDC_manifest.json'
+
+# Days before the last run that a refresh starts at, to catch granules
+# that were published some time after they were acquired
+REFRESH_LAG_DAYS = 7
+
+TIME_FMT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime(TIME_FMT)
+
+
+class Manifest(object):
+    """
+        Query and granule records for one output directory.
+
+        The file is rewritten (atomically) after every change, so it is
+        up to date whenever a download is interrupted.  Changes are made
+        under self.lock, so concurrent downloads can share a manifest.
+    """
+
+    def __init__(self, filename=MANIFEST):
+        self.filename = filename
+        self.lock = threading.RLock()
+        if os.path.isfile(filename):
+            with open(filename) as fh:
+                self.data = json.load(fh)
+        else:
+            self.data = {'queries': {}, 'granules': {}}
+
+    @property
+    def granules(self):
+        """ {granule name: [size, mtime, crc]} of the granules on disk. """
+        return self.data['granules']
+
+    @staticmethod
+    def key(params):
+        """ Key of a query: its parameters without token and page. """
+        return json.dumps({k: str(v) for k, v in params.items()
+                           if k not in ('token', 'page_num')}, sort_keys=True)
+
+    def entry(self, params):
+        """ The record of a query, created if it is new. """
+        key = self.key(params)
+        if key not in self.data['queries']:
+            self.data['queries'][key] = {
+                'params': json.loads(key), 'next_page': 1, 'complete': False,
+                'started': None, 'finished': None, 'last_run': None}
+        return self.data['queries'][key]
+
+    def start(self, params, base=None):
+        """
+            First page to fetch for a query, or None if it is complete.
+
+            base is the query that params refreshes (see
+            refresh_params), whose last run is brought up to date when
+            params finishes.
+        """
+        with self.lock:
+            entry = self.entry(params)
+            if base is not None and self.key(base) != self.key(params):
+                entry['base'] = self.key(base)
+            if entry['complete']:
+                return None
+            if entry['started'] is None:
+                entry['started'] = _now()
+            self.save()
+            return entry['next_page']
+
+    def page_done(self, params, page):
+        """ Record that a page has been downloaded and extracted. """
+        with self.lock:
+            self.entry(params)['next_page'] = page + 1
+            self.save()
+
+    def finish(self, params):
+        """ Record that a query has returned all of its pages. """
+        with self.lock:
+            entry = self.entry(params)
+            entry['complete'] = True
+            entry['finished'] = _now()
+            # a refresh brings its base query up to date
+            base = self.data['queries'].get(entry.get('base'), entry)
+            base['last_run'] = max(base['last_run'] or '', entry['started'])
+            self.save()
+
+    def refresh_params(self, params, lag_days=REFRESH_LAG_DAYS):
+        """
+            Parameters of a query for the granules acquired since the
+            last run of params.
+
+            Returns params unchanged if the query has never completed,
+            the parameters of an unfinished refresh if there is one (so
+            it resumes), and None if the query's time range ends before
+            the last run.  Nothing is saved: pass params as the base of
+            start when the refresh is run.
+        """
+        base_key = self.key(params)
+        base = self.data['queries'].get(base_key)
+        if base is None or base['last_run'] is None:
+            return params
+
+        for entry in self.data['queries'].values():
+            if entry.get('base') == base_key and not entry['complete']:
+                return dict(params, time=entry['params']['time'])
+
+        t0 = datetime.datetime.strptime(base['last_run'], TIME_FMT) \
+            - datetime.timedelta(days=lag_days)
+        t0, t1 = t0.strftime(TIME_FMT), _now()
+        if params.get('time'):
+            t_start, t_end = params['time'].split(',')
+            t0, t1 = max(t0, t_start), min(t1, t_end)
+            if t0 >= t1:
+                return None
+
+        return dict(params, time='%s,%s' % (t0, t1))
+
+    def save(self):
+        """ Write the manifest, replacing the old file in one step. """
+        with self.lock:
+            with open(self.filename + '.part', 'w') as fh:
+                json.dump(self.data, fh, indent=1, sort_keys=True)
+            os.replace(self.filename + '.part', self.filename)
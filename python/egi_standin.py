@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+"""
+Local stand-in for the NSIDC EGI server, for testing nsidc_download.
+
+EGIStandIn serves numbered pages of fake granules from an http.server
+on localhost.  Each page is a zip file of small .h5 members, named in
+the Content-Disposition header like EGI's; the page after the last
+one comes back without a zip file.  Pages can be made to fail with
+HTTP 503 a few times before they succeed, or every request can be
+answered with one status (401, say), and each request can be delayed
+so concurrent downloads overlap.  The server counts the requests of
+each page and the most it served at once.
+
+Run as a script, it checks nsidc_download against the stand-in:
+Content-Disposition naming, extraction, concurrency, retries, the end
+of the results and HTTP errors.
+
+    python egi_standin.py
+"""
+
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from nsidc_download import download_pages, extract_pages
+
+
+class EGIStandIn(object):
+    """
+        An EGI stand-in serving n_pages pages of granules_per_page fake
+        granules on localhost.
+
+        fail is a {page: n} dict of pages that return HTTP 503 n times
+        before they succeed.  status, if given, is returned for every
+        request instead.  delay (s) is added to every request.
+
+        Use as a context manager, or call start and stop; url is the
+        request URL once started.
+    """
+
+    def __init__(self, n_pages=3, granules_per_page=2, fail=None,
+                 status=None, delay=0.0):
+        self.n_pages = n_pages
+        self.granules_per_page = granules_per_page
+        self.fail = dict(fail or {})
+        self.status = status
+        self.delay = delay
+        self.requests = {}
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def granule_names(self, page):
+        """ Names of the granules of a page. """
+        return ['ATL03_20190101000000_%02d%02d0201_001_01.h5' % (page, k)
+                for k in range(self.granules_per_page)]
+
+    def zip_page(self, page):
+        """ The zip file of a page, as bytes. """
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            for name in self.granule_names(page):
+                # EGI stores granules under a directory per order
+                zf.writestr('5000000%d/%s' % (page, name), name * 10)
+        return buf.getvalue()
+
+    def start(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                page = int(query.get('page_num', ['1'])[0])
+                with standin.lock:
+                    standin.requests[page] = standin.requests.get(page, 0) + 1
+                    standin.active += 1
+                    standin.max_active = max(standin.max_active,
+                                             standin.active)
+                    failing = standin.fail.get(page, 0) > 0
+                    if failing:
+                        standin.fail[page] -= 1
+                try:
+                    time.sleep(standin.delay)
+                    if standin.status is not None:
+                        self.reply(standin.status)
+                    elif failing:
+                        self.reply(503)
+                    elif page > standin.n_pages:
+                        # the end of the results: no zip file
+                        self.reply(200, b'no more results', 'text/plain')
+                    else:
+                        self.reply(200, standin.zip_page(page),
+                                   'application/zip',
+                                   'attachment; filename="5000000%d.zip"'
+                                   % page)
+                finally:
+                    with standin.lock:
+                        standin.active -= 1
+
+            def reply(self, status, body=b'', content_type='text/plain',
+                      disposition=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if disposition is not None:
+                    self.send_header('Content-Disposition', disposition)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/egi/request' % self.server.server_port
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+def self_check():
+    """ Run nsidc_download against the stand-in; returns the failures. """
+    failures = []
+
+    def check(ok, message):
+        print('%s: %s' % ('ok' if ok else 'FAILED', message))
+        if not ok:
+            failures.append(message)
+
+    params = {'short_name': 'ATL03', 'version': '001', 'page_size': 2}
+    workdir = tempfile.mkdtemp(prefix='egi_standin_')
+    try:
+        # naming, extraction and concurrency
+        with EGIStandIn(n_pages=4, delay=0.2) as standin:
+            done = download_pages(params, url=standin.url, out_dir=workdir,
+                                  concurrency=3, backoff=0.01,
+                                  on_page=extract_pages(workdir, verbose=False))
+            check([os.path.basename(z) for _, z in done]
+                  == ['5000000%d.zip' % p for p in range(1, 5)],
+                  'zip files named from Content-Disposition')
+            names = [n for p in range(1, 5) for n in standin.granule_names(p)]
+            files = os.listdir(workdir)
+            check(sorted(f for f in files if f.endswith('.h5'))
+                  == sorted(names), 'granules extracted flat')
+            check(not any(f.endswith('.zip') for f in files),
+                  'zip files removed after extraction')
+            check(standin.max_active >= 2,
+                  'pages fetched concurrently (%d at once)'
+                  % standin.max_active)
+            check(standin.requests.get(5, 0) >= 1,
+                  'page after the last one ends the request')
+
+        # retries of transient errors
+        with EGIStandIn(n_pages=2, fail={2: 2}) as standin:
+            done = download_pages(params, url=standin.url, out_dir=workdir,
+                                  concurrency=2, retries=3, backoff=0.01)
+            check(len(done) == 2 and standin.requests[2] == 3,
+                  'HTTP 503 retried (%d requests of page 2)'
+                  % standin.requests[2])
+            for _, zip_file in done:
+                os.remove(zip_file)
+
+        # HTTP errors that are not the end of the results
+        for status in (401, 404):
+            with EGIStandIn(status=status) as standin:
+                try:
+                    download_pages(params, url=standin.url, out_dir=workdir,
+                                   concurrency=2, retries=1, backoff=0.01)
+                    check(False, 'HTTP %d raises' % status)
+                except RuntimeError as err:
+                    check(re.search(str(status), str(err)) is not None,
+                          'HTTP %d raises: %s' % (status, err))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(1 if self_check() else 0)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Vectorized GPS time conversions for ICESat-2 data.
+
+ATLAS times are given as delta_time, seconds since the ATLAS SDP GPS
+epoch stored in /ancillary_data/atlas_sdp_gps_epoch. Adding the two
+gives GPS seconds since 1980-01-06T00:00:00 UTC.
+
+The conversions here use NumPy datetime64 arithmetic and a built-in
+leap second table instead of astropy, which is slow to import and to
+build Time objects with. Decimal years are computed on the TAI scale,
+like astropy's Time(t, format='gps').decimalyear that readATL06 used
+before.
+
+Run as a script to benchmark against astropy:
+
+    python gps_time.py [npoints]
+
+"""
+
+import sys
+import time
+
+import numpy as np
+
+# GPS epoch, and the TAI calendar time of the GPS epoch
+GPS_EPOCH = np.datetime64('1980-01-06T00:00:00', 'ns')
+GPS_EPOCH_TAI = np.datetime64('1980-01-06T00:00:19', 'ns')
+
+# UTC date each leap second took effect, and TAI - UTC (s) after it.
+# Update when IERS announces a new leap second (none through 2026).
+LEAP_SECONDS = [
+    ('1981-07-01', 20), ('1982-07-01', 21), ('1983-07-01', 22),
+    ('1985-07-01', 23), ('1988-01-01', 24), ('1990-01-01', 25),
+    ('1991-01-01', 26), ('1992-07-01', 27), ('1993-07-01', 28),
+    ('1994-07-01', 29), ('1996-01-01', 30), ('1997-07-01', 31),
+    ('1999-01-01', 32), ('2006-01-01', 33), ('2009-01-01', 34),
+    ('2012-07-01', 35), ('2015-07-01', 36), ('2017-01-01', 37),
+]
+
+# GPS seconds at which each leap second took effect, and GPS - UTC (s)
+_LEAP_GPS = np.array([(np.datetime64(date, 's') - GPS_EPOCH.astype('datetime64[s]')).astype(np.int64)
+                      + (tai_utc - 19) for date, tai_utc in LEAP_SECONDS])
+_GPS_UTC = np.array([tai_utc - 19 for date, tai_utc in LEAP_SECONDS])
+
+# Start (ns since 1970) and length (ns) of each calendar year
+_YEARS = np.arange(1980, 2101)
+_YEAR_BOUNDS = (np.append(_YEARS, 2101) - 1970).astype('datetime64[Y]').astype('datetime64[ns]').astype(np.int64)
+_YEAR_START = _YEAR_BOUNDS[:-1]
+_YEAR_LENGTH = np.diff(_YEAR_BOUNDS)
+
+
+def _timedelta_ns(seconds):
+    """ Convert float seconds to timedelta64[ns] without losing precision. """
+    seconds = np.asarray(seconds, dtype=np.float64)
+    whole = np.floor(seconds)
+    frac = np.round((seconds - whole) * 1e9).astype(np.int64)
+    return (whole.astype(np.int64) * 1000000000 + frac).astype('timedelta64[ns]')
+
+
+def gps_utc_offset(gps):
+    """ GPS - UTC (s) in effect at each GPS time. """
+    i = np.searchsorted(_LEAP_GPS, np.asarray(gps, dtype=np.float64), side='right')
+    return np.concatenate(([0], _GPS_UTC))[i]
+
+
+def gps2datetime(gps):
+    """ Convert GPS seconds to UTC datetime64[ns]. """
+    gps = np.asarray(gps, dtype=np.float64)
+    return GPS_EPOCH + _timedelta_ns(gps - gps_utc_offset(gps))
+
+
+def gps2dyr(gps):
+    """ Convert GPS seconds to decimal years (TAI scale, as astropy). """
+    tai = (GPS_EPOCH_TAI + _timedelta_ns(gps)).astype(np.int64)
+    i = np.searchsorted(_YEAR_START, tai, side='right') - 1
+    return _YEARS[i] + (tai - _YEAR_START[i]) / _YEAR_LENGTH[i]
+
+
+def atlas_times(delta_time, atlas_sdp_gps_epoch):
+    """
+        Convert ATLAS delta_time to decimal years, GPS seconds and UTC.
+
+        Returns (t_yr, t_gps, t_utc) with t_utc as datetime64[ns].
+    """
+    t_gps = delta_time + atlas_sdp_gps_epoch
+    return gps2dyr(t_gps), t_gps, gps2datetime(t_gps)
+
+
+def gps2dyr_astropy(gps):
+    """ Reference decimal year conversion with astropy (slow). """
+    from astropy.time import Time
+    return Time(gps, format='gps').decimalyear
+
+
+def check_astropy(gps):
+    """
+        Compare the conversions with astropy.
+
+        Returns the largest differences in seconds for the decimal year
+        and the UTC datetime. The decimal year difference is limited by
+        float64 resolution of a decimal year (~15 us near 2020).
+    """
+    from astropy.time import Time
+    t = Time(gps, format='gps')
+
+    # Decimal year difference expressed in seconds of the year
+    dyr = gps2dyr(gps)
+    year = np.floor(dyr)
+    length = (np.array(year - 1969, dtype='datetime64[Y]') -
+              np.array(year - 1970, dtype='datetime64[Y]')).astype('timedelta64[s]').astype(float)
+    d_dyr = np.max(np.abs(dyr - t.decimalyear) * length)
+
+    # UTC difference
+    utc = t.utc.datetime64.astype('datetime64[ns]')
+    d_utc = np.max(np.abs((gps2datetime(gps) - utc).astype(np.int64))) * 1e-9
+
+    return d_dyr, d_utc
+
+
+def benchmark(n=1000000, nsub=1000, nrep=100):
+    """
+        Time the NumPy and astropy decimal year conversions on n
+        ATL06-like times, and on nrep small subsets of nsub times as in
+        a regional extraction.
+    """
+    gps = 1198800018.0 + np.sort(np.random.uniform(0, 2.5e8, n))
+
+    t0 = time.time()
+    from astropy.time import Time
+    t_import = time.time() - t0
+
+    timings = []
+    for convert in (gps2dyr, gps2dyr_astropy):
+        t0 = time.time()
+        convert(gps)
+        t_full = time.time() - t0
+        t0 = time.time()
+        for k in range(nrep):
+            convert(gps[k * nsub:(k + 1) * nsub])
+        timings.append((t_full, time.time() - t0))
+
+    d_dyr, d_utc = check_astropy(gps)
+
+    print('astropy import: %8.3f s' % t_import)
+    print('%23s %14s' % ('%d points' % n, '%d x %d points' % (nrep, nsub)))
+    for name, (t_full, t_sub) in zip(('numpy', 'astropy'), timings):
+        print('%-9s %11.4f s %12.4f s' % (name + ':', t_full, t_sub))
+    print('speedup   %11.1fx %12.1fx' % (timings[1][0] / timings[0][0],
+                                          timings[1][1] / timings[0][1]))
+    print('max difference: decimal year %.2e s, utc %.2e s' % (d_dyr, d_utc))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local SQLite catalogue of ATL03/ATL06 granules.
+
+For every granule the catalogue records file size and mtime, product,
+RGT and cycle, time range, processing status, and the lat/lon bounds
+and time range of each beam. Readers query it to skip granules (or
+beams) that can't intersect a region before opening them.
+
+Updates are incremental: only files that are new, or whose size or
+mtime changed, are opened. Files that can't be read are recorded with
+status 'failed' and no beams, so they aren't reopened either.
+
+Times are GPS seconds (delta_time + atlas_sdp_gps_epoch).
+
+    python granule_catalog.py catalog.db /path/to/granules [-b w e s n]
+
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+
+import h5py
+import numpy as np
+
+# Beam names
+GROUPS = ['gt1l', 'gt1r', 'gt2l', 'gt2r', 'gt3l', 'gt3r']
+
+# Per-beam latitude, longitude and time datasets of each product
+BEAM_VARS = {
+    'ATL06': ('land_ice_segments/latitude', 'land_ice_segments/longitude',
+              'land_ice_segments/delta_time'),
+    'ATL03': ('geolocation/reference_photon_lat',
+              'geolocation/reference_photon_lon',
+              'geolocation/delta_time'),
+}
+
+# ATLxx_yyyymmddhhmmss_ttttccss_rrr_vv.h5
+NAME_RE = re.compile(r'(ATL\d\d)_\d{14}_(\d{4})(\d{2})\d{2}_')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS granules (
+    path TEXT PRIMARY KEY, size INTEGER, mtime REAL, product TEXT,
+    rgt INTEGER, cycle INTEGER, t_min REAL, t_max REAL, status TEXT);
+CREATE TABLE IF NOT EXISTS beams (
+    path TEXT, beam TEXT, lat_min REAL, lat_max REAL, lon_min REAL,
+    lon_max REAL, t_min REAL, t_max REAL, PRIMARY KEY (path, beam));
+CREATE INDEX IF NOT EXISTS beams_lat ON beams (lat_min, lat_max);
+CREATE INDEX IF NOT EXISTS beams_t ON beams (t_min, t_max);
+"""
+
+
+def open_catalog(dbfile):
+    """ Open (and create if needed) a catalogue database. """
+    db = sqlite3.connect(dbfile)
+    db.executescript(SCHEMA)
+    return db
+
+
+def file_record(path):
+    """
+        The granules table row of a file, from its name and stat only.
+    """
+
+    name = os.path.basename(path)
+    m = NAME_RE.search(name)
+    stat = os.stat(path)
+    granule = {'path': os.path.abspath(path), 'size': stat.st_size,
+               'mtime': stat.st_mtime, 'product': None, 'rgt': None,
+               'cycle': None, 't_min': None, 't_max': None,
+               'status': 'new'}
+    if m is not None:
+        granule['product'] = m.group(1)
+        granule['rgt'] = int(m.group(2))
+        granule['cycle'] = int(m.group(3))
+    return granule
+
+
+def scan_granule(path):
+    """
+        Read the catalogue record of one granule.
+
+        Returns (granule, beams): granule is a dict of the granules
+        table columns and beams a list of dicts of the beams table
+        columns. Raises IOError/OSError/KeyError if the file can't be
+        read.
+    """
+
+    granule = file_record(path)
+    beams = []
+    with h5py.File(path, 'r') as fi:
+
+        # Orbit info from the file wins over the file name
+        for key, var in (('rgt', 'orbit_info/rgt'),
+                         ('cycle', 'orbit_info/cycle_number')):
+            if var in fi:
+                granule[key] = int(fi[var][0])
+
+        tref = fi['/ancillary_data/atlas_sdp_gps_epoch'][0]
+
+        for group in GROUPS:
+            for product, (v_lat, v_lon, v_time) in BEAM_VARS.items():
+                if group + '/' + v_lat in fi:
+                    break
+            else:
+                continue
+            granule['product'] = granule['product'] or product
+
+            lat = fi[group + '/' + v_lat][:]
+            lon = fi[group + '/' + v_lon][:]
+            t = fi[group + '/' + v_time][:]
+
+            # Drop fill values
+            good = np.isfinite(lat) & (np.abs(lat) <= 90) & (np.abs(lon) <= 360)
+            good &= np.isfinite(t) & (np.abs(t) < 1e12)
+            if not good.any():
+                continue
+            lat, lon, t = lat[good], lon[good], t[good] + tref
+
+            beams.append({'path': granule['path'], 'beam': group,
+                          'lat_min': lat.min(), 'lat_max': lat.max(),
+                          'lon_min': lon.min(), 'lon_max': lon.max(),
+                          't_min': t.min(), 't_max': t.max()})
+
+    if beams:
+        granule['t_min'] = min(b['t_min'] for b in beams)
+        granule['t_max'] = max(b['t_max'] for b in beams)
+
+    return granule, beams
+
+
+def update_catalog(db, paths, verbose=False):
+    """
+        Add new or changed granules to the catalogue.
+
+        Files whose size and mtime match the catalogue are not opened.
+        Files that can't be read get status 'failed' and no beams.
+        Catalogue entries for paths that no longer exist are removed.
+        Returns the number of granules scanned.
+    """
+
+    known = {row[0]: (row[1], row[2]) for row in
+             db.execute('SELECT path, size, mtime FROM granules')}
+
+    nscan = 0
+    for path in paths:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        if known.get(path) == (stat.st_size, stat.st_mtime):
+            continue
+        try:
+            granule, beams = scan_granule(path)
+        except (IOError, OSError, KeyError) as err:
+            if verbose:
+                print('granule_catalog: failed %s: %s' % (path, err))
+            granule, beams = dict(file_record(path), status='failed'), []
+        db.execute('DELETE FROM beams WHERE path = ?', (path,))
+        db.execute('INSERT OR REPLACE INTO granules VALUES '
+                   '(:path, :size, :mtime, :product, :rgt, :cycle, '
+                   ':t_min, :t_max, :status)', granule)
+        db.executemany('INSERT INTO beams VALUES (:path, :beam, :lat_min, '
+                       ':lat_max, :lon_min, :lon_max, :t_min, :t_max)', beams)
+        nscan += 1
+
+    # Forget files that have gone away
+    for path in known:
+        if not os.path.isfile(path):
+            db.execute('DELETE FROM beams WHERE path = ?', (path,))
+            db.execute('DELETE FROM granules WHERE path = ?', (path,))
+
+    db.commit()
+    return nscan
+
+
+def query_beams(db, bbox=None, t_range=None, rgt=None, cycle=None,
+                product=None, status=None):
+    """
+        Find beams that may intersect a region and time range.
+
+        bbox is (w, e, s, n) in degrees and t_range (t0, t1) in GPS
+        seconds. The test uses beam bounding boxes, so it is
+        conservative: every beam with data in the region is returned.
+        Returns a dict {path: [beam, ...]}.
+    """
+
+    sql = ('SELECT beams.path, beams.beam FROM beams '
+           'JOIN granules ON beams.path = granules.path WHERE 1')
+    args = []
+    if bbox is not None:
+        (lonmin, lonmax, latmin, latmax) = bbox
+        sql += (' AND beams.lat_max >= ? AND beams.lat_min <= ?'
+                ' AND beams.lon_max >= ? AND beams.lon_min <= ?')
+        args += [latmin, latmax, lonmin, lonmax]
+    if t_range is not None:
+        sql += ' AND beams.t_max >= ? AND beams.t_min <= ?'
+        args += [t_range[0], t_range[1]]
+    for column, value in (('rgt', rgt), ('cycle', cycle),
+                          ('product', product), ('status', status)):
+        if value is not None:
+            sql += ' AND granules.%s = ?' % column
+            args.append(value)
+    sql += ' ORDER BY beams.path, beams.beam'
+
+    found = {}
+    for path, beam in db.execute(sql, args):
+        found.setdefault(path, []).append(beam)
+    return found
+
+
+def query_granules(db, **kwargs):
+    """ Paths of granules that may intersect; see query_beams. """
+    return sorted(query_beams(db, **kwargs))
+
+
+def query_status(db, status):
+    """ Paths of the granules with a processing status. """
+    return [row[0] for row in
+            db.execute('SELECT path FROM granules WHERE status = ? '
+                       'ORDER BY path', (status,))]
+
+
+def set_status(db, paths, status):
+    """ Set the processing status of granules. """
+    db.executemany('UPDATE granules SET status = ? WHERE path = ?',
+                   [(status, os.path.abspath(path)) for path in paths])
+    db.commit()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+            description='Update and query a catalogue of ICESat-2 granules.')
+    parser.add_argument('catalog', type=str, help='catalogue file (SQLite)')
+    parser.add_argument('path', type=str, nargs='?', default=None,
+                        help='directory of granules to add')
+    parser.add_argument('-b', metavar=('w','e','s','n'), dest='bbox',
+                        type=float, nargs=4, default=None,
+                        help='list granules intersecting this bounding box')
+    parser.add_argument('-v', dest='verbose', action='store_true')
+    args = parser.parse_args()
+
+    db = open_catalog(args.catalog)
+
+    if args.path is not None:
+        paths = [os.path.join(dpath, f)
+                 for dpath, dnames, fnames in os.walk(args.path)
+                 for f in fnames if f.endswith('.h5')]
+        nscan = update_catalog(db, paths, verbose=args.verbose)
+        print('scanned %d of %d granules' % (nscan, len(paths)))
+
+    for path, beams in sorted(query_beams(db, bbox=args.bbox).items()):
+        print(path, ','.join(beams))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,433 @@
+"""Open ATL granules with tuned HDF5 caches and read into reused buffers.
+
+h5py opens files with HDF5's default raw data chunk cache, which holds
+only a few of the decompressed chunks of each dataset.  A read that
+starts or stops inside a chunk decompresses it; when the chunk has
+already been pushed out of the cache, the next read of the same chunk
+decompresses it again.  Slicing ATL03 photon datasets a window of
+segments at a time does exactly that.  open_granule opens granules
+with a larger chunk cache and, optionally, a page buffer, set with
+configure:
+
+chunk_cache
+    Bytes of raw data chunk cache per open dataset (rdcc_nbytes).
+chunk_slots
+    Hash table slots of the chunk cache (rdcc_nslots).  HDF5 suggests a
+    prime about 100 times the number of chunks that fit in the cache;
+    the default is derived from chunk_cache on that basis.
+page_buffer
+    Bytes of HDF5 page buffer (page_buf_size).  It only has an effect on
+    files written with the paged file space strategy (see report); 0
+    turns it off.
+
+Worker processes open granules the same way only if configure is
+called in them too: pools pass configuration to their workers.
+
+read and ReadBuffers read datasets with Dataset.read_direct into arrays
+allocated by the caller, or into buffers kept from one read to the
+next, instead of a new array per read.
+
+Run as a script, it reports the chunk layout and compression of each
+dataset in a granule, optionally with the time to read it with given
+cache settings:
+
+    python granule_io.py ATL03_....h5 -p gt1l/heights -r -H 64
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import sys
+import time
+
+import h5py
+import numpy as np
+
+# Default chunk cache size in bytes.
+CHUNK_CACHE = 32 * 2**20
+
+# Chunk size assumed when deriving chunk_slots from chunk_cache.
+# ATL03 and ATL06 chunks are 10000 values, 40 to 80 kB.
+CHUNK_BYTES = 2**16
+
+_chunk_cache = CHUNK_CACHE
+_chunk_slots = None
+_page_buffer = 0
+
+
+def configure(chunk_cache=None, chunk_slots=None, page_buffer=None):
+    """Set how this process opens granules.
+
+    Parameters
+    ----------
+    chunk_cache : int, optional
+        Chunk cache bytes per dataset.  Default is CHUNK_CACHE.
+    chunk_slots : int, optional
+        Chunk cache hash table slots.  Default is derived from
+        chunk_cache.
+    page_buffer : int, optional
+        Page buffer bytes.  Default is 0, no page buffer.
+
+    """
+    global _chunk_cache, _chunk_slots, _page_buffer
+    _chunk_cache = int(chunk_cache if chunk_cache is not None
+                       else CHUNK_CACHE)
+    _chunk_slots = int(chunk_slots) if chunk_slots is not None else None
+    _page_buffer = int(page_buffer or 0)
+
+
+def configuration():
+    """Return the configure keyword arguments that are in effect."""
+    return {"chunk_cache": _chunk_cache, "chunk_slots": _chunk_slots,
+            "page_buffer": _page_buffer}
+
+
+def settings():
+    """Return the h5py.File keyword arguments used by open_granule."""
+    slots = _chunk_slots
+    if slots is None:
+        slots = chunk_slots(_chunk_cache)
+    kwargs = {"rdcc_nbytes": _chunk_cache, "rdcc_nslots": slots}
+    if _page_buffer > 0:
+        kwargs["page_buf_size"] = _page_buffer
+    return kwargs
+
+
+def chunk_slots(chunk_cache):
+    """Return a prime about 100 times the chunks that fit in chunk_cache."""
+    n = max(100 * chunk_cache // CHUNK_BYTES, 521) | 1
+    while any(n % k == 0 for k in range(3, int(n**0.5) + 1, 2)):
+        n += 2
+    return n
+
+
+def open_granule(filename, mode="r", **kwargs):
+    """Open an HDF5 granule with the configured caches.
+
+    Parameters
+    ----------
+    filename : str
+        Granule file name.
+    mode : str, optional
+        h5py.File mode.  Default is read only.
+    **kwargs
+        h5py.File keyword arguments, overriding the configured ones.
+
+    Returns
+    -------
+    f_in : h5py.File
+
+    """
+    options = settings()
+    options.update(kwargs)
+    if "page_buf_size" not in options:
+        return h5py.File(filename, mode, **options)
+    try:
+        return h5py.File(filename, mode, **options)
+    except (IOError, OSError, ValueError):
+        # Some HDF5 versions refuse a page buffer for files that were
+        # not written with paged aggregation.
+        del options["page_buf_size"]
+        return h5py.File(filename, mode, **options)
+
+
+def file_settings(f_in):
+    """Return the cache settings an open granule actually uses.
+
+    Unlike settings, this reflects a page buffer that open_granule had
+    to drop, or that HDF5 ignored for a file without paged aggregation.
+
+    Returns
+    -------
+    settings : dict
+        rdcc_nbytes, rdcc_nslots and page_buf_size, in the form of
+        settings.
+
+    """
+    plist = f_in.id.get_access_plist()
+    _, nslots, nbytes, _ = plist.get_cache()
+    kwargs = {"rdcc_nbytes": nbytes, "rdcc_nslots": nslots}
+    page_buffer = plist.get_page_buffer_size()[0]
+    if page_buffer > 0:
+        kwargs["page_buf_size"] = page_buffer
+    return kwargs
+
+
+def read(dataset, start=None, stop=None, out=None):
+    """Read rows [start:stop] of a dataset with read_direct.
+
+    Parameters
+    ----------
+    dataset : h5py Dataset or NumPy array
+        Dataset to read.  Arrays, such as memory-mapped photon_cache
+        entries, are sliced instead.
+    start, stop : int, optional
+        Row range.  Default is every row.
+    out : NumPy array, optional
+        Array to read into, with at least stop - start rows and the
+        dataset's trailing shape and dtype.  Default is a new array.
+
+    Returns
+    -------
+    data : NumPy array
+        The rows read; a view of out if out was given.  A scalar
+        dataset is read whole, ignoring start and stop.
+
+    """
+    if dataset.ndim == 0:
+        if out is None:
+            return np.array(dataset[()])
+        out[...] = dataset[()]
+        return out
+    start, stop, _ = slice(start, stop).indices(dataset.shape[0])
+    stop = max(start, stop)
+    if not isinstance(dataset, h5py.Dataset):
+        return dataset[start:stop]
+    n = stop - start
+    if out is None:
+        out = np.empty((n,) + dataset.shape[1:], dtype=dataset.dtype)
+    if n > 0:
+        dataset.read_direct(out, source_sel=np.s_[start:stop],
+                            dest_sel=np.s_[0:n])
+    return out[:n]
+
+
+def read_datasets(f_in, names, buffers=None):
+    """Read several whole datasets with read_direct.
+
+    Parameters
+    ----------
+    f_in : h5py.File
+        Open granule.
+    names : sequence of str
+        Dataset paths.
+    buffers : ReadBuffers, optional
+        Read into these buffers instead of new arrays.
+
+    Returns
+    -------
+    data : dict
+        NumPy array of each name.
+
+    Raises
+    ------
+    KeyError
+        A dataset is missing from the file.
+
+    """
+    data = {}
+    for name in names:
+        if name not in f_in:
+            raise KeyError(name + " not found in " + f_in.filename)
+        if buffers is not None:
+            data[name] = buffers.read(f_in[name])
+        else:
+            data[name] = read(f_in[name])
+    return data
+
+
+class ReadBuffers(object):
+    """Buffers reused by repeated reads of the same datasets.
+
+    Each dataset gets one buffer, allocated on its first read and grown
+    when a later read needs more rows, so reading a track a window at a
+    time allocates once per dataset instead of once per window.  The
+    array returned by read is a view of the buffer and is overwritten
+    by the next read of the same dataset; copy what has to be kept.
+
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    @property
+    def nbytes(self):
+        """Total size of the buffers."""
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+    def read(self, dataset, start=None, stop=None):
+        """Read rows [start:stop] of a dataset into its buffer.
+
+        Arrays, such as memory-mapped photon_cache entries, are sliced
+        instead, without a copy, and scalar datasets are read whole.
+
+        """
+        if not isinstance(dataset, h5py.Dataset) or dataset.ndim == 0:
+            return read(dataset, start, stop)
+        start, stop, _ = slice(start, stop).indices(dataset.shape[0])
+        n = max(stop - start, 0)
+        buffer = self._buffers.get(dataset.name)
+        if buffer is None or buffer.shape[0] < n:
+            buffer = np.empty((n,) + dataset.shape[1:], dtype=dataset.dtype)
+            self._buffers[dataset.name] = buffer
+        return read(dataset, start, stop, out=buffer)
+
+
+def describe(f_in, prefix=None):
+    """Return the storage layout of every dataset in a granule.
+
+    Parameters
+    ----------
+    f_in : h5py.File
+        Open granule.
+    prefix : str, optional
+        Only describe datasets under this group.
+
+    Returns
+    -------
+    layout : list of dict
+        name, shape, dtype, chunks, n_chunks, chunk_bytes, compression,
+        compression_opts, shuffle, fletcher32, nbytes (decoded size),
+        storage_bytes (size in the file) and ratio of each dataset.
+
+    """
+    group = f_in[prefix] if prefix is not None else f_in
+    layout = []
+
+    def visit(name, item):
+        if not isinstance(item, h5py.Dataset):
+            return
+        chunks = item.chunks
+        n_chunks = chunk_bytes = None
+        if chunks is not None:
+            n_chunks = int(np.prod([-(-n // c)
+                                    for n, c in zip(item.shape, chunks)]))
+            chunk_bytes = int(np.prod(chunks)) * item.dtype.itemsize
+        storage = item.id.get_storage_size()
+        layout.append({
+            "name": item.name,
+            "shape": item.shape,
+            "dtype": str(item.dtype),
+            "chunks": chunks,
+            "n_chunks": n_chunks,
+            "chunk_bytes": chunk_bytes,
+            "compression": item.compression,
+            "compression_opts": item.compression_opts,
+            "shuffle": item.shuffle,
+            "fletcher32": item.fletcher32,
+            "nbytes": item.size * item.dtype.itemsize,
+            "storage_bytes": storage,
+            "ratio": (item.size * item.dtype.itemsize / storage
+                      if storage else None),
+        })
+
+    group.visititems(visit)
+    return layout
+
+
+def file_space(f_in):
+    """Return the file space strategy name and page size of a granule."""
+    plist = f_in.id.get_create_plist()
+    strategy = plist.get_file_space_strategy()[0]
+    names = {h5py.h5f.FSPACE_STRATEGY_FSM_AGGR: "fsm_aggr",
+             h5py.h5f.FSPACE_STRATEGY_PAGE: "page",
+             h5py.h5f.FSPACE_STRATEGY_AGGR: "aggr",
+             h5py.h5f.FSPACE_STRATEGY_NONE: "none"}
+    return names.get(strategy, str(strategy)), plist.get_file_space_page_size()
+
+
+def time_read(f_in, name, rows=None):
+    """Return the seconds to read a dataset, whole or rows at a time."""
+    dataset = f_in[name]
+    buffers = ReadBuffers()
+    step = rows or max(dataset.shape[0], 1)
+    start = time.perf_counter()
+    for row in range(0, dataset.shape[0], step):
+        buffers.read(dataset, row, row + step)
+    return time.perf_counter() - start
+
+
+def report(filename, prefix=None, time_reads=False, rows=None):
+    """Print the storage layout of a granule's datasets.
+
+    Parameters
+    ----------
+    filename : str
+        Granule file name, opened with the configured caches.  The
+        settings printed are those the file was opened with.
+    prefix : str, optional
+        Only report datasets under this group.
+    time_reads : bool, optional
+        Also time reading each dataset.
+    rows : int, optional
+        With time_reads, read this many rows at a time.
+
+    """
+    with open_granule(filename) as f_in:
+        strategy, page_size = file_space(f_in)
+        options = file_settings(f_in)
+        print(filename)
+        print("file space strategy %s, page size %d" % (strategy, page_size))
+        print("chunk cache %d bytes, %d slots, page buffer %d bytes"
+              % (options["rdcc_nbytes"], options["rdcc_nslots"],
+                 options.get("page_buf_size", 0)))
+        header = "%-48s %12s %8s %10s %8s %-7s %7s %6s" % (
+            "dataset", "rows", "dtype", "chunk", "chunks", "filter",
+            "shuffle", "ratio")
+        if time_reads:
+            header += " %9s" % "MB/s"
+        print(header)
+        for item in describe(f_in, prefix=prefix):
+            chunks = item["chunks"]
+            line = "%-48s %12s %8s %10s %8s %-7s %7s %6s" % (
+                item["name"],
+                item["shape"][0] if item["shape"] else 1,
+                item["dtype"],
+                "x".join(str(c) for c in chunks) if chunks else "-",
+                item["n_chunks"] if chunks else "-",
+                "%s%s" % (item["compression"] or "-",
+                          "" if item["compression_opts"] is None
+                          else "-%s" % (item["compression_opts"],)),
+                "yes" if item["shuffle"] else "no",
+                "%.2f" % item["ratio"] if item["ratio"] else "-")
+            if time_reads:
+                seconds = time_read(f_in, item["name"], rows=rows) \
+                    if item["shape"] else 0.0
+                line += " %9.1f" % (item["nbytes"] / 1e6 / seconds
+                                    if seconds > 0 else 0.0)
+            print(line)
+
+
+def cl_args(description):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("infile", type=str,
+                        help="input ATL03 or ATL06 file")
+    parser.add_argument("-p", type=str, default=None,
+                        help="only report datasets under this group")
+    parser.add_argument("-r", action="store_true",
+                        help="time reading each dataset")
+    parser.add_argument("-w", type=int, default=None,
+                        help="with -r, read this many rows at a time")
+    parser.add_argument("-H", type=float, default=CHUNK_CACHE / 2**20,
+                        help="chunk cache size (MB), default is %g"
+                             % (CHUNK_CACHE / 2**20))
+    parser.add_argument("-N", type=int, default=None,
+                        help="chunk cache slots, default is derived from "
+                             "the cache size")
+    parser.add_argument("-P", type=float, default=0.0,
+                        help="page buffer size (MB), default is 0 (off)")
+    return parser.parse_args()
+
+
+def main():
+    """Report the chunk layout and compression of a granule."""
+    args = cl_args(__doc__)
+    configure(chunk_cache=int(args.H * 2**20), chunk_slots=args.N,
+              page_buffer=int(args.P * 2**20))
+    try:
+        report(args.infile, prefix=args.p, time_reads=args.r, rows=args.w)
+    except (IOError, KeyError, OSError) as err:
+        print("{0}: error: {1}".format(__file__, err), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
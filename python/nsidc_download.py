@@ -0,0 +1,268 @@
+#! /usr/bin/env python3
+"""
+Paginated NSIDC EGI downloads with a pooled HTTP session.
+
+Each page of an EGI request comes back as a zip file whose name is
+given in the Content-Disposition header.  Pages are fetched by a pool
+of threads that share one requests.Session, so TLS connections are
+reused, with retries and exponential backoff for transient errors.
+The first page that comes back without a zip file ends the request.
+
+Each page's .h5 files are extracted with zipfile, straight to a flat
+output directory, while later pages are still downloading. Files that
+are already there with the same size and CRC are not written again.
+
+With a download_manifest.Manifest, an interrupted request resumes at
+its first incomplete page, and granules the manifest already knows are
+skipped without being read back for their CRC.
+
+The base URL is a parameter, so the downloader can be pointed at a
+local stand-in server that serves fake zip pages (see egi_standin.py).
+"""
+
+import os
+import re
+import shutil
+import sys
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+EGI_URL = 'https://n5eil02u.ecs.nsidc.org/egi/request'
+
+# HTTP status codes worth retrying
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+zip_re = re.compile('filename="?([^";]*\\.zip)"?')
+
+
+def read_token(script_dir=None):
+    """
+        Read the NSIDC token from NSIDC_token.txt, looking in the current
+        directory first and then in script_dir (default: the directory of
+        the running script).
+    """
+    if script_dir is None:
+        script_dir = sys.path[0]
+    try:
+        fh = open('NSIDC_token.txt', 'r')
+    except FileNotFoundError:
+        # also look in the script's directory
+        fh = open(os.path.join(script_dir, 'NSIDC_token.txt'), 'r')
+
+    token = None
+    token_re = re.compile('<id>(.*)</id>')
+    with fh:
+        for line in fh:
+            m = token_re.search(line)
+            if m is not None:
+                token = m.group(1)
+    if token is None:
+        raise RuntimeError('missing token string')
+    return token
+
+
+def make_session(concurrency=4):
+    """ A requests session whose connection pool fits concurrency threads. """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, 1))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def zip_name(headers):
+    """ Zip file name from a Content-Disposition header, or None. """
+    m = zip_re.search(headers.get('Content-Disposition', ''))
+    if m is None:
+        return None
+    return os.path.basename(m.group(1))
+
+
+def file_crc(filename, chunk_size=1 << 20):
+    """ CRC-32 of a file, as stored in zip file headers. """
+    crc = 0
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(chunk_size), b''):
+            crc = zlib.crc32(block, crc)
+    return crc & 0xffffffff
+
+
+def extract_h5(zip_file, out_dir='.', remove=True, chunk_size=1 << 20,
+               known=None):
+    """
+        Extract the .h5 members of a zip file into out_dir, dropping the
+        directories they are stored under.
+
+        Each member is streamed to a .part file and renamed when done, so
+        no partial granules are left behind. Members that already exist
+        in out_dir with matching size and CRC are skipped. The zip file
+        is deleted afterwards if remove is True.
+
+        known is an optional {name: [size, mtime, crc]} dict of granules
+        on disk (see download_manifest.Manifest.granules). Files that
+        match their record are skipped without computing their CRC, and
+        the records of the files extracted or checked are updated.
+
+        Returns (extracted, skipped), lists of output file names.
+    """
+    extracted, skipped = [], []
+    with zipfile.ZipFile(zip_file) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not info.filename.endswith('.h5'):
+                continue
+            name = os.path.basename(info.filename)
+            out_file = os.path.join(out_dir, name)
+            if os.path.isfile(out_file):
+                stat = os.stat(out_file)
+                record = [stat.st_size, stat.st_mtime, info.CRC]
+                if stat.st_size == info.file_size and (
+                        known is not None and known.get(name) == record
+                        or file_crc(out_file, chunk_size) == info.CRC):
+                    skipped.append(out_file)
+                    if known is not None:
+                        known[name] = record
+                    continue
+            with zf.open(info) as src, open(out_file + '.part', 'wb') as dst:
+                shutil.copyfileobj(src, dst, chunk_size)
+            os.replace(out_file + '.part', out_file)
+            extracted.append(out_file)
+            if known is not None:
+                stat = os.stat(out_file)
+                known[name] = [stat.st_size, stat.st_mtime, info.CRC]
+    if remove:
+        os.remove(zip_file)
+    return extracted, skipped
+
+
+def fetch_page(session, url, params, page, out_dir='.', retries=3,
+               backoff=1.0, timeout=600, chunk_size=1 << 20):
+    """
+        Download one page of an EGI request into out_dir.
+
+        Returns the path of the zip file, or None if the page comes back
+        (HTTP 200) without a zip file, which is the end of the results.
+        Connection errors and the status codes in RETRY_STATUS are
+        retried up to retries times, waiting backoff, 2*backoff,
+        4*backoff, ... seconds.  Other HTTP errors, such as 401 for bad
+        credentials, raise RuntimeError.
+    """
+    page_params = dict(params, page_num=page)
+    for attempt in range(retries + 1):
+        try:
+            with session.get(url, params=page_params, stream=True,
+                             timeout=timeout) as r:
+                if r.status_code in RETRY_STATUS:
+                    if attempt < retries:
+                        raise requests.ConnectionError('HTTP %d' % r.status_code)
+                    raise RuntimeError('page %d failed with HTTP %d'
+                                       % (page, r.status_code))
+                if r.status_code != 200:
+                    raise RuntimeError('page %d failed with HTTP %d'
+                                       % (page, r.status_code))
+                name = zip_name(r.headers)
+                if name is None:
+                    return None
+                zip_file = os.path.join(out_dir, name)
+                with open(zip_file + '.part', 'wb') as fh:
+                    for block in r.iter_content(chunk_size=chunk_size):
+                        fh.write(block)
+                os.replace(zip_file + '.part', zip_file)
+                return zip_file
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def download_pages(params, url=EGI_URL, out_dir='.', concurrency=4,
+                   retries=3, backoff=1.0, first_page=1, session=None,
+                   on_page=None, manifest=None, key_params=None,
+                   n_pages=None):
+    """
+        Download every page of an EGI request.
+
+        Up to concurrency pages are in flight at once.  on_page(page,
+        zip_file) is called in page order as pages arrive, so a page can
+        be extracted while later pages are still downloading.
+
+        Returns the list of (page, zip_file) downloaded.  Use
+        on_page=extract_pages(out_dir) to unpack the granules as they
+        come in.
+
+        With a manifest (download_manifest.Manifest), the request starts
+        at its first incomplete page instead of first_page, and each page
+        is recorded as done once on_page has returned.  Nothing is
+        fetched for a request the manifest has as complete.  The
+        manifest records the request under key_params if given (see
+        query_planner), otherwise under params.
+
+        If the request is known to have n_pages pages, it is complete
+        after page n_pages, without fetching the page after it to find
+        the end.
+    """
+    if key_params is None:
+        key_params = params
+    if manifest is not None:
+        first_page = manifest.start(key_params)
+        if first_page is None:
+            return []
+
+    if session is None:
+        session = make_session(concurrency)
+    concurrency = max(concurrency, 1)
+
+    done = []
+    futures = {}
+    next_page = first_page
+    page = first_page
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            if n_pages is not None and page > n_pages:
+                if manifest is not None:
+                    manifest.finish(key_params)
+                break
+
+            # keep the pool full
+            while len(futures) < concurrency and (n_pages is None
+                                                  or next_page <= n_pages):
+                futures[next_page] = pool.submit(
+                    fetch_page, session, url, params, next_page,
+                    out_dir=out_dir, retries=retries, backoff=backoff)
+                next_page += 1
+
+            zip_file = futures.pop(page).result()
+            if zip_file is None:
+                if manifest is not None:
+                    manifest.finish(key_params)
+                break
+            done.append((page, zip_file))
+            if on_page is not None:
+                on_page(page, zip_file)
+            if manifest is not None:
+                manifest.page_done(key_params, page)
+            page += 1
+
+        # pages past the end return nothing, but clean up just in case
+        for future in futures.values():
+            if not future.cancel() and future.exception() is None \
+                    and future.result() is not None:
+                os.remove(future.result())
+
+    return done
+
+
+def extract_pages(out_dir='.', verbose=True, manifest=None):
+    """ An on_page callback for download_pages that runs extract_h5. """
+    known = None if manifest is None else manifest.granules
+
+    def on_page(page, zip_file):
+        extracted, skipped = extract_h5(zip_file, out_dir, known=known)
+        if verbose:
+            print('page %d: %d granules extracted, %d already present'
+                  % (page, len(extracted), len(skipped)))
+    return on_page
@@ -0,0 +1,483 @@
+"""Extract photon heights from many ATL03 granules with a process pool.
+
+photon_height.py handles one granule per run, so an archive costs one
+interpreter launch, and one h5py and matplotlib import, per granule.
+Here granules are gathered from files, directories, glob patterns and
+list files, and every ground track of every granule becomes a task for
+a pool of worker processes that import everything once.
+
+Tasks are ordered by their number of photons, largest first, so the
+largest tracks don't start last and hold up the end of the batch.  A
+task that fails, by returning an error status or raising, is recorded
+and the batch goes on.  If a worker process dies (a crash in the HDF5
+library, say), the tasks that were in flight are rerun one at a time,
+so only the task that kills its process fails.  The partial output and
+plot of a failed task are removed, and tasks whose output file exists
+are skipped unless overwrite is set, so an interrupted batch can be
+rerun.
+
+A summary of the tasks done, skipped and failed, with the errors and the
+photon and byte throughput, is printed and can be written as JSON.
+
+    python photon_batch.py /data/ATL03 -o heights -j 16 -c 3 -S summary.json
+    python photon_batch.py "/data/ATL03/*/ATL03_2019*.h5" -o heights -a 20
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import collections
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import fnmatch
+import glob
+import io
+import json
+import os
+import sys
+import time
+import traceback
+
+import h5py
+
+from dem_footprint import read_footprint
+import granule_io
+from photon_bins import PERCENTILES
+import photon_cache
+from photon_height import (SURFACE_TYPES, TRACKS, init_worker, photon_heights,
+                           plot_name, worker_settings)
+from photon_output import FORMATS, output_name
+from photon_plot import PLOT_FORMATS
+import stage_metrics
+
+# Granule file name pattern used when searching directories.
+PATTERN = "ATL03_*.h5"
+
+
+def find_granules(paths, pattern=PATTERN):
+    """Return the granule files named by files, directories and globs.
+
+    Parameters
+    ----------
+    paths : sequence of str
+        Granule files, directories searched recursively for files
+        matching pattern, or glob patterns.
+    pattern : str, optional
+        File name pattern for directory searches.
+
+    Returns
+    -------
+    granules : list of str
+        Sorted granule file names without duplicates.
+
+    """
+    found = set()
+    for path in paths:
+        if glob.has_magic(path):
+            found.update(name for name in glob.glob(path, recursive=True)
+                         if os.path.isfile(name))
+        elif os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                found.update(os.path.join(dirpath, name)
+                             for name in fnmatch.filter(filenames, pattern))
+        else:
+            found.add(path)
+    return sorted(found)
+
+
+def read_list(listfile):
+    """Return the non-empty, non-comment lines of a list file ("-" is stdin)."""
+    f_in = sys.stdin if listfile == "-" else open(listfile)
+    try:
+        return [line.strip() for line in f_in
+                if line.strip() and not line.startswith("#")]
+    finally:
+        if f_in is not sys.stdin:
+            f_in.close()
+
+
+def plan_tasks(granules, tracks=None):
+    """Return one task per ground track, largest first.
+
+    Only dataset shapes are read, so planning costs one file open per
+    granule.
+
+    Parameters
+    ----------
+    granules : sequence of str
+        ATL03 granule files.
+    tracks : sequence of str, optional
+        Ground tracks to process.  Default is every track in TRACKS.
+
+    Returns
+    -------
+    tasks : list of dict
+        infile, track, n_photons and size (bytes of the granule shared
+        by its tracks in proportion to their photons) of each task.
+    failed : list of dict
+        Results of granules that can't be opened or have no tracks.
+
+    """
+    tracks = TRACKS if tracks is None else tracks
+    tasks = []
+    failed = []
+    for infile in granules:
+        try:
+            size = os.path.getsize(infile)
+            with h5py.File(infile, "r") as f_in:
+                counts = {track: f_in[track + "/heights/h_ph"].shape[0]
+                          for track in tracks
+                          if track + "/heights/h_ph" in f_in}
+        except (IOError, OSError, RuntimeError) as err:
+            failed.append(result(infile, None, "failed", error=str(err)))
+            continue
+        if not counts:
+            failed.append(result(infile, None, "failed",
+                                 error="no ground tracks found"))
+            continue
+        total = max(sum(counts.values()), 1)
+        for track, n_photons in counts.items():
+            tasks.append({"infile": infile, "track": track,
+                          "n_photons": n_photons,
+                          "size": size * n_photons // total})
+    tasks.sort(key=lambda task: task["n_photons"], reverse=True)
+    return tasks, failed
+
+
+def result(infile, track, status, error=None, seconds=0.0, n_photons=0,
+           size=0):
+    """Return the result record of a task."""
+    return {"infile": infile, "track": track, "status": status,
+            "error": error, "seconds": seconds, "n_photons": n_photons,
+            "size": size}
+
+
+def task_outroot(task, outdir):
+    """Return the output root name of a task."""
+    stem = os.path.splitext(os.path.basename(task["infile"]))[0]
+    return os.path.join(outdir, stem + "_" + task["track"])
+
+
+def task_outputs(task, outdir, options):
+    """Return the output and plot file names of a task."""
+    outroot = task_outroot(task, outdir)
+    names = [output_name(outroot, options.get("out_format", "txt"))]
+    if options.get("plot"):
+        names.append(plot_name(outroot, task["infile"], task["track"],
+                               options.get("density")))
+    return names
+
+
+def remove_outputs(task, outdir, options, keep=()):
+    """Remove the partial outputs of a failed task, except those in keep."""
+    for name in task_outputs(task, outdir, options):
+        if name not in keep and os.path.exists(name):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+
+def run_task(task, outdir, options):
+    """Run photon_heights for one task in a worker process.
+
+    Errors are caught and returned in the result, with the messages
+    photon_heights writes to stderr, so one bad granule or track can't
+    stop the batch.  The outputs of a failed task are removed, unless
+    they existed before and overwrite is off.
+
+    """
+    start = time.time()
+    existing = [] if options.get("overwrite") else \
+        [name for name in task_outputs(task, outdir, options)
+         if os.path.exists(name)]
+    stderr = io.StringIO()
+    saved, sys.stderr = sys.stderr, stderr
+    try:
+        status = photon_heights(task["infile"], task["track"],
+                                task_outroot(task, outdir), **options)
+        error = None
+    except Exception:
+        status = 1
+        error = traceback.format_exc().strip().splitlines()[-1]
+    finally:
+        sys.stderr = saved
+    if status and error is None:
+        lines = stderr.getvalue().strip().splitlines()
+        error = lines[-1].partition(": error: ")[2] or lines[-1] if lines \
+            else "exit status " + str(status)
+    if status:
+        remove_outputs(task, outdir, options, keep=existing)
+    return result(task["infile"], task["track"],
+                  "failed" if status else "done", error=error,
+                  seconds=time.time() - start, n_photons=task["n_photons"],
+                  size=task["size"])
+
+
+def run_batch(tasks, outdir, options, jobs=None, verbose=False):
+    """Run tasks over a process pool.
+
+    At most two tasks per worker are submitted at a time, so if a worker
+    process dies only the tasks in flight are suspect.  Each suspect is
+    then run again alone in a new process, and fails only if that
+    process dies too; the other tasks go on in a new pool.
+
+    Parameters
+    ----------
+    tasks : list of dict
+        Tasks from plan_tasks, in the order to submit them.
+    outdir : str
+        Output directory.
+    options : dict
+        Keyword arguments of photon_heights after the output root.
+    jobs : int, optional
+        Worker processes.  Default is one per CPU.
+    verbose : bool, optional
+        Print each result as it comes.
+
+    Returns
+    -------
+    results : list of dict
+        One result per task, in completion order.
+
+    """
+    jobs = jobs or os.cpu_count() or 1
+    settings = worker_settings()
+    results = []
+    queue = collections.deque(tasks)
+
+    def finish(res):
+        results.append(res)
+        if verbose or res["status"] != "done":
+            report(res, len(results), len(tasks))
+
+    while queue:
+        suspects = []
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=(settings,)) as pool:
+            running = {}
+            while queue or running:
+                while queue and len(running) < 2 * jobs:
+                    task = queue.popleft()
+                    running[pool.submit(run_task, task, outdir,
+                                        options)] = task
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                try:
+                    for future in done:
+                        res = future.result()
+                        del running[future]
+                        finish(res)
+                except BrokenProcessPool:
+                    suspects = list(running.values())
+                    break
+
+        if suspects:
+            print("{0}: warning: worker process died, rerunning {1} tasks "
+                  "one at a time".format(__file__, len(suspects)),
+                  file=sys.stderr)
+        for task in suspects:
+            # Outputs of suspects are partial; they didn't exist before,
+            # or the task would have been skipped.
+            remove_outputs(task, outdir, options)
+            with ProcessPoolExecutor(max_workers=1, initializer=init_worker,
+                                     initargs=(settings,)) as pool:
+                try:
+                    finish(pool.submit(run_task, task, outdir,
+                                       options).result())
+                except BrokenProcessPool:
+                    remove_outputs(task, outdir, options)
+                    finish(result(task["infile"], task["track"], "failed",
+                                  error="worker process died",
+                                  n_photons=task["n_photons"],
+                                  size=task["size"]))
+    return results
+
+
+def report(res, done, total):
+    """Print one task result."""
+    name = os.path.basename(res["infile"])
+    if res["status"] == "failed":
+        print("[{0}/{1}] {2} {3}: failed: {4}".format(
+            done, total, name, res["track"], res["error"]), file=sys.stderr)
+    else:
+        print("[{0}/{1}] {2} {3}: {4} photons in {5:.2f} s".format(
+            done, total, name, res["track"], res["n_photons"],
+            res["seconds"]))
+
+
+def summarize(results, elapsed):
+    """Return counts, throughput and failures of a batch.
+
+    Throughput counts the photons and granule bytes of the tasks done,
+    over the wall time of the batch.
+
+    """
+    done = [r for r in results if r["status"] == "done"]
+    n_photons = sum(r["n_photons"] for r in done)
+    size = sum(r["size"] for r in done)
+    return {
+        "tasks": len(results),
+        "done": len(done),
+        "skipped": sum(r["status"] == "skipped" for r in results),
+        "failed": sum(r["status"] == "failed" for r in results),
+        "granules": len(set(r["infile"] for r in results)),
+        "photons": n_photons,
+        "bytes": size,
+        "seconds": elapsed,
+        "task_seconds": sum(r["seconds"] for r in done),
+        "photons_per_second": n_photons / elapsed if elapsed > 0 else 0.0,
+        "mb_per_second": size / 1e6 / elapsed if elapsed > 0 else 0.0,
+        "failures": [r for r in results if r["status"] == "failed"],
+    }
+
+
+def print_summary(summary):
+    """Print a batch summary."""
+    print()
+    print("              tasks:", summary["tasks"], "in",
+          summary["granules"], "granules")
+    print("               done:", summary["done"])
+    print("            skipped:", summary["skipped"])
+    print("             failed:", summary["failed"])
+    print("          wall time: {0:.1f} s ({1:.1f} s in tasks)".format(
+        summary["seconds"], summary["task_seconds"]))
+    print("         throughput: {0:.3g} photons/s, {1:.1f} MB/s".format(
+        summary["photons_per_second"], summary["mb_per_second"]))
+    for res in summary["failures"]:
+        print("  failed:", res["infile"], res["track"] or "", "-",
+              res["error"])
+
+
+def cl_args(description):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", type=str, nargs="*",
+                        help="ATL03 files, directories searched for "
+                             + PATTERN + ", or glob patterns")
+    parser.add_argument("-l", type=str, default=None,
+                        help="file listing granules, directories or "
+                             "patterns, one per line (- for stdin)")
+    parser.add_argument("-o", type=str, default=".",
+                        help="output directory, default is the current "
+                             "directory")
+    parser.add_argument("-T", type=str, nargs="+", default=None,
+                        choices=TRACKS,
+                        help="ground tracks to process, default is all")
+    parser.add_argument("-c", type=int, default=2,
+                        help="minimum signal confidence (0-4), default is 2")
+    parser.add_argument("-s", type=str, default="any",
+                        choices=("any",) + SURFACE_TYPES,
+                        help="surface type for the signal confidence test, "
+                             "default is any")
+    parser.add_argument("-t", type=str, default="txt", choices=FORMATS,
+                        help="output file format, default is txt")
+    parser.add_argument("-w", type=int, default=None,
+                        help="process tracks in windows of this many "
+                             "geolocation segments")
+    parser.add_argument("-b", type=float, nargs=4, default=None,
+                        metavar=("W", "E", "S", "N"),
+                        help="only read segments inside this bounding box "
+                             "(deg)")
+    parser.add_argument("-g", type=str, default=None,
+                        help="only read segments inside this polygon file or "
+                             "DEM footprint")
+    parser.add_argument("-a", type=float, default=None,
+                        help="write along-track bin statistics for bins of "
+                             "this width (m) instead of photons")
+    parser.add_argument("-q", type=float, nargs="+", default=PERCENTILES,
+                        help="with -a, height percentiles besides the median")
+    parser.add_argument("-d", type=str, default=None, choices=PLOT_FORMATS,
+                        help="also save a photon density plot of each track "
+                             "in this format")
+    parser.add_argument("-j", type=int, default=None,
+                        help="worker processes, default is one per CPU")
+    parser.add_argument("-S", type=str, default=None,
+                        help="write the batch summary to this JSON file")
+    parser.add_argument("-M", type=str, default=None,
+                        help="append per-stage metrics to this file as JSON "
+                             "lines")
+    parser.add_argument("-k", type=str, default=None,
+                        help="cache the decoded photon arrays in this "
+                             "directory (see photon_cache.py)")
+    parser.add_argument("-K", type=float, default=None,
+                        help="with -k, cache size limit (GB), default is %g"
+                             % (photon_cache.MAX_BYTES / 2**30))
+    parser.add_argument("-H", type=float, default=None,
+                        help="HDF5 chunk cache size (MB) per dataset, "
+                             "default is %g (see granule_io.py)"
+                             % (granule_io.CHUNK_CACHE / 2**20))
+    parser.add_argument("-f", action="store_true",
+                        help="overwrite existing output files instead of "
+                             "skipping their tasks")
+    parser.add_argument("-v", action="store_true",
+                        help="report every task, not only failures")
+    return parser.parse_args()
+
+
+def main():
+    """Extract photon heights from many ATL03 granules."""
+    args = cl_args(__doc__)
+    start = time.time()
+
+    paths = list(args.paths)
+    if args.l is not None:
+        paths += read_list(args.l)
+    granules = find_granules(paths)
+    if not granules:
+        print("{0}: error: no granules found".format(__file__),
+              file=sys.stderr)
+        return 1
+    if not os.path.isdir(args.o):
+        os.makedirs(args.o)
+    if args.M is not None:
+        stage_metrics.enable(args.M)
+    if args.k is not None:
+        photon_cache.enable(args.k, max_bytes=None if args.K is None
+                            else int(args.K * 2**30))
+    if args.H is not None:
+        granule_io.configure(chunk_cache=int(args.H * 2**20))
+
+    try:
+        polygon = read_footprint(args.g) if args.g is not None else None
+    except (IOError, OSError, RuntimeError, ValueError) as err:
+        print("{0}: error: {1}".format(__file__, err), file=sys.stderr)
+        return 1
+    options = dict(confidence=args.c, surface=args.s, out_format=args.t,
+                   window=args.w, bbox=args.b, polygon=polygon,
+                   bin_width=args.a, percentiles=args.q, overwrite=args.f,
+                   plot=args.d is not None, density=args.d)
+
+    tasks, results = plan_tasks(granules, tracks=args.T)
+    n_tasks = len(tasks) + len(results)
+    todo = []
+    for task in tasks:
+        outfile = task_outputs(task, args.o, options)[0]
+        if not args.f and os.path.exists(outfile):
+            results.append(result(task["infile"], task["track"], "skipped",
+                                  n_photons=task["n_photons"],
+                                  size=task["size"]))
+        else:
+            todo.append(task)
+    print("{0} granules, {1} tasks, {2} to run, largest {3} photons".format(
+        len(granules), n_tasks, len(todo),
+        todo[0]["n_photons"] if todo else 0))
+
+    results += run_batch(todo, args.o, options, jobs=args.j,
+                         verbose=args.v)
+
+    summary = summarize(results, time.time() - start)
+    print_summary(summary)
+    if args.S is not None:
+        with open(args.S, "w") as f_out:
+            json.dump(dict(summary, results=results), f_out, indent=1)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""Along-track bin statistics of photon heights.
+
+Photons are binned by total along-track distance into fixed-width bins,
+and the count, mean, median and percentiles of the heights in each bin
+are computed with one sort and reduceat over the whole chunk, not a
+loop over bins.  PhotonBinner takes the photons a chunk at a time, as
+the streaming mode of photon_height.py produces them, and carries the
+photons of the last bin of each chunk over to the next one, so bins
+that straddle a chunk boundary come out the same as from a single
+read.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+
+# Default percentiles written besides the median.
+PERCENTILES = (10, 90)
+
+
+def bin_columns(percentiles=PERCENTILES):
+    """Return the output column names for a list of percentiles."""
+    return (("distance", "count", "mean", "median") +
+            tuple("p%g" % p for p in percentiles))
+
+
+def bin_attrs(attrs, percentiles=PERCENTILES):
+    """Return output column attributes from photon column attributes.
+
+    Parameters
+    ----------
+    attrs : dict
+        long_name and units of the photon distance and height columns.
+    percentiles : sequence of float, optional
+        Percentiles written besides the median.
+
+    Returns
+    -------
+    attrs : dict
+        Attributes for each column of bin_columns(percentiles).
+
+    """
+    distance = dict(attrs.get("distance", {}))
+    height = dict(attrs.get("height", {}))
+    out = {"distance": dict(distance, long_name="bin center " +
+                            distance.get("long_name", "distance")),
+           "count": {"long_name": "number of photons in bin"}}
+    names = [("mean", "mean"), ("median", "median")]
+    names += [("p%g" % p, "%g percentile" % p) for p in percentiles]
+    for name, stat in names:
+        out[name] = dict(height, long_name=stat + " of " +
+                         height.get("long_name", "height"))
+    return out
+
+
+def bin_stats(bins, height, bin_width, percentiles=PERCENTILES):
+    """Return statistics of heights grouped by bin index.
+
+    Parameters
+    ----------
+    bins : NumPy array of int
+        Bin index of each photon.
+    height : NumPy array
+        Photon heights.
+    bin_width : float
+        Bin width, for the bin center distances.
+    percentiles : sequence of float, optional
+        Percentiles computed besides the median.
+
+    Returns
+    -------
+    columns : list of NumPy array
+        One array per column of bin_columns(percentiles), one row per
+        non-empty bin in increasing bin order.  Percentiles interpolate
+        linearly, like numpy.percentile.
+
+    """
+    order = np.lexsort((height, bins))
+    bins = bins[order]
+    height = np.asarray(height, dtype=np.float64)[order]
+    n = len(bins)
+    if n == 0:
+        return [np.zeros(0), np.zeros(0, dtype=np.int64)] + \
+            [np.zeros(0) for _ in range(2 + len(percentiles))]
+
+    starts = np.flatnonzero(np.concatenate(([True], bins[1:] != bins[:-1])))
+    counts = np.diff(np.append(starts, n))
+    mean = np.add.reduceat(height, starts) / counts
+
+    def percentile(p):
+        pos = starts + (counts - 1) * (p / 100.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, starts + counts - 1)
+        return height[lo] + (height[hi] - height[lo]) * (pos - lo)
+
+    return ([(bins[starts] + 0.5) * bin_width, counts, mean, percentile(50)] +
+            [percentile(p) for p in percentiles])
+
+
+class PhotonBinner(object):
+    """Bin statistics of photons that arrive in along-track chunks.
+
+    Photons must come in along-track order from chunk to chunk (within
+    a chunk any order will do), as photon_height.photon_windows yields
+    them.
+
+    Parameters
+    ----------
+    bin_width : float
+        Bin width along track, in the units of the distances.
+    percentiles : sequence of float, optional
+        Percentiles written besides the median.
+
+    Attributes
+    ----------
+    columns : tuple of str
+        Names of the arrays returned by add and flush.
+    n_photons, n_bins : int
+        Photons added and bins returned so far.
+
+    """
+
+    def __init__(self, bin_width, percentiles=PERCENTILES):
+        if not bin_width > 0:
+            raise ValueError("bin width must be positive")
+        self.bin_width = float(bin_width)
+        self.percentiles = tuple(percentiles)
+        self.columns = bin_columns(self.percentiles)
+        self.n_photons = 0
+        self.n_bins = 0
+        self._last = None  # Last bin returned
+        self._bins = np.zeros(0, dtype=np.int64)
+        self._height = np.zeros(0)
+
+    def add(self, distance, height):
+        """Add a chunk of photons and return the bins it completes.
+
+        Returns
+        -------
+        columns : list of NumPy array
+            Statistics of the bins before the last bin seen so far, one
+            array per column.
+
+        Raises
+        ------
+        ValueError
+            Photons fall in a bin that has already been returned.
+
+        """
+        bins = np.floor(np.asarray(distance) / self.bin_width).astype(np.int64)
+        if len(bins) and self._last is not None and bins.min() <= self._last:
+            raise ValueError("photons are not in along-track order")
+        self.n_photons += len(bins)
+
+        bins = np.concatenate((self._bins, bins))
+        height = np.concatenate((self._height, height))
+        if len(bins) == 0:
+            return self._stats(bins, height)
+
+        # Hold back the last bin, the next chunk may add to it
+        last = bins.max()
+        done = bins < last
+        self._bins = bins[~done]
+        self._height = height[~done]
+        return self._stats(bins[done], height[done])
+
+    def flush(self):
+        """Return the statistics of the bins still held back."""
+        columns = self._stats(self._bins, self._height)
+        self._bins = self._bins[:0]
+        self._height = self._height[:0]
+        return columns
+
+    def _stats(self, bins, height):
+        columns = bin_stats(bins, height, self.bin_width, self.percentiles)
+        if len(bins):
+            self._last = bins.max()
+        self.n_bins += len(columns[0])
+        return columns
+
+
+def bin_photons(distance, height, bin_width, percentiles=PERCENTILES):
+    """Return bin statistics of all photons of a ground track at once."""
+    binner = PhotonBinner(bin_width, percentiles)
+    first = binner.add(distance, height)
+    return [np.concatenate(pair) for pair in zip(first, binner.flush())]
@@ -0,0 +1,337 @@
+"""On-disk cache of decoded ATL03 photon arrays.
+
+Reading h_ph, dist_ph_along and signal_conf_ph means decompressing them
+from the granule on every run.  When the cache is enabled, the first
+read of a dataset copies it, decoded, into a .npy file in the cache
+directory, and later reads map that file into memory with
+np.load(mmap_mode="r") instead.  Arrays computed from a granule, such
+as the total along-track distance, are cached the same way.  Readers
+that need only part of a dataset, such as photon_height's windowed
+mode, pass fill=False: they use an entry that exists but read from the
+granule on a miss rather than copying the whole dataset.
+
+Entries are keyed by the granule's real path, modification time and
+size and by the dataset name, so a granule that is replaced gets new
+entries.  The old ones are never read again and age out: when the
+cache grows beyond its size limit, the least recently used entries are
+removed.  Each hit touches its file, so the file modification times
+give the use order.
+
+Cached arrays are read-only.  Entries are written to a temporary file
+and renamed into place, so several processes can share a cache.  An
+array larger than the whole size limit is not cached.  Worker
+processes use the cache only if enable is called in them too: pools
+pass settings to their workers.
+
+    python photon_cache.py -d cache info
+    python photon_cache.py -d cache clear
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+# Default size limit in bytes.
+MAX_BYTES = 20 * 2**30
+
+# Rows copied from a dataset into a new entry at a time, which bounds
+# the memory used to fill the cache.
+BLOCK = 2**20
+
+_directory = None
+_max_bytes = MAX_BYTES
+
+
+def enable(directory, max_bytes=None):
+    """Cache the arrays of this process in directory.
+
+    Parameters
+    ----------
+    directory : str
+        Cache directory, created if needed.
+    max_bytes : int, optional
+        Size limit of the cache.  Default is MAX_BYTES.
+
+    """
+    global _directory, _max_bytes
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _directory = directory
+    _max_bytes = int(max_bytes if max_bytes is not None else MAX_BYTES)
+
+
+def disable():
+    """Stop caching arrays."""
+    global _directory
+    _directory = None
+
+
+def enabled():
+    """Return True if arrays are being cached."""
+    return _directory is not None
+
+
+def settings():
+    """Return (directory, max_bytes); directory is None if disabled."""
+    return _directory, _max_bytes
+
+
+def entry_path(filename, name, directory=None):
+    """Return the cache file of dataset name in granule filename.
+
+    Raises
+    ------
+    OSError
+        The granule does not exist.
+
+    """
+    info = os.stat(filename)
+    key = json.dumps([os.path.realpath(filename), info.st_mtime_ns,
+                      info.st_size, name])
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(directory or _directory, stem + "." + digest + ".npy")
+
+
+def dataset(f_in, name, fill=True):
+    """Return a dataset of an open granule, from the cache if enabled.
+
+    Parameters
+    ----------
+    f_in : file
+        Open HDF5 file handle.
+    name : str
+        Dataset path.
+    fill : bool, optional
+        Copy the dataset into the cache on a miss.  With False a miss
+        returns the dataset itself, for callers that read only parts of
+        it.  Default is True.
+
+    Returns
+    -------
+    data : NumPy array or h5py Dataset
+        A read-only memory-mapped array of the decoded dataset, or the
+        dataset itself if caching is disabled, the entry is missing and
+        fill is False, the dataset is larger than the size limit or the
+        entry can't be written.  Both can be sliced, or read in full
+        with [...].
+
+    """
+    source = f_in[name]
+    if _directory is None or source.size * source.dtype.itemsize > _max_bytes:
+        return source
+    path = entry_path(f_in.filename, name)
+    data = load(path)
+    if data is None and not fill:
+        return source
+    if data is None:
+        try:
+            store_dataset(path, source)
+        except (IOError, OSError) as err:
+            print("{0}: warning: can't cache {1}: {2}".format(
+                __file__, name, err), file=sys.stderr)
+            return source
+        data = load(path)
+    return data if data is not None else source
+
+
+def derived(f_in, name, compute):
+    """Return an array computed from a granule, from the cache if enabled.
+
+    Parameters
+    ----------
+    f_in : file
+        Open HDF5 file handle.
+    name : str
+        Name of the computed array, unique within the granule, such as
+        "/gt1l/heights/along_track_distance".
+    compute : callable
+        Called with no arguments on a cache miss.  A None result, or
+        one larger than the size limit, is returned and not cached.
+
+    Returns
+    -------
+    data : NumPy array or None
+
+    """
+    if _directory is None:
+        return compute()
+    path = entry_path(f_in.filename, name)
+    data = load(path)
+    if data is None:
+        data = compute()
+        if data is not None and np.asarray(data).nbytes <= _max_bytes:
+            try:
+                store(path, data)
+            except (IOError, OSError) as err:
+                print("{0}: warning: can't cache {1}: {2}".format(
+                    __file__, name, err), file=sys.stderr)
+    return data
+
+
+def load(path):
+    """Map a cache entry into memory and mark it used, or return None."""
+    try:
+        data = np.load(path, mmap_mode="r", allow_pickle=False)
+        os.utime(path, None)
+    except (IOError, OSError, ValueError):
+        return None
+    return data
+
+
+def store_dataset(path, source):
+    """Copy an HDF5 dataset into a new cache entry, BLOCK rows at a time."""
+    tmpfile = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        out = np.lib.format.open_memmap(tmpfile, mode="w+",
+                                        dtype=source.dtype,
+                                        shape=source.shape)
+        if source.ndim == 0 or source.size == 0:
+            out[...] = source[...]
+        else:
+            for start in range(0, source.shape[0], BLOCK):
+                out[start:start + BLOCK] = source[start:start + BLOCK]
+        out.flush()
+        del out
+        os.replace(tmpfile, path)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    evict()
+
+
+def store(path, data):
+    """Write an array to a new cache entry."""
+    tmpfile = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmpfile, "wb") as f_out:
+            np.save(f_out, np.asarray(data), allow_pickle=False)
+        os.replace(tmpfile, path)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    evict()
+
+
+def entries(directory=None):
+    """Return (mtime, bytes, path) of each cache entry, oldest first."""
+    items = []
+    for path in glob.glob(os.path.join(directory or _directory, "*.npy")):
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue  # Removed by another process.
+        items.append((info.st_mtime, info.st_size, path))
+    return sorted(items)
+
+
+def evict(max_bytes=None, directory=None):
+    """Remove the least recently used entries beyond a size limit.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Size limit.  Default is the limit given to enable.
+    directory : str, optional
+        Cache directory.  Default is the enabled one.
+
+    Returns
+    -------
+    n_removed, n_bytes : int
+        Number and total size of the entries removed.
+
+    """
+    max_bytes = _max_bytes if max_bytes is None else max_bytes
+    items = entries(directory)
+    excess = sum(size for _, size, _ in items) - max_bytes
+    n_removed = n_bytes = 0
+    for _, size, path in items:
+        if excess <= 0:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # Removed by another process.
+        excess -= size
+        n_removed += 1
+        n_bytes += size
+    return n_removed, n_bytes
+
+
+def clear(directory=None):
+    """Remove every cache entry and return (n_removed, n_bytes).
+
+    Temporary files left by interrupted writes are removed too.
+
+    """
+    n_removed, n_bytes = evict(0, directory)
+    for path in glob.glob(os.path.join(directory or _directory,
+                                       "*.npy.*.tmp")):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            continue  # Renamed or removed by its writer.
+        n_removed += 1
+        n_bytes += size
+    return n_removed, n_bytes
+
+
+def cl_args(description):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", type=str, choices=("info", "evict",
+                                                      "clear"),
+                        help="info: show the cache size, evict: remove "
+                             "least recently used entries beyond the size "
+                             "limit, clear: remove every entry")
+    parser.add_argument("-d", type=str, default=None,
+                        help="cache directory")
+    parser.add_argument("-s", type=float, default=None,
+                        help="size limit (GB) for evict, default is %g"
+                             % (MAX_BYTES / 2**30))
+    return parser.parse_args()
+
+
+def main():
+    """Show, trim or clear the photon array cache."""
+    args = cl_args(__doc__)
+    if args.d is None:
+        print("{0}: error: no cache directory given".format(__file__),
+              file=sys.stderr)
+        return 1
+    if not os.path.isdir(args.d):
+        print("{0}: error: {1} is not a directory".format(__file__, args.d),
+              file=sys.stderr)
+        return 1
+
+    if args.command == "info":
+        items = entries(args.d)
+        n_bytes = sum(size for _, size, _ in items)
+        print("%d entries, %.1f MB in %s" % (len(items), n_bytes / 1e6,
+                                            args.d))
+    else:
+        if args.command == "clear":
+            n_removed, n_bytes = clear(args.d)
+        else:
+            max_bytes = MAX_BYTES if args.s is None else int(args.s * 2**30)
+            n_removed, n_bytes = evict(max_bytes, args.d)
+        print("removed %d entries, %.1f MB" % (n_removed, n_bytes / 1e6))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
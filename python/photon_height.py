@@ -18,18 +18,41 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
-import posixpath
+from concurrent.futures import ProcessPoolExecutor
 import os
+import posixpath
 import sys
+import time
 
-import h5py
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
 import numpy as np
 
+from granule_catalog import open_catalog, query_beams, update_catalog
+import granule_io
+from granule_io import ReadBuffers, open_granule
+from photon_bins import PERCENTILES, PhotonBinner, bin_attrs, bin_photons
+import photon_cache
+from photon_index import PhotonIndex
+from photon_plot import PLOT_FORMATS, DensityRaster, save_density
+from photon_output import (BEAM_COLUMNS, COLUMNS, FORMATS, open_writer,
+                           output_name)
+from dem_footprint import read_footprint
+from region import region_mask, runs
+import stage_metrics
+
+# Column order of the /gtx/heights/signal_conf_ph surface types.
+SURFACE_TYPES = ("land", "ocean", "sea_ice", "land_ice", "inland_water")
+
+# Ground tracks processed by the "all" track option.  The beam column of
+# merged output holds the 1-based position of the track in this list.
+TRACKS = ("gt1l", "gt1r", "gt2l", "gt2r", "gt3l", "gt3r")
+
 
 def photon_heights(infile, track, outroot, confidence, plot=False,
-                   overwrite=False, verbose=False):
+                   overwrite=False, verbose=False, surface=None, window=None,
+                   bbox=None, polygon=None, out_format="txt", bin_width=None,
+                   percentiles=PERCENTILES, density=None):
     """Return distance and reference photon height along a ground track.
 
     Parameters
@@ -49,6 +72,29 @@ def photon_heights(infile, track, outroot, confidence, plot=False,
         Allow function to overwrite existing files if True.
     verbose : bool, optional
         Turn on additional output.
+    surface : str or list of str, optional
+        Surface types used for the signal confidence test, from
+        SURFACE_TYPES.  Default is all surface types.
+    window : int, optional
+        Process the ground track in windows of this many geolocation
+        segments instead of reading the whole track at once.
+    bbox : sequence of float, optional
+        Only read photons in geolocation segments whose reference
+        photon is inside (west, east, south, north) in degrees.
+    polygon : NumPy array, optional
+        Only read photons in geolocation segments whose reference
+        photon is inside this (N, 2) longitude latitude polygon.
+    out_format : str, optional
+        Output file format, one of photon_output.FORMATS.  Default is
+        txt.
+    bin_width : float, optional
+        Write the statistics of along-track bins this long (m) instead
+        of the photons.
+    percentiles : sequence of float, optional
+        Height percentiles written for each bin besides the median.
+    density : str, optional
+        Plot photon density and save it in this format, one of
+        photon_plot.PLOT_FORMATS, without opening a window.
 
     Returns
     -------
@@ -58,10 +104,13 @@ def photon_heights(infile, track, outroot, confidence, plot=False,
     """
     if confidence is None:
         confidence = 4  # High confidence.
+    stage_metrics.set_context(granule=os.path.basename(infile),
+                              beam=track.strip("/"))
 
     # Open the input ATL03 file.
     try:
-        f_in = h5py.File(infile, "r")
+        with stage_metrics.stage("open"):
+            f_in = open_granule(infile)
     except (IOError, RuntimeError) as err:
         print("{0}: error: {1}".format(__file__, err), file=sys.stderr)
         return 1
@@ -74,45 +123,80 @@ def photon_heights(infile, track, outroot, confidence, plot=False,
         print("{0}: error: {1}".format(__file__, message), file=sys.stderr)
         return 1
 
-    # Read along-track distance.
+    streamed = window is not None or bbox is not None \
+        or polygon is not None or bin_width is not None
+
+    # Name the plot file once, for both paths.  Only a full track plot
+    # without an output root or density format opens a window instead.
+    pdffile = None
+    if plot and (density is not None or outroot is not None or streamed):
+        pdffile = plot_name(outroot, infile, track, density)
+
+    if streamed:
+        try:
+            status = stream_photon_heights(f_in, track, outroot, confidence,
+                                           window, plot=plot,
+                                           overwrite=overwrite,
+                                           verbose=verbose, surface=surface,
+                                           bbox=bbox, polygon=polygon,
+                                           out_format=out_format,
+                                           bin_width=bin_width,
+                                           percentiles=percentiles,
+                                           plotfile=pdffile)
+        finally:
+            f_in.close()
+        return status
+
+    # Read along-track distance and photon height.
     x_name = '/'.join([track, "heights/dist_ph_along"])
-    if x_name not in f_in:
-        message = x_name + " not found in " + infile
-        print("{0}: error: {1}".format(__file__, message), file=sys.stderr)
-        return 1
-    dist_ph_along = f_in[x_name][...]
-    print("TEST: len(dist_ph_along) =", len(dist_ph_along))
+    y_name = '/'.join([track, "heights/h_ph"])
+    for name in (x_name, y_name):
+        if name not in f_in:
+            message = name + " not found in " + infile
+            print("{0}: error: {1}".format(__file__, message), file=sys.stderr)
+            return 1
+    with stage_metrics.stage("read") as timer:
+        # Ellipses extract data into a NumPy array.  From the cache they
+        # are memory-mapped, so dist_ph_along isn't read if the distance
+        # is cached too.
+        dist_ph_along = photon_cache.dataset(f_in, x_name)[...]
+        height = photon_cache.dataset(f_in, y_name)[...]
+        timer.add(dist_ph_along, height)
 
     # Determine distance from equator for each photon.
-    distance = total_along_track_distance(f_in, track, dist_ph_along)
+    with stage_metrics.stage("distance") as timer:
+        distance = photon_cache.derived(
+            f_in, '/'.join([track, "heights/along_track_distance"]),
+            lambda: total_along_track_distance(f_in, track, dist_ph_along))
+        timer.add(distance)
     if distance is None:
         return 1
 
-    # Read photon height.
-    y_name = '/'.join([track, "heights/h_ph"])
-    if y_name not in f_in:
-        message = y_name + " not found in " + infile
-        print("{0}: error: {1}".format(__file__, message), file=sys.stderr)
-        return 1
-    height = f_in[y_name][...]  # Ellipses extract data into a NumPy array.
-
     if verbose:
         print("read", len(distance), "photons from", track, "in", infile)
 
     # Apply the signal confidence mask.
-    take = make_signal_conf_mask(f_in, track, confidence)
-    print("TEST: start masking data...")
-    distance = distance[take]
-    height = height[take]
-    print("TEST: done masking data")
+    with stage_metrics.stage("mask") as timer:
+        take = make_signal_conf_mask(f_in, track, confidence, surface=surface)
+        if take is not None:
+            distance = distance[take]
+            height = height[take]
+            timer.add(distance, height)
+    if take is None:
+        return 1
     if verbose:
         print(len(distance), "photons with confidence >=", confidence)
         print(len(height), "photons with confidence >=", confidence)
     if outroot is not None:
-        outfile = outroot + ".txt"
+        outfile = output_name(outroot, out_format)
+        attrs = {"distance": dataset_attrs(f_in[x_name]),
+                 "height": dataset_attrs(f_in[y_name])}
         try:
-            write_data(outfile, distance, height, overwrite=overwrite,
-                       verbose=verbose)
+            with stage_metrics.stage("write") as timer:
+                write_data(outfile, distance, height, overwrite=overwrite,
+                           verbose=verbose, out_format=out_format,
+                           attrs=attrs)
+                timer.add(distance, height)
         except (IOError, RuntimeError) as err:
             print("{0}: error: {1}".format(__file__, err), file=sys.stderr)
             return 1
@@ -124,21 +208,607 @@ def photon_heights(infile, track, outroot, confidence, plot=False,
         """
 
         title = f_in.filename.rpartition("/")[2]
-        x_label = (f_in[x_name].attrs.get("long_name") + " (" +
-                   f_in[x_name].attrs.get("units") + ")")
-        y_label = (f_in[y_name].attrs.get("long_name") + " (" +
-                   f_in[y_name].attrs.get("units") + ")")
-
-        pdffile = outroot + ".pdf"
-        plot_data(distance, height, mask=None,
-                  title=title, x_label=x_label, y_label=y_label,
-                  pdffile=pdffile, verbose=verbose)
+        x_label = axis_label(dataset_attrs(f_in[x_name]))
+        y_label = axis_label(dataset_attrs(f_in[y_name]))
+        with stage_metrics.stage("plot") as timer:
+            plot_data(distance, height, mask=None,
+                      title=title, x_label=x_label, y_label=y_label,
+                      pdffile=pdffile, verbose=verbose,
+                      density=density is not None)
+            timer.add(distance)
 
     f_in.close()
 
     return 0
 
 
+def all_photon_heights(infile, outroot, confidence, plot=False,
+                       overwrite=False, verbose=False, surface=None,
+                       window=None, bbox=None, polygon=None,
+                       out_format="txt", merge=False, jobs=None,
+                       tracks=None, bin_width=None, percentiles=PERCENTILES,
+                       density=None):
+    """Extract photon heights for every ground track in a granule.
+
+    The ground tracks are spread over a pool of worker processes so the
+    HDF5 decompression of different beams overlaps.  Processes are used
+    rather than threads because h5py serializes HDF5 calls within one
+    process.
+
+    Parameters
+    ----------
+    infile : str
+        Name of ATL03 file to read.
+    outroot : str
+        Root name of output files.  Each ground track is written to
+        outroot_gtxx unless merge is True.
+    confidence : int
+        Minimum signal confidence for plotting photons.
+    plot : bool, optional
+        Turn on plotting.
+    overwrite : bool, optional
+        Allow function to overwrite existing files if True.
+    verbose : bool, optional
+        Turn on additional output.
+    surface, window, bbox, polygon, out_format : optional
+        Passed on to photon_heights.
+    bin_width, percentiles, density : optional
+        Passed on to photon_heights.
+    merge : bool, optional
+        Write every ground track to one outroot file with a beam column
+        instead of one file per track.
+    jobs : int, optional
+        Number of worker processes.  Default is one per ground track.
+    tracks : list of str, optional
+        Ground tracks to process.  Default is every track in TRACKS
+        that is in the granule.
+
+    Returns
+    -------
+    status : int
+        Non-zero indicates an error in at least one ground track.
+
+    """
+    try:
+        with open_granule(infile) as f_in:
+            tracks = [track for track in (TRACKS if tracks is None else tracks)
+                      if track in f_in]
+    except (IOError, RuntimeError) as err:
+        print("{0}: error: {1}".format(__file__, err), file=sys.stderr)
+        return 1
+    if not tracks:
+        message = "no ground tracks found in " + infile
+        print("{0}: error: {1}".format(__file__, message), file=sys.stderr)
+        return 1
+
+    if jobs is None:
+        jobs = len(tracks)
+    options = dict(surface=surface, window=window, bbox=bbox, polygon=polygon)
+    if merge:
+        tasks = [(read_track, (infile, track, confidence), options)
+                 for track in tracks]
+    else:
+        options.update(plot=plot, overwrite=overwrite, verbose=verbose,
+                       out_format=out_format, bin_width=bin_width,
+                       percentiles=percentiles, density=density)
+        tasks = [(photon_heights,
+                  (infile, track,
+                   outroot + "_" + track if outroot is not None else None,
+                   confidence),
+                  options)
+                 for track in tracks]
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=(worker_settings(),)) as pool:
+            results = list(pool.map(timed_call, tasks))
+    else:
+        results = [timed_call(task) for task in tasks]
+
+    status = 0
+    for track, (result, elapsed) in zip(tracks, results):
+        if merge:
+            n_photons = len(result[0]) if result is not None else 0
+            print("{0}: {1} photons in {2:.2f} s".format(track, n_photons,
+                                                         elapsed))
+            if result is None:
+                status = 1
+        else:
+            print("{0}: status {1} in {2:.2f} s".format(track, result,
+                                                        elapsed))
+            status = status or result
+
+    if merge and status == 0:
+        status = write_merged(infile, tracks, [result for result, _ in results],
+                              outroot, confidence, plot=plot,
+                              overwrite=overwrite, verbose=verbose,
+                              out_format=out_format, bin_width=bin_width,
+                              percentiles=percentiles, density=density)
+    return status
+
+
+def worker_settings():
+    """Return the settings of this process that worker processes need.
+
+    Workers don't share the module state of the process that starts
+    them (and spawned workers don't inherit it), so process pools pass
+    these settings to init_worker.
+
+    Returns
+    -------
+    settings : dict
+        The stage_metrics file, the photon_cache directory and size
+        limit, and the granule_io configuration.  The file and
+        directory are None if disabled.
+
+    """
+    return {"metrics": stage_metrics.metrics_file(),
+            "cache": photon_cache.settings(),
+            "granule_io": granule_io.configuration()}
+
+
+def init_worker(settings):
+    """Apply settings from worker_settings in a worker process."""
+    if settings["metrics"] is not None:
+        stage_metrics.enable(settings["metrics"])
+    directory, max_bytes = settings["cache"]
+    if directory is not None:
+        photon_cache.enable(directory, max_bytes=max_bytes)
+    granule_io.configure(**settings["granule_io"])
+
+
+def timed_call(task):
+    """Call function(*args, **kwargs) and return (result, seconds)."""
+    function, args, kwargs = task
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+
+def read_track(infile, track, confidence, surface=None, window=None,
+               bbox=None, polygon=None):
+    """Return masked distance, height and attributes for one ground track.
+
+    Parameters
+    ----------
+    infile : str
+        Name of ATL03 file to read.
+    track : str
+        Name of ground track to read.
+    confidence : int
+        Minimum signal confidence for keeping photons.
+    surface, window, bbox, polygon : optional
+        Passed on to photon_windows.
+
+    Returns
+    -------
+    distance, height, attrs : NumPy array, NumPy array, dict or None
+        attrs holds the long_name and units of the distance and height
+        datasets.  None indicates an error occurred.
+
+    """
+    stage_metrics.set_context(granule=os.path.basename(infile),
+                              beam=track.strip("/"))
+    try:
+        with open_granule(infile) as f_in:
+            track = posixpath.normpath(posixpath.join("/", track))
+            chunks = list(photon_windows(f_in, track, confidence, window,
+                                         surface=surface, bbox=bbox,
+                                         polygon=polygon))
+            attrs = {
+                "distance": dataset_attrs(
+                    f_in['/'.join([track, "heights/dist_ph_along"])]),
+                "height": dataset_attrs(
+                    f_in['/'.join([track, "heights/h_ph"])]),
+            }
+    except (IOError, KeyError, RuntimeError, ValueError) as err:
+        print("{0}: error: {1}".format(__file__, err.args[0]),
+              file=sys.stderr)
+        return None
+
+    distance = np.concatenate([chunk[0] for chunk in chunks] or [[]])
+    height = np.concatenate([chunk[1] for chunk in chunks] or [[]])
+    return distance, height, attrs
+
+
+def write_merged(infile, tracks, results, outroot, confidence, plot=False,
+                 overwrite=False, verbose=False, out_format="txt",
+                 bin_width=None, percentiles=PERCENTILES, density=None):
+    """Write and plot the photons of several ground tracks together.
+
+    Parameters
+    ----------
+    infile : str
+        Name of ATL03 file the photons were read from.
+    tracks : list of str
+        Ground track of each result.
+    results : list of tuple
+        (distance, height, attrs) for each ground track from read_track.
+    outroot : str
+        Root name of output files.
+    confidence : int
+        Minimum signal confidence used to select the photons.
+    plot : bool, optional
+        Turn on plotting.
+    overwrite : bool, optional
+        Allow function to overwrite existing files if True.
+    verbose : bool, optional
+        Turn on additional output.
+    out_format : str, optional
+        Output file format, one of photon_output.FORMATS.
+    bin_width : float, optional
+        Write the statistics of along-track bins this long (m) of each
+        ground track instead of the photons.
+    percentiles : sequence of float, optional
+        Height percentiles written for each bin besides the median.
+    density : str, optional
+        Plot the photon density of all ground tracks and save it in this
+        format without opening a window.
+
+    Returns
+    -------
+    status : int
+        Non-zero indicates an error.
+
+    """
+    stage_metrics.set_context(granule=os.path.basename(infile), beam="all")
+    attrs = dict(results[0][2])
+    columns = BEAM_COLUMNS
+    if bin_width is not None:
+        attrs = bin_attrs(attrs, percentiles)
+        columns = PhotonBinner(bin_width, percentiles).columns + ("beam",)
+    attrs["beam"] = {"long_name": "beam index into " + ",".join(TRACKS)}
+
+    if outroot is not None:
+        outfile = output_name(outroot, out_format)
+        try:
+            with stage_metrics.stage("write") as timer, \
+                    open_writer(outfile, out_format=out_format, attrs=attrs,
+                                overwrite=overwrite, columns=columns) as f_out:
+                for track, (distance, height, _) in zip(tracks, results):
+                    if bin_width is not None:
+                        arrays = bin_photons(distance, height, bin_width,
+                                             percentiles)
+                    else:
+                        arrays = [distance, height]
+                    beam = np.full(len(arrays[0]), TRACKS.index(track) + 1,
+                                   dtype=np.int8)
+                    f_out.write(*(arrays + [beam]))
+                    timer.add(distance, height)
+        except (IOError, RuntimeError, ValueError) as err:
+            print("{0}: error: {1}".format(__file__, err), file=sys.stderr)
+            return 1
+        if verbose:
+            print("wrote", f_out.n_rows, "bins" if bin_width is not None
+                  else "photons", "to", outfile)
+
+    if plot:
+        with stage_metrics.stage("plot"):
+            plot_merged(infile, tracks, results, outroot, density=density,
+                        verbose=verbose)
+
+    return 0
+
+
+def plot_merged(infile, tracks, results, outroot, density=None,
+                verbose=False):
+    """Plot the photons of several ground tracks, for write_merged."""
+    title = infile.rpartition("/")[2]
+    x_label = axis_label(results[0][2]["distance"])
+    y_label = axis_label(results[0][2]["height"])
+    if density is not None:
+        raster = DensityRaster()
+        for distance, height, _ in results:
+            raster.add(distance, height)
+        save_density(raster, plot_name(outroot, infile, "all", density),
+                     title=title, x_label=x_label, y_label=y_label,
+                     verbose=verbose)
+        return
+    for track, (distance, height, _) in zip(tracks, results):
+        plt.plot(distance, height, ".", label=track)
+    plt.legend()
+    pdffile = outroot + ".pdf" if outroot is not None else None
+    finish_plot(title=title, x_label=x_label, y_label=y_label,
+                pdffile=pdffile, verbose=verbose)
+
+
+def stream_photon_heights(f_in, track, outroot, confidence, window,
+                          plot=False, overwrite=False, verbose=False,
+                          surface=None, bbox=None, polygon=None,
+                          out_format="txt", bin_width=None,
+                          percentiles=PERCENTILES, plotfile=None):
+    """Write and plot photon heights one window of segments at a time.
+
+    Peak memory is set by the number of photons in window geolocation
+    segments rather than by the length of the ground track.  With a
+    bbox or polygon only the photons of segments inside the region are
+    read.  With a bin_width the statistics of each along-track bin are
+    written instead of the photons, as each window completes them.
+    Plots are always photon density images, counted as each window is
+    read, so plotting doesn't hold every photon either.
+
+    Parameters
+    ----------
+    f_in : file
+        Open ATL03 file handle.
+    track : str
+        Name of ground track to read.
+    outroot : str
+        Root name of output files.
+    confidence : int
+        Minimum signal confidence for plotting photons.
+    window : int or None
+        Number of geolocation segments to read at a time.  None reads
+        each run of selected segments at once.
+    plot : bool, optional
+        Turn on plotting.
+    overwrite : bool, optional
+        Allow function to overwrite existing files if True.
+    verbose : bool, optional
+        Turn on additional output.
+    surface : str or list of str, optional
+        Surface types used for the signal confidence test.
+    bbox : sequence of float, optional
+        Region as (west, east, south, north) in degrees.
+    polygon : NumPy array, optional
+        Region as an (N, 2) longitude latitude polygon.
+    out_format : str, optional
+        Output file format, one of photon_output.FORMATS.
+    bin_width : float, optional
+        Write the statistics of along-track bins this long (m) instead
+        of the photons.
+    percentiles : sequence of float, optional
+        Height percentiles written for each bin besides the median.
+    plotfile : str, optional
+        Name of the photon density plot, required with plot.  Its
+        extension, one of photon_plot.PLOT_FORMATS, sets the format.
+
+    Returns
+    -------
+    status : int
+        Non-zero indicates an error.
+
+    """
+    x_name = '/'.join([track, "heights/dist_ph_along"])
+    y_name = '/'.join([track, "heights/h_ph"])
+    for name in (x_name, y_name):
+        if name not in f_in:
+            message = name + " not found in " + f_in.filename
+            print("{0}: error: {1}".format(__file__, message), file=sys.stderr)
+            return 1
+
+    f_out = None
+    binner = None
+    if outroot is not None:
+        outfile = output_name(outroot, out_format)
+        attrs = {"distance": dataset_attrs(f_in[x_name]),
+                 "height": dataset_attrs(f_in[y_name])}
+        columns = COLUMNS
+        try:
+            if bin_width is not None:
+                binner = PhotonBinner(bin_width, percentiles)
+                attrs = bin_attrs(attrs, percentiles)
+                columns = binner.columns
+            f_out = open_writer(outfile, out_format=out_format, attrs=attrs,
+                                overwrite=overwrite, columns=columns)
+        except (IOError, RuntimeError, ValueError) as err:
+            print("{0}: error: {1}".format(__file__, err), file=sys.stderr)
+            return 1
+
+    raster = DensityRaster() if plot else None
+    timers = stage_metrics.totals()
+    n_photons = 0
+    try:
+        for distance, height in photon_windows(f_in, track, confidence,
+                                               window, surface=surface,
+                                               bbox=bbox, polygon=polygon):
+            with timers.stage("write") as timer:
+                if binner is not None:
+                    f_out.write(*binner.add(distance, height))
+                elif f_out is not None:
+                    f_out.write(distance, height)
+                timer.add(distance, height)
+            with timers.stage("plot"):
+                if raster is not None:
+                    raster.add(distance, height)
+            n_photons += len(distance)
+        if binner is not None:
+            with timers.stage("write"):
+                f_out.write(*binner.flush())
+    except (IOError, KeyError, RuntimeError, ValueError) as err:
+        print("{0}: error: {1}".format(__file__, err.args[0]),
+              file=sys.stderr)
+        return 1
+    finally:
+        if f_out is not None:
+            f_out.close()
+
+    if verbose:
+        print(n_photons, "photons with confidence >=", confidence)
+        if binner is not None:
+            print("wrote", f_out.n_rows, "bins to", outfile)
+        elif f_out is not None:
+            print("wrote", n_photons, "photons to", outfile)
+
+    if raster is not None:
+        with timers.stage("plot"):
+            save_density(raster, plotfile,
+                         title=f_in.filename.rpartition("/")[2],
+                         x_label=axis_label(dataset_attrs(f_in[x_name])),
+                         y_label=axis_label(dataset_attrs(f_in[y_name])),
+                         verbose=verbose)
+    timers.emit()
+
+    return 0
+
+
+def photon_windows(f_in, track, confidence, window, surface=None,
+                   bbox=None, polygon=None):
+    """Yield masked distance and height for windows of segments.
+
+    Only the geolocation group is read in full.  For each window of
+    geolocation segments the matching hyperslab of dist_ph_along, h_ph
+    and signal_conf_ph is read, converted to total along track distance
+    and masked by signal confidence.  If a bbox or polygon is given,
+    only the runs of segments inside the region are visited.  With
+    photon_cache enabled the hyperslabs are sliced from arrays that are
+    already cached; missing ones are read from the file, and only the
+    full track path of photon_heights adds them to the cache.
+
+    Parameters
+    ----------
+    f_in : file
+        Open ATL03 file handle.
+    track : str
+        Name of ground track to read.
+    confidence : int
+        Minimum signal confidence for keeping photons.
+    window : int or None
+        Number of geolocation segments to read at a time.  None reads
+        each run of selected segments at once.
+    surface : str or list of str, optional
+        Surface types used for the signal confidence test.
+    bbox : sequence of float, optional
+        Region as (west, east, south, north) in degrees.
+    polygon : NumPy array, optional
+        Region as an (N, 2) longitude latitude polygon.
+
+    Yields
+    ------
+    distance, height : NumPy array
+        Total along track distance and height of the photons in the
+        window with signal confidence of at least confidence.
+
+    Raises
+    ------
+    KeyError
+        A required dataset is missing from the file.
+    RuntimeError
+        The geolocation datasets are inconsistent.
+    ValueError
+        Invalid window size or surface type.
+
+    """
+    if window is not None and window < 1:
+        raise ValueError("window must be at least one segment")
+
+    timers = stage_metrics.totals()
+    try:
+        for distance, height in _windows(f_in, track, confidence, window,
+                                         surface, bbox, polygon, timers):
+            yield distance, height
+    finally:
+        # Also when a window fails or the caller stops early.
+        timers.emit()
+
+
+def _windows(f_in, track, confidence, window, surface, bbox, polygon,
+             timers):
+    """Yield the windows of photon_windows, timed by timers."""
+    heights = {}
+    for name in ("dist_ph_along", "h_ph", "signal_conf_ph"):
+        path = '/'.join([track, "heights", name])
+        if path not in f_in:
+            raise KeyError(path + " not found in " + f_in.filename)
+        with timers.stage("read"):
+            heights[name] = photon_cache.dataset(f_in, path, fill=False)
+
+    n_photons = heights["h_ph"].shape[0]
+    with timers.stage("index"):
+        index = PhotonIndex.from_file(f_in, track, n_photons=n_photons)
+        surface_columns(surface)  # Fail before reading any photons.
+
+        if bbox is None and polygon is None:
+            seg_starts, seg_stops = [0], [index.n_segments]
+        else:
+            seg_starts, seg_stops = region_segments(f_in, track, bbox=bbox,
+                                                    polygon=polygon)
+
+    buffers = ReadBuffers()
+    for run_start, run_stop in zip(seg_starts, seg_stops):
+        step = window if window is not None else run_stop - run_start
+        for seg_start in range(run_start, run_stop, step):
+            seg_stop = min(seg_start + step, run_stop)
+            start, stop = index.photon_range(seg_start, seg_stop)
+            if start == stop:
+                continue
+            with timers.stage("read") as timer:
+                # The buffers are reused by the next window, so only
+                # new arrays computed from them are yielded.
+                dist_ph_along = buffers.read(heights["dist_ph_along"],
+                                             start, stop)
+                height = buffers.read(heights["h_ph"], start, stop)
+                signal_conf_ph = buffers.read(heights["signal_conf_ph"],
+                                              start, stop)
+                timer.add(dist_ph_along, height, signal_conf_ph)
+            with timers.stage("distance") as timer:
+                distance = index.along_track_distance(
+                    dist_ph_along, start=start, seg_start=seg_start,
+                    seg_stop=seg_stop)
+                timer.add(distance)
+            with timers.stage("mask") as timer:
+                conf = max_signal_conf(signal_conf_ph, surface=surface)
+                take = conf >= confidence
+                distance, height = distance[take], height[take]
+                timer.add(distance, height)
+            yield distance, height
+
+
+def region_segments(f_in, track, bbox=None, polygon=None):
+    """Find the runs of geolocation segments inside a region.
+
+    Only the reference photon latitude and longitude of each 20 m
+    geolocation segment are read, so the test is much cheaper than
+    reading photon coordinates.
+
+    Parameters
+    ----------
+    f_in : file
+        Open ATL03 file handle.
+    track : str
+        Name of ground track to read.
+    bbox : sequence of float, optional
+        Region as (west, east, south, north) in degrees.
+    polygon : NumPy array, optional
+        Region as an (N, 2) longitude latitude polygon.
+
+    Returns
+    -------
+    starts, stops : NumPy array of int
+        0-based segment ranges [starts[i], stops[i]) inside the region.
+
+    Raises
+    ------
+    KeyError
+        A reference photon coordinate dataset is missing from the file.
+
+    """
+    coords = []
+    for name in ("reference_photon_lon", "reference_photon_lat"):
+        path = '/'.join([track, "geolocation", name])
+        if path not in f_in:
+            raise KeyError(path + " not found in " + f_in.filename)
+        coords.append(f_in[path][...])
+    return runs(region_mask(coords[0], coords[1], bbox=bbox, polygon=polygon))
+
+
+def dataset_attrs(dataset):
+    """Return the long_name and units attributes of a dataset as str."""
+    attrs = {}
+    for key in ("long_name", "units"):
+        value = dataset.attrs.get(key)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        if value is not None:
+            attrs[key] = value
+    return attrs
+
+
+def axis_label(attrs):
+    """Return a plot axis label from long_name and units attributes."""
+    return attrs.get("long_name", "") + " (" + attrs.get("units", "") + ")"
+
+
 def total_along_track_distance(f_in, track, dist_ph_along):
     """Compute total along track distance from equator.
 
@@ -159,42 +829,80 @@ def total_along_track_distance(f_in, track, dist_ph_along):
         error occurred.
 
     """
-    name = '/'.join([track, "geolocation/ph_index_beg"])
-    if name not in f_in:
-        message = name + " not found in " + f_in.filename
+    try:
+        index = PhotonIndex.from_file(f_in, track,
+                                      n_photons=len(dist_ph_along))
+    except (KeyError, RuntimeError) as err:
+        message = err.args[0]
         print("{0}: error: {1}".format(__file__, message), file=sys.stderr)
         return None
-    ph_index_beg = f_in[name][...]
 
-    name = '/'.join([track, "geolocation/segment_ph_cnt"])
-    if name not in f_in:
-        message = name + " not found in " + f_in.filename
-        print("{0}: error: {1}".format(__file__, message), file=sys.stderr)
-        return None
-    segment_ph_cnt = f_in[name][...]
+    return index.along_track_distance(dist_ph_along)
 
-    name = '/'.join(["", track, "geolocation/segment_dist_x"])
-    if name not in f_in:
-        message = name + " not found in " + f_in.filename
-        print("{0}: error: {1}".format(__file__, message), file=sys.stderr)
-        return None
-    segment_dist_x = f_in[name][...]
 
-    distance = np.zeros(len(dist_ph_along))
-    j = -1
-    for i, start in enumerate(ph_index_beg):
-        # The index values in ph_index_bg are 1-based.
-        start -= 1  # Index of first photon in geosegment.
-        stop = start + segment_ph_cnt[i]
-        segment_start = segment_dist_x[i]
-        for dist in dist_ph_along[start:stop]:
-            j += 1
-            distance[j] = segment_start + dist
+def surface_columns(surface=None):
+    """Return the signal_conf_ph column indices for surface types.
 
-    return distance
+    Parameters
+    ----------
+    surface : str or list of str, optional
+        Surface type names from SURFACE_TYPES.  None or "any" selects
+        every surface type.
+
+    Returns
+    -------
+    columns : list of int
+        Column indices into /track/heights/signal_conf_ph.
 
+    Raises
+    ------
+    ValueError
+        Unknown surface type.
 
-def make_signal_conf_mask(f_hdf5, track, confidence):
+    """
+    if surface is None or surface == "any":
+        return list(range(len(SURFACE_TYPES)))
+    if isinstance(surface, str):
+        surface = [surface]
+    columns = []
+    for name in surface:
+        if name not in SURFACE_TYPES:
+            raise ValueError("unknown surface type " + name + ", expected "
+                             "one of " + ", ".join(SURFACE_TYPES))
+        columns.append(SURFACE_TYPES.index(name))
+    return columns
+
+
+def max_signal_conf(signal_conf_ph, surface=None):
+    """Return the per-photon maximum signal confidence.
+
+    Parameters
+    ----------
+    signal_conf_ph : NumPy array
+        ATL03 /gtXN/heights/signal_conf_ph data, one row per photon and
+        one column per surface type.
+    surface : str or list of str, optional
+        Surface types to consider.  Default is all surface types.
+
+    Returns
+    -------
+    conf : NumPy array
+        Maximum signal confidence over the selected surface types as an
+        int8 array, one value per photon.  Comparing it with a threshold
+        gives the same mask as make_signal_conf_mask.
+
+    """
+    columns = surface_columns(surface)
+    signal_conf_ph = np.asarray(signal_conf_ph)
+    if columns == list(range(signal_conf_ph.shape[1])):
+        conf = signal_conf_ph.max(axis=1)
+    else:
+        conf = signal_conf_ph[:, columns].max(axis=1)
+    return conf.astype(np.int8, copy=False)
+
+
+def make_signal_conf_mask(f_hdf5, track, confidence, surface=None,
+                          max_conf=False):
     """Create mask based on minimum signal confidence.
 
     Parameters
@@ -206,29 +914,43 @@ def make_signal_conf_mask(f_hdf5, track, confidence):
         gt2l, gt2r, gt3l, or gt3r.
     confidence : int
         Minimum signal confidence for plotting photons.
+    surface : str or list of str, optional
+        Surface types to test, from SURFACE_TYPES.  Default is all
+        surface types.
+    max_conf : bool, optional
+        Return the per-photon maximum signal confidence instead of the
+        mask, so callers can apply other thresholds later.
 
     Returns
     -------
     mask : NumPy array or None
-        True if /track/heights/signal_conf_ph is True for at least one
-        surface type.  None indicates an error occurred.
+        True if /track/heights/signal_conf_ph is at least confidence
+        for at least one selected surface type, or the int8 maximum
+        confidence if max_conf is True.  None indicates an error
+        occurred.
 
     """
     # Read signal confidence dataset.
     name = '/'.join([track, "heights/signal_conf_ph"])
-    if name in f_hdf5:
-        signal_conf_ph = f_hdf5[name][...]
-        mask = np.array([np.any(row >= confidence) for row in signal_conf_ph])
-    else:
+    if name not in f_hdf5:
         message = name + " not found in " + f_hdf5.filename
         print("{0}: error: {1}".format(__file__, message), file=sys.stderr)
-        mask = None
+        return None
+
+    try:
+        conf = max_signal_conf(photon_cache.dataset(f_hdf5, name)[...],
+                               surface=surface)
+    except ValueError as err:
+        print("{0}: error: {1}".format(__file__, err), file=sys.stderr)
+        return None
 
-    return mask
+    if max_conf:
+        return conf
+    return conf >= confidence
 
 
 def plot_data(x, y, mask=None, title=None, x_label=None, y_label=None,
-              pdffile=None, verbose=False):
+              pdffile=None, verbose=False, density=False):
     """Plot one dataset against another with an optional mask.
 
     Parameters
@@ -245,50 +967,105 @@ def plot_data(x, y, mask=None, title=None, x_label=None, y_label=None,
         Label for X axis
     y_label : str, optional
         Label for Y axis
+    pdffile : str, optional
+        Name of the plot file.
     verbose : bool, optional
         Turn on additional output.
+    density : bool, optional
+        Save a photon density image to pdffile without opening a window
+        instead of plotting every point.
 
     Returns
     -------
     This function does not return anything.
 
     """
-    if mask is None:
-        mask = np.array(len(x) * [True])
-    else:
-        mask = np.array(mask)
-    if len(mask) != len(x):
-        message = "mask and data have different lengths, unable to plot"
-        print("{0}: warning: {1}".format(__file__, message), file=sys.stderr)
-        print("TEST: len(mask), len(x) =", len(mask), len(x))
-        return
-
-    # Filter the data.
-    x = x[mask]
-    y = y[mask]
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if len(mask) != len(x):
+            message = "mask and data have different lengths, unable to plot"
+            print("{0}: warning: {1}".format(__file__, message),
+                  file=sys.stderr)
+            return
+
+        # Filter the data.
+        x = x[mask]
+        y = y[mask]
 
     if verbose:
         print("plotting", len(x), "data points")
 
+    if density:
+        raster = DensityRaster()
+        raster.add(x, y)
+        save_density(raster, pdffile, title=title, x_label=x_label,
+                     y_label=y_label, verbose=verbose)
+        return
+
     # Plot the data.
     plt.plot(x, y, "r.")
+    finish_plot(title=title, x_label=x_label, y_label=y_label,
+                pdffile=pdffile, verbose=verbose)
+
+    return
+
+
+def finish_plot(title=None, x_label=None, y_label=None, pdffile=None,
+                verbose=False):
+    """Label, save and show the current plot.
+
+    Parameters
+    ----------
+    title : str, optional
+        Plot title
+    x_label : str, optional
+        Label for X axis
+    y_label : str, optional
+        Label for Y axis
+    pdffile : str, optional
+        Name of PDF file for the plot.
+    verbose : bool, optional
+        Turn on additional output.
+
+    Returns
+    -------
+    This function does not return anything.
+
+    """
     plt.xlabel(x_label)
     plt.ylabel(y_label)
     plt.title(title)
-    plt.show()
 
-    # Save the plot to a file.
+    # Save the plot to a file before show, which may discard the figure.
     if pdffile:
         if verbose:
             print("saving plot to", pdffile)
         pdf = PdfPages(pdffile)
         pdf.savefig()
         pdf.close()
+    plt.show()
+    plt.close()
 
     return
 
 
-def write_data(outfile, distance, height, overwrite=False, verbose=False):
+def plot_name(outroot, infile, track, plot_format="pdf"):
+    """Return the plot file name for an output root or input granule.
+
+    Without an output root the plot is named after the input file and
+    ground track, so batch runs with density plots need no -o.
+
+    """
+    if plot_format is None:
+        plot_format = "pdf"
+    if outroot is None:
+        outroot = (os.path.splitext(os.path.basename(infile))[0] + "_" +
+                   track.strip("/"))
+    return outroot + "." + plot_format
+
+
+def write_data(outfile, distance, height, overwrite=False, verbose=False,
+               out_format=None, attrs=None):
     """Write height along track data to output file.
 
     Parameters
@@ -299,14 +1076,16 @@ def write_data(outfile, distance, height, overwrite=False, verbose=False):
         Distance along track.
     height : list
         Photon height.
-    infile : str
-        Name of input data file.
-    track : str
-        Ground track for data.
     overwrite : bool, optional
         Allow function to overwrite existing files if True.
     verbose : bool, optional
         Turn on additional output.
+    out_format : str, optional
+        Output file format, one of photon_output.FORMATS.  Default is
+        taken from the outfile extension.
+    attrs : dict, optional
+        long_name and units attributes for the distance and height
+        columns.
 
     Returns
     -------
@@ -320,40 +1099,131 @@ def write_data(outfile, distance, height, overwrite=False, verbose=False):
         Unauthorized attempt to overwrite an existing file.
 
     """
-    if os.path.isfile(outfile) and not overwrite:
-        message = outfile + " already exists and overwrite set to False"
-        raise RuntimeError(message)
-
-    try:
-        f_out = open(outfile, mode="w")
-    except IOError:
-        raise
-
-    print("#  Distance (m)     Height (m)", file=f_out)
-    for i, _ in enumerate(distance):
-        print("{0:15.3f}{1:15.3f}".format(distance[i], height[i]), file=f_out)
-    f_out.close()
+    with open_writer(outfile, out_format=out_format, attrs=attrs,
+                     overwrite=overwrite) as f_out:
+        f_out.write(distance, height)
     if verbose:
         print("wrote", len(distance), "photons to", outfile)
     return
 
 
+def catalog_tracks(catalog, infile, bbox=None, polygon=None):
+    """Return the ground tracks of a granule that may meet a region.
+
+    The granule is added to the catalogue first if it is new or has
+    changed, otherwise the answer comes from the catalogue alone.
+
+    Parameters
+    ----------
+    catalog : str
+        Name of the granule catalogue (SQLite) file.
+    infile : str
+        Name of ATL03 file.
+    bbox : sequence of float, optional
+        Region as (west, east, south, north) in degrees.
+    polygon : NumPy array, optional
+        Region as an (N, 2) longitude latitude polygon.  Its bounding
+        box is used.
+
+    Returns
+    -------
+    tracks : list of str
+        Ground tracks whose bounds intersect the region.
+
+    """
+    if polygon is not None:
+        poly_bbox = (polygon[:, 0].min(), polygon[:, 0].max(),
+                     polygon[:, 1].min(), polygon[:, 1].max())
+        # A polygon across the antimeridian runs past 180 E
+        if poly_bbox[1] > 180:
+            poly_bbox = (-180, 180) + poly_bbox[2:]
+        if bbox is not None:
+            bbox = (max(bbox[0], poly_bbox[0]), min(bbox[1], poly_bbox[1]),
+                    max(bbox[2], poly_bbox[2]), min(bbox[3], poly_bbox[3]))
+        else:
+            bbox = poly_bbox
+
+    db = open_catalog(catalog)
+    update_catalog(db, [infile])
+    found = query_beams(db, bbox=bbox)
+    db.close()
+    return found.get(os.path.abspath(infile), [])
+
+
 def cl_args(description):
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument("infile", type=str,
                         help="input ATL03 file")
     parser.add_argument("track", type=str,
-                        help="ground track: gt1l,gt1r,gt2l,gt2r,gt3l,gt3r,")
+                        help="ground track: gt1l,gt1r,gt2l,gt2r,gt3l,gt3r, "
+                             "or all")
     parser.add_argument("-o", type=str, default=None,
                         help="output file root name")
     parser.add_argument("-c", type=int, default=2,
                         help="minimum signal confidence to plot (0-4)"
                              "default is 4 (high)")
+    parser.add_argument("-s", type=str, default="any",
+                        choices=("any",) + SURFACE_TYPES,
+                        help="surface type for the signal confidence test, "
+                             "default is any")
+    parser.add_argument("-t", type=str, default="txt", choices=FORMATS,
+                        help="output file format, default is txt")
+    parser.add_argument("-w", type=int, default=None,
+                        help="process the track in windows of this many "
+                             "geolocation segments to bound memory use")
+    parser.add_argument("-b", type=float, nargs=4, default=None,
+                        metavar=("W", "E", "S", "N"),
+                        help="only read segments inside this bounding box "
+                             "(deg)")
+    parser.add_argument("-g", type=str, default=None,
+                        help="only read segments inside the polygon in this "
+                             "text file of lon lat vertices, or inside the "
+                             "footprint of this DEM")
+    parser.add_argument("-a", type=float, default=None,
+                        help="write the photon count and height mean, "
+                             "median and percentiles of along-track bins of "
+                             "this width (m) instead of the photons")
+    parser.add_argument("-q", type=float, nargs="+", default=PERCENTILES,
+                        help="with -a, height percentiles written besides the "
+                             "median, default is %s"
+                             % " ".join(str(p) for p in PERCENTILES))
+    parser.add_argument("-m", action="store_true",
+                        help="with track all, write every track to one file "
+                             "with a beam column")
+    parser.add_argument("-j", type=int, default=None,
+                        help="with track all, number of worker processes, "
+                             "default is one per track")
+    parser.add_argument("-C", type=str, default=None,
+                        help="granule catalogue (SQLite) used with -b or -g "
+                             "to skip beams outside the region without "
+                             "opening the granule")
     parser.add_argument("-f", action="store_true",
                         help="force overwriting output data file")
     parser.add_argument("-p", action="store_true",
-                        help="plot photon heights")
+                        help="plot photon heights; with -w, -b, -g or -a "
+                             "the plot is a density image, saved as PDF "
+                             "unless -d gives another format")
+    parser.add_argument("-d", type=str, default=None, choices=PLOT_FORMATS,
+                        help="plot photon density as an image in this format "
+                             "without opening a window, for batch runs "
+                             "(implies -p)")
+    parser.add_argument("-M", type=str, default=None,
+                        help="append the time, bytes read, array sizes and "
+                             "peak memory of each stage to this file as JSON "
+                             "lines")
+    parser.add_argument("-k", type=str, default=None,
+                        help="cache the decoded photon arrays as .npy files "
+                             "in this directory, so later runs on the same "
+                             "granule skip decompression (see "
+                             "photon_cache.py)")
+    parser.add_argument("-K", type=float, default=None,
+                        help="with -k, cache size limit (GB), default is %g"
+                             % (photon_cache.MAX_BYTES / 2**30))
+    parser.add_argument("-H", type=float, default=None,
+                        help="HDF5 chunk cache size (MB) per dataset, "
+                             "default is %g (see granule_io.py)"
+                             % (granule_io.CHUNK_CACHE / 2**20))
     parser.add_argument("-v", action="store_true",
                         help="increase the output verbosity")
     return parser.parse_args()
@@ -368,28 +1238,93 @@ def main(argv=None):
     infile = args.infile
     track = args.track
     outroot = args.o
+    out_format = args.t
     confidence_min = args.c
+    surface = args.s
+    window = args.w
+    bbox = args.b
+    polygon_file = args.g
+    bin_width = args.a
+    percentiles = args.q
+    merge = args.m
+    jobs = args.j
+    catalog = args.C
     overwrite = args.f
-    plot = args.p
+    density = args.d
+    plot = args.p or density is not None
     verbose = args.v
+    if args.M is not None:
+        stage_metrics.enable(args.M)
+    if args.k is not None:
+        photon_cache.enable(args.k, max_bytes=None if args.K is None
+                            else int(args.K * 2**30))
+    if args.H is not None:
+        granule_io.configure(chunk_cache=int(args.H * 2**20))
 
     if verbose:
         print()
         print("          input ATLAS granule:", infile)
         print("                 ground track:", track)
         print("                 plot results:", plot)
+        if density is not None:
+            print("          density plot format:", density)
         if plot:
             print("    minimum signal confidence:", confidence_min)
+            print("    signal confidence surface:", surface)
         print("             output file root:", outroot)
+        print("           output file format:", out_format)
+        print("          segments per window:", window)
+        print("                 bounding box:", bbox)
+        print("                 polygon file:", polygon_file)
+        print("                bin width (m):", bin_width)
+        if bin_width is not None:
+            print("              bin percentiles:", " ".join(
+                "%g" % p for p in percentiles))
+        if track == "all":
+            print("          merge ground tracks:", merge)
+            print("             worker processes:", jobs)
+        print("       photon cache directory:", args.k)
         print("     overwrite existing files:", overwrite)
         print("                 verbose mode:", verbose)
         print()
 
     try:
-        status = photon_heights(infile, track, outroot,
-                                confidence_min, plot=plot,
-                                overwrite=overwrite, verbose=verbose)
-    except (IOError, RuntimeError) as err:
+        polygon = None
+        if polygon_file is not None:
+            polygon = read_footprint(polygon_file)
+        tracks = None
+        if catalog is not None and (bbox is not None or polygon is not None):
+            tracks = catalog_tracks(catalog, infile, bbox=bbox,
+                                    polygon=polygon)
+            if verbose:
+                print("catalogue tracks in region:", ",".join(tracks))
+        if tracks is not None and (not tracks if track == "all"
+                                   else track not in tracks):
+            if verbose:
+                print(track, "does not intersect the region, skipping")
+            status = 0
+        elif track == "all":
+            status = all_photon_heights(infile, outroot, confidence_min,
+                                        plot=plot, overwrite=overwrite,
+                                        verbose=verbose, surface=surface,
+                                        window=window, bbox=bbox,
+                                        polygon=polygon,
+                                        out_format=out_format, merge=merge,
+                                        jobs=jobs, tracks=tracks,
+                                        bin_width=bin_width,
+                                        percentiles=percentiles,
+                                        density=density)
+        else:
+            status = photon_heights(infile, track, outroot,
+                                    confidence_min, plot=plot,
+                                    overwrite=overwrite, verbose=verbose,
+                                    surface=surface, window=window,
+                                    bbox=bbox, polygon=polygon,
+                                    out_format=out_format,
+                                    bin_width=bin_width,
+                                    percentiles=percentiles,
+                                    density=density)
+    except (IOError, RuntimeError, ValueError) as err:
         print("{0}: error: {1}".format(__file__, err), file=sys.stderr)
         status = 1
 
@@ -0,0 +1,220 @@
+"""Photon to geolocation segment index for ATL03 ground tracks.
+
+The ATL03 /gtx/geolocation group describes the photons in /gtx/heights
+with one record per 20 m geolocation segment.  ph_index_beg holds the
+1-based index of the first photon in the segment (0 when the segment has
+no photons), segment_ph_cnt holds the number of photons in the segment,
+and segment_dist_x holds the along-track distance of the segment from
+the equator.  PhotonIndex turns these into per-photon lookups with bulk
+NumPy operations so that no code has to loop over segments or photons.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+
+
+class PhotonIndex(object):
+    """Map photons in /gtx/heights to segments in /gtx/geolocation.
+
+    Parameters
+    ----------
+    ph_index_beg : NumPy array
+        ATL03 /gtx/geolocation/ph_index_beg data (1-based, 0 for
+        segments without photons).
+    segment_ph_cnt : NumPy array
+        ATL03 /gtx/geolocation/segment_ph_cnt data.
+    segment_dist_x : NumPy array
+        ATL03 /gtx/geolocation/segment_dist_x data.
+    n_photons : int, optional
+        Number of photons in /gtx/heights.  Defaults to one past the
+        last photon referenced by the segments.
+
+    Attributes
+    ----------
+    segment_start : NumPy array
+        0-based index of the first photon in each segment, -1 for
+        segments without photons.
+    segment_ph_cnt : NumPy array
+        Number of photons in each segment.
+    segment_dist_x : NumPy array
+        Along-track distance of each segment from the equator.
+    segment_id : NumPy array
+        0-based segment index for each photon, -1 for photons that do
+        not belong to any segment.  Computed on each access; use
+        segment_ids for a range of photons.
+
+    """
+
+    def __init__(self, ph_index_beg, segment_ph_cnt, segment_dist_x,
+                 n_photons=None):
+        ph_index_beg = np.asarray(ph_index_beg, dtype=np.int64)
+        segment_ph_cnt = np.asarray(segment_ph_cnt, dtype=np.int64)
+        if not (len(ph_index_beg) == len(segment_ph_cnt) ==
+                len(segment_dist_x)):
+            raise RuntimeError("geolocation datasets have different lengths")
+
+        # A segment only contributes photons if it has a valid 1-based
+        # start index and a positive count.
+        empty = (ph_index_beg < 1) | (segment_ph_cnt < 1)
+        self.segment_ph_cnt = np.where(empty, 0, segment_ph_cnt)
+        self.segment_start = np.where(empty, -1, ph_index_beg - 1)
+        self.segment_dist_x = np.asarray(segment_dist_x)
+
+        segment_stop = self.segment_start + self.segment_ph_cnt
+        if n_photons is None:
+            n_photons = int(segment_stop.max()) if len(segment_stop) else 0
+        elif len(segment_stop) and segment_stop.max() > n_photons:
+            raise RuntimeError("geolocation segments reference more than " +
+                               str(n_photons) + " photons")
+        self.n_photons = n_photons
+
+    @classmethod
+    def from_file(cls, f_in, track, n_photons=None):
+        """Build the index from the geolocation group of an ATL03 file.
+
+        Parameters
+        ----------
+        f_in : file
+            Open ATL03 file handle.
+        track : str
+            Name of ground track to read.  Value is one of gt1l, gt1r,
+            gt2l, gt2r, gt3l, or gt3r.
+        n_photons : int, optional
+            Number of photons in /track/heights.
+
+        Returns
+        -------
+        index : PhotonIndex
+
+        Raises
+        ------
+        KeyError
+            A geolocation dataset is missing from the file.
+
+        """
+        data = []
+        for name in ("ph_index_beg", "segment_ph_cnt", "segment_dist_x"):
+            name = '/'.join([track, "geolocation", name])
+            if name not in f_in:
+                raise KeyError(name + " not found in " + f_in.filename)
+            data.append(f_in[name][...])
+        return cls(*data, n_photons=n_photons)
+
+    @property
+    def segment_id(self):
+        """0-based segment index of every photon, -1 outside segments."""
+        return self.segment_ids()
+
+    def segment_ids(self, start=0, stop=None, seg_start=0, seg_stop=None):
+        """Return the segment index of the photons in [start, stop).
+
+        Only segments [seg_start, seg_stop) are expanded, so for a window
+        of segments and its photon_range the work and memory scale with
+        the window rather than the ground track.
+
+        Parameters
+        ----------
+        start, stop : int, optional
+            0-based photon range.  Default is every photon.
+        seg_start, seg_stop : int, optional
+            0-based range of the segments to look in.  Default is every
+            segment.
+
+        Returns
+        -------
+        segment_id : NumPy array
+            0-based segment index of each photon in the range, -1 for
+            photons that do not belong to any of the segments.
+
+        """
+        if stop is None:
+            stop = self.n_photons
+        segments = np.arange(seg_start, len(self.segment_start)
+                             if seg_stop is None else seg_stop)
+        segments = segments[self.segment_ph_cnt[segments] > 0]
+
+        # Clip each segment's photons to the range, then expand the
+        # clipped ranges into one entry per photon.  offset is the
+        # position of each segment's first photon in the flattened list
+        # of photons, so subtracting it from a running count gives the
+        # position of each photon within its segment.
+        first = np.maximum(self.segment_start[segments], start)
+        last = np.minimum(self.segment_start[segments] +
+                          self.segment_ph_cnt[segments], stop)
+        keep = last > first
+        segments, first = segments[keep], first[keep]
+        counts = last[keep] - first
+        offset = np.cumsum(counts) - counts
+        photons = (np.repeat(first - start - offset, counts) +
+                   np.arange(counts.sum()))
+        segment_id = np.full(max(stop - start, 0), -1, dtype=np.int64)
+        segment_id[photons] = np.repeat(segments, counts)
+        return segment_id
+
+    @property
+    def n_segments(self):
+        """Number of geolocation segments."""
+        return len(self.segment_start)
+
+    def photon_range(self, seg_start=0, seg_stop=None):
+        """Return the photon slice covered by a range of segments.
+
+        Parameters
+        ----------
+        seg_start : int, optional
+            0-based index of the first segment.
+        seg_stop : int, optional
+            0-based index one past the last segment.
+
+        Returns
+        -------
+        start, stop : int
+            0-based photon indices such that photons[start:stop] holds
+            every photon in the segments.  start == stop if none of the
+            segments have photons.
+
+        """
+        starts = self.segment_start[seg_start:seg_stop]
+        counts = self.segment_ph_cnt[seg_start:seg_stop]
+        full = counts > 0
+        if not full.any():
+            return 0, 0
+        start = int(starts[full].min())
+        stop = int((starts[full] + counts[full]).max())
+        return start, stop
+
+    def along_track_distance(self, dist_ph_along, start=0, seg_start=0,
+                             seg_stop=None):
+        """Compute total along track distance from equator.
+
+        Parameters
+        ----------
+        dist_ph_along : NumPy array
+            ATL03 /gtXN/heights/dist_ph_along data.
+        start : int, optional
+            0-based index of the first photon in dist_ph_along, for
+            callers that read a hyperslab of the heights group.
+        seg_start, seg_stop : int, optional
+            0-based range of the segments holding the photons, for
+            callers that read a window of segments.  Default is every
+            segment.
+
+        Returns
+        -------
+        distance : NumPy array
+            Total along track distance from equator.  Photons that do
+            not belong to a segment get a distance of zero.
+
+        """
+        segment_id = self.segment_ids(start, start + len(dist_ph_along),
+                                      seg_start, seg_stop)
+        distance = np.zeros(len(dist_ph_along))
+        take = segment_id >= 0
+        distance[take] = (self.segment_dist_x[segment_id[take]] +
+                          dist_ph_along[take])
+        return distance
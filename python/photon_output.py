@@ -0,0 +1,250 @@
+"""Output backends for photon height along track data.
+
+Each writer takes whole arrays (or successive chunks of them from the
+streaming mode of photon_height.py) and writes them in bulk.  The
+dataset attributes read from the ATL03 file, such as long_name and
+units, are kept wherever the format has somewhere to put them.
+
+Formats
+-------
+txt
+    Fixed-width text, the original photon_height.py format.
+h5
+    HDF5 with chunked, compressed, resizable datasets.
+npz
+    NumPy .npz archive.  Chunks are held until the writer is closed.
+parquet
+    Apache Parquet, one row group per chunk.  Requires pyarrow.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+
+import numpy as np
+
+FORMATS = ("txt", "h5", "npz", "parquet")
+
+# Output column names, in file order.  The beam column is only written
+# when several ground tracks are merged into one file.  Along-track bin
+# output has the columns of photon_bins.bin_columns instead.
+COLUMNS = ("distance", "height")
+BEAM_COLUMNS = COLUMNS + ("beam",)
+
+# Text format and header for each column.  Other columns, such as bin
+# percentiles, are written with TEXT_FORMAT under their own name.
+TEXT_FORMATS = {"distance": "%15.3f", "height": "%15.3f", "beam": "%5d",
+                "count": "%8d", "mean": "%15.3f", "median": "%15.3f"}
+TEXT_HEADERS = {"distance": "  Distance (m)", "height": "     Height (m)",
+                "beam": " Beam", "count": "   Count", "mean": "       Mean (m)",
+                "median": "     Median (m)"}
+TEXT_FORMAT = "%15.3f"
+
+
+def output_name(outroot, out_format="txt"):
+    """Return the output file name for a root name and format."""
+    return outroot + "." + out_format
+
+
+def open_writer(outfile, out_format=None, attrs=None, overwrite=False,
+                columns=COLUMNS):
+    """Open a photon height writer.
+
+    Parameters
+    ----------
+    outfile : str
+        Name of output file.
+    out_format : str, optional
+        One of FORMATS.  Default is taken from the outfile extension,
+        falling back to txt.
+    attrs : dict, optional
+        Attributes for each column, e.g.
+        {"distance": {"long_name": ..., "units": ...}, "height": ...}.
+    overwrite : bool, optional
+        Allow function to overwrite existing files if True.
+    columns : sequence of str, optional
+        Output column names, COLUMNS, BEAM_COLUMNS or bin columns.
+
+    Returns
+    -------
+    writer : object
+        Writer with write(*arrays) and close() methods, taking one array
+        per column.  It can also be used in a with statement.
+
+    Raises
+    ------
+    IOError
+        Error opening output file.
+    RuntimeError
+        Unauthorized attempt to overwrite an existing file, unknown
+        format, or missing optional dependency.
+
+    """
+    if out_format is None:
+        out_format = os.path.splitext(outfile)[1].lstrip(".") or "txt"
+    if out_format not in FORMATS:
+        raise RuntimeError("unknown output format " + out_format +
+                           ", expected one of " + ", ".join(FORMATS))
+
+    if os.path.isfile(outfile) and not overwrite:
+        message = outfile + " already exists and overwrite set to False"
+        raise RuntimeError(message)
+
+    writer = {"txt": TextWriter, "h5": HDF5Writer, "npz": NpzWriter,
+              "parquet": ParquetWriter}[out_format]
+    return writer(outfile, attrs=attrs, columns=columns)
+
+
+class _Writer(object):
+    """Common bookkeeping for the photon height writers."""
+
+    def __init__(self, outfile, attrs=None, columns=COLUMNS):
+        self.outfile = outfile
+        self.attrs = attrs if attrs is not None else {}
+        self.columns = tuple(columns)
+        self.n_rows = 0
+
+    def write(self, *arrays):
+        """Append rows, one array per column."""
+        if len(arrays) != len(self.columns):
+            raise RuntimeError("expected arrays for " +
+                               ", ".join(self.columns))
+        arrays = [np.asarray(data) for data in arrays]
+        if any(len(data) != len(arrays[0]) for data in arrays):
+            raise RuntimeError(", ".join(self.columns) +
+                               " have different lengths")
+        self._write(arrays)
+        self.n_rows += len(arrays[0])
+
+    def close(self):
+        """Finish writing the output file."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class TextWriter(_Writer):
+    """Fixed-width text written through a preformatted buffer."""
+
+    block = 65536  # Rows formatted per write call.
+
+    def __init__(self, outfile, attrs=None, columns=COLUMNS):
+        super(TextWriter, self).__init__(outfile, attrs=attrs,
+                                         columns=columns)
+        self.f_out = open(outfile, mode="w")
+        self.f_out.write("#" + "".join(TEXT_HEADERS.get(name, "%15s" % name)
+                                       for name in self.columns) + "\n")
+
+    def _write(self, arrays):
+        # One % over a repeated format string is several times faster
+        # than formatting and printing each row.
+        fmt = "".join(TEXT_FORMATS.get(name, TEXT_FORMAT)
+                      for name in self.columns) + "\n"
+        for start in range(0, len(arrays[0]), self.block):
+            rows = np.column_stack([data[start:start + self.block]
+                                    for data in arrays])
+            self.f_out.write((fmt * len(rows)) % tuple(rows.ravel().tolist()))
+
+    def close(self):
+        self.f_out.close()
+
+
+class HDF5Writer(_Writer):
+    """Chunked, gzip-compressed, resizable HDF5 datasets."""
+
+    chunk = 65536  # Rows per HDF5 chunk.
+
+    def __init__(self, outfile, attrs=None, columns=COLUMNS,
+                 compression="gzip"):
+        import h5py
+
+        super(HDF5Writer, self).__init__(outfile, attrs=attrs,
+                                         columns=columns)
+        self.f_out = h5py.File(outfile, "w")
+        self.compression = compression
+
+    def _write(self, arrays):
+        for name, data in zip(self.columns, arrays):
+            if name not in self.f_out:
+                dset = self.f_out.create_dataset(
+                    name, shape=(0,), maxshape=(None,), dtype=data.dtype,
+                    chunks=(self.chunk,), compression=self.compression,
+                    shuffle=True)
+                for key, value in self.attrs.get(name, {}).items():
+                    dset.attrs[key] = value
+            dset = self.f_out[name]
+            dset.resize((self.n_rows + len(data),))
+            dset[self.n_rows:] = data
+
+    def close(self):
+        self.f_out.close()
+
+
+class NpzWriter(_Writer):
+    """NumPy .npz archive written in one call when the writer closes.
+
+    The attributes are stored as a JSON string in the attrs member.
+
+    """
+
+    def __init__(self, outfile, attrs=None, columns=COLUMNS,
+                 compressed=False):
+        super(NpzWriter, self).__init__(outfile, attrs=attrs,
+                                        columns=columns)
+        self.compressed = compressed
+        self.chunks = {name: [] for name in self.columns}
+
+    def _write(self, arrays):
+        for name, data in zip(self.columns, arrays):
+            self.chunks[name].append(data)
+
+    def close(self):
+        arrays = {name: (np.concatenate(chunks) if chunks
+                         else np.zeros(0))
+                  for name, chunks in self.chunks.items()}
+        arrays["attrs"] = np.array(json.dumps(self.attrs))
+        save = np.savez_compressed if self.compressed else np.savez
+        with open(self.outfile, "wb") as f_out:
+            save(f_out, **arrays)
+
+
+class ParquetWriter(_Writer):
+    """Apache Parquet file with one row group per chunk."""
+
+    def __init__(self, outfile, attrs=None, columns=COLUMNS):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("parquet output requires pyarrow")
+
+        super(ParquetWriter, self).__init__(outfile, attrs=attrs,
+                                            columns=columns)
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.f_out = None
+
+    def _write(self, arrays):
+        table = self.pa.table(dict(zip(self.columns, arrays)))
+        if self.f_out is None:
+            fields = [field.with_metadata(
+                          {key: str(value) for key, value in
+                           self.attrs.get(field.name, {}).items()})
+                      for field in table.schema]
+            self.schema = self.pa.schema(fields)
+            self.f_out = self.pq.ParquetWriter(self.outfile, self.schema)
+        self.f_out.write_table(table.cast(self.schema))
+
+    def close(self):
+        if self.f_out is None:
+            self._write([np.zeros(0) for _ in self.columns])
+        self.f_out.close()
@@ -0,0 +1,213 @@
+"""Headless photon density plots.
+
+Drawing every photon of a ground track as a marker takes time and
+memory in proportion to the number of photons, and showing the plot
+needs a display.  Here the photons are counted into a fixed grid of
+pixels instead, one chunk at a time, and the grid is drawn as an image
+and saved to a PDF or PNG file through the Agg canvas, without pyplot
+or a window.  Memory is set by the grid, and drawing time by the grid
+and the figure, whatever the number of photons.
+
+The grid does not need the data extent in advance.  When a chunk falls
+outside it, the grid doubles its extent along that axis by merging
+pairs of pixels, so the counts stay exact and the pixels are at most
+twice as large as a grid fitted to all the data.
+
+Run as a script to time density plots of increasing numbers of
+photons:
+
+    python photon_plot.py [n_max]
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import time
+
+import numpy as np
+
+# Output formats of save_density.
+PLOT_FORMATS = ("pdf", "png")
+
+
+class DensityRaster(object):
+    """Photon counts on a pixel grid that grows to fit the data.
+
+    Parameters
+    ----------
+    nx, ny : int, optional
+        Number of pixels along x and y, rounded up to even numbers.
+
+    Attributes
+    ----------
+    counts : NumPy array of int64
+        (nx, ny) photon counts, or None before any photons are added.
+    origin, step : list of float
+        Lower left corner and pixel size along x and y.
+    n_points : int
+        Number of finite points added.
+
+    """
+
+    def __init__(self, nx=2048, ny=1024):
+        self.shape = (nx + nx % 2, ny + ny % 2)
+        self.counts = None
+        self.origin = [0.0, 0.0]
+        self.step = [1.0, 1.0]
+        self.n_points = 0
+
+    def add(self, x, y):
+        """Count points into the grid, growing it if needed."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        keep = np.isfinite(x) & np.isfinite(y)
+        if not keep.all():
+            x, y = x[keep], y[keep]
+        if len(x) == 0:
+            return
+        coords = (x, y)
+
+        if self.counts is None:
+            self.counts = np.zeros(self.shape, dtype=np.int64)
+            for axis, data in enumerate(coords):
+                lo, hi = data.min(), data.max()
+                n = self.shape[axis]
+                self.origin[axis] = lo
+                self.step[axis] = (hi - lo) / (n - 1) if hi > lo else 1.0 / n
+        for axis, data in enumerate(coords):
+            self._fit(axis, data.min(), data.max())
+
+        nx, ny = self.shape
+        i = ((x - self.origin[0]) / self.step[0]).astype(np.int64)
+        j = ((y - self.origin[1]) / self.step[1]).astype(np.int64)
+        np.clip(i, 0, nx - 1, out=i)
+        np.clip(j, 0, ny - 1, out=j)
+        self.counts += np.bincount(i * ny + j,
+                                   minlength=nx * ny).reshape(nx, ny)
+        self.n_points += len(x)
+
+    def _fit(self, axis, lo, hi):
+        # Double the extent, toward the data, until [lo, hi] fits
+        n = self.shape[axis]
+        while lo < self.origin[axis] or \
+                hi >= self.origin[axis] + n * self.step[axis]:
+            counts = np.moveaxis(self.counts, axis, 0)
+            merged = counts.reshape((n // 2, 2) + counts.shape[1:]).sum(axis=1)
+            grown = np.zeros_like(counts)
+            if lo < self.origin[axis]:
+                grown[n // 2:] = merged
+                self.origin[axis] -= n * self.step[axis]
+            else:
+                grown[:n // 2] = merged
+            self.counts = np.moveaxis(grown, 0, axis)
+            self.step[axis] *= 2
+
+    def image(self):
+        """Return the counts and extent of the pixels holding data.
+
+        Returns
+        -------
+        counts : NumPy array
+            (ny, nx) counts cropped to the data, for imshow with
+            origin="lower".
+        extent : tuple of float
+            (left, right, bottom, top) of the cropped image.
+
+        """
+        i = np.flatnonzero(self.counts.any(axis=1))
+        j = np.flatnonzero(self.counts.any(axis=0))
+        counts = self.counts[i[0]:i[-1] + 1, j[0]:j[-1] + 1]
+        (x0, y0), (dx, dy) = self.origin, self.step
+        extent = (x0 + i[0] * dx, x0 + (i[-1] + 1) * dx,
+                  y0 + j[0] * dy, y0 + (j[-1] + 1) * dy)
+        return counts.T, extent
+
+
+def save_density(raster, plotfile, title=None, x_label=None, y_label=None,
+                 dpi=150, verbose=False):
+    """Draw a DensityRaster and save it without opening a window.
+
+    Parameters
+    ----------
+    raster : DensityRaster
+        Photon counts to draw.
+    plotfile : str
+        Name of the output file.  The format is taken from the
+        extension, one of PLOT_FORMATS.
+    title : str, optional
+        Plot title
+    x_label : str, optional
+        Label for X axis
+    y_label : str, optional
+        Label for Y axis
+    dpi : int, optional
+        Resolution of PNG output.
+    verbose : bool, optional
+        Turn on additional output.
+
+    Returns
+    -------
+    This function does not return anything.
+
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.colors import LogNorm
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(11, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    if raster.n_points:
+        counts, extent = raster.image()
+        counts = np.ma.masked_equal(counts, 0)
+        im = ax.imshow(counts, origin="lower", extent=extent, aspect="auto",
+                       interpolation="nearest", cmap="viridis",
+                       norm=LogNorm(vmin=1, vmax=max(counts.max(), 2)))
+        fig.colorbar(im, ax=ax, label="photons per pixel")
+    else:
+        ax.text(0.5, 0.5, "no photons", ha="center", va="center",
+                transform=ax.transAxes)
+    ax.set_xlabel(x_label)
+    ax.set_ylabel(y_label)
+    ax.set_title(title)
+
+    if verbose:
+        print("saving plot of", raster.n_points, "photons to", plotfile)
+    fig.savefig(plotfile, dpi=dpi)
+
+
+def benchmark(n_max=10000000):
+    """Time density plots of 10**5 up to n_max synthetic photons."""
+    import os
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    plotfile = os.path.join(tempfile.mkdtemp(), "density.png")
+    n = 100000
+    while n <= n_max:
+        x = np.sort(rng.uniform(0, 1e6, n))
+        y = 500 * np.sin(x / 1e5) + rng.normal(0, 2, n)
+        noise = rng.random(n) < 0.3
+        y[noise] = rng.uniform(-1000, 1000, noise.sum())
+
+        t0 = time.time()
+        raster = DensityRaster()
+        for start in range(0, n, 1000000):
+            raster.add(x[start:start + 1000000], y[start:start + 1000000])
+        t_add = time.time() - t0
+        t0 = time.time()
+        save_density(raster, plotfile)
+        t_save = time.time() - t0
+        print("%9d photons: count %7.3f s, draw %7.3f s, %7d bytes"
+              % (n, t_add, t_save, os.path.getsize(plotfile)))
+        n *= 10
+    os.remove(plotfile)
+    os.rmdir(os.path.dirname(plotfile))
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 10000000)
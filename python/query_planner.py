@@ -0,0 +1,236 @@
+#! /usr/bin/env python3
+"""
+Split large EGI requests into tiles that are downloaded concurrently.
+
+A request's bbox (W,S,E,N) is cut into tile_deg x tile_deg tiles and its
+time range into tile_days windows.  An untiled request is one
+sub-request, and CMR is not searched for it.  For a tiled request, if
+the CMR granule search is reachable, the granules of every tile are
+listed there first, each granule is kept only in the first tile that
+returns it, and each sub-request asks EGI for its granules by name
+(producer_granule_id), at most one page of them, with the request's
+full bbox for subsetting.  No granule is downloaded twice and the page
+count of the plan is exact, so each sub-request stops after its page.
+
+The manifest records sub-requests by their tile, time window and batch
+number (the 'key' of each sub-request), not by the granule names CMR
+returned, so a rerun resumes them even if CMR's answer has changed.
+
+Without CMR the sub-requests are the tiles themselves, and granules in
+more than one tile are downloaded more than once but only extracted
+once (see nsidc_download.extract_h5).  Subsetted granules would differ
+between tiles, so subsetting requests are only split in time then.
+
+The scripts call plan_query, print_plan for their -d dry run, and
+run_plan.
+"""
+
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from nsidc_download import EGI_URL, download_pages, make_session
+
+CMR_URL = 'https://cmr.earthdata.nasa.gov/search/granules.json'
+
+TIME_FMT = '%Y-%m-%dT%H:%M:%S'
+
+
+def split_bbox(bbox, tile_deg):
+    """
+        Cut a 'W,S,E,N' bbox string into tile bbox strings.  W > E is a
+        bbox across the antimeridian.
+    """
+    W, S, E, N = [float(v) for v in bbox.split(',')]
+    if E < W:
+        E += 360
+    lon = _edges(W, E, tile_deg)
+    lat = _edges(S, N, tile_deg)
+    wrap = lambda x: x - 360 if x > 180 else x
+    return ['%6.4f,%6.4f,%6.4f,%6.4f' % (wrap(x0), y0, wrap(x1), y1)
+            for y0, y1 in zip(lat[:-1], lat[1:])
+            for x0, x1 in zip(lon[:-1], lon[1:])]
+
+
+def _edges(v0, v1, step):
+    """ Tile edges from v0 to v1, step apart except for the last tile. """
+    edges = np.arange(v0, v1, step)
+    return np.append(edges, v1)
+
+
+def split_time(time_str, tile_days):
+    """ Cut a 'start,end' time range into windows of tile_days days. """
+    t0, t1 = [datetime.datetime.strptime(t, TIME_FMT) for t in time_str.split(',')]
+    step = datetime.timedelta(days=tile_days)
+    windows = []
+    while t0 < t1:
+        windows.append('%s,%s' % (t0.strftime(TIME_FMT),
+                                  min(t0 + step, t1).strftime(TIME_FMT)))
+        t0 += step
+    return windows
+
+
+def cmr_granules(session, params, cmr_url=CMR_URL, page_size=2000):
+    """
+        Names (producer_granule_id) of the granules CMR finds for the
+        short_name, version, bbox, polygon and time of an EGI request.
+    """
+    query = {'short_name': params['short_name'], 'version': params['version'],
+             'page_size': page_size, 'sort_key': 'start_date'}
+    if params.get('bbox'):
+        query['bounding_box'] = params['bbox']
+    if params.get('polygon'):
+        query['polygon'] = params['polygon']
+    if params.get('time'):
+        query['temporal'] = params['time']
+
+    names = []
+    headers = {}
+    while True:
+        r = session.get(cmr_url, params=query, headers=headers, timeout=120)
+        r.raise_for_status()
+        entries = r.json()['feed']['entry']
+        names += [e.get('producer_granule_id', e.get('title')) for e in entries]
+        # CMR pages through results with a search-after token
+        if len(entries) < page_size or 'CMR-Search-After' not in r.headers:
+            break
+        headers['CMR-Search-After'] = r.headers['CMR-Search-After']
+    return names
+
+
+def plan_query(params, tile_deg=None, tile_days=None, cmr_url=CMR_URL,
+               session=None):
+    """
+        Plan the sub-requests of an EGI request.
+
+        Returns a list of dicts with the sub-request's params, its
+        manifest key params, the tile bbox and time, and the number of
+        granules and pages (None if unknown). CMR is only searched if
+        tile_deg or tile_days is given; set cmr_url=None to plan
+        without it.
+
+        Raises ValueError if the request can't be split as asked.
+    """
+    page_size = int(params.get('page_size', 99))
+    bboxes = [params.get('bbox')]
+    times = [params.get('time')]
+    if tile_deg is not None and params.get('bbox'):
+        bboxes = split_bbox(params['bbox'], tile_deg)
+    if tile_days is not None:
+        if not params.get('time'):
+            raise ValueError('tiling in time needs a time range')
+        times = split_time(params['time'], tile_days)
+    tiles = [(bbox, time_str) for time_str in times for bbox in bboxes]
+
+    def tile_params(bbox, time_str):
+        new = dict(params)
+        for key, value in (('bbox', bbox), ('time', time_str)):
+            if value is not None:
+                new[key] = value
+        return new
+
+    if tile_deg is None and tile_days is None:
+        return [{'params': dict(params), 'key': dict(params),
+                 'bbox': bboxes[0], 'time': times[0], 'granules': None,
+                 'pages': None}]
+
+    names = None
+    if cmr_url is not None:
+        if session is None:
+            session = make_session(8)
+        try:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                names = list(pool.map(
+                    lambda tile: cmr_granules(session, tile_params(*tile), cmr_url),
+                    tiles))
+        except (requests.RequestException, ValueError, KeyError) as err:
+            print('query_planner: CMR search failed (%s), planning without it' % err)
+
+    plan = []
+    if names is None:
+        if len(bboxes) > 1 and 'agent' not in params:
+            raise ValueError('subsetting requests can only be split in time '
+                             'without a CMR granule list')
+        for bbox, time_str in tiles:
+            sub_params = tile_params(bbox, time_str)
+            plan.append({'params': sub_params, 'key': dict(sub_params),
+                         'bbox': bbox, 'time': time_str, 'granules': None,
+                         'pages': None})
+        return plan
+
+    if len(tiles) == 1:
+        n = len(names[0])
+        return [{'params': dict(params), 'key': dict(params),
+                 'bbox': bboxes[0], 'time': times[0], 'granules': n,
+                 'pages': -(-n // page_size)}]
+
+    # each granule goes to the first tile that found it
+    seen = set()
+    for (bbox, time_str), tile_names in zip(tiles, names):
+        new = [name for name in tile_names if name not in seen]
+        seen.update(new)
+        for i0 in range(0, len(new), page_size):
+            batch = new[i0:i0 + page_size]
+            # the key is stable across runs, the granule names may not be
+            key = dict(tile_params(bbox, time_str), tile_batch=i0 // page_size)
+            plan.append({'params': dict(params, producer_granule_id=','.join(batch)),
+                         'key': key, 'bbox': bbox, 'time': time_str,
+                         'granules': len(batch), 'pages': 1})
+    return plan
+
+
+def print_plan(plan, out=print):
+    """ Report a plan, one line per sub-request. """
+    out('%4s  %-35s  %-39s %8s %6s' % ('', 'bbox', 'time', 'granules', 'pages'))
+    for k, sub in enumerate(plan):
+        out('%4d  %-35s  %-39s %8s %6s' % (
+            k, sub['bbox'] or '-', sub['time'] or '-',
+            '?' if sub['granules'] is None else sub['granules'],
+            '?' if sub['pages'] is None else sub['pages']))
+    if all(sub['pages'] is not None for sub in plan):
+        out('%d sub-requests, %d granules, %d pages' % (
+            len(plan), sum(sub['granules'] for sub in plan),
+            sum(sub['pages'] for sub in plan)))
+    else:
+        out('%d sub-requests' % len(plan))
+
+
+def run_plan(plan, url=EGI_URL, concurrency=4, retries=3, on_page=None,
+             manifest=None, params=None):
+    """
+        Download the sub-requests of a plan, concurrency at a time,
+        over one pooled session.
+
+        Calls to on_page are serialized, so granules found by more than
+        one sub-request are extracted once.  With a manifest, each
+        sub-request resumes on its own, and params (the request that was
+        planned) is marked complete when every sub-request is.
+    """
+    session = make_session(concurrency)
+    # the manifest's lock also guards its granule records during extraction
+    lock = threading.RLock() if manifest is None else manifest.lock
+
+    def locked_on_page(page, zip_file):
+        with lock:
+            if on_page is not None:
+                on_page(page, zip_file)
+
+    if manifest is not None and params is not None:
+        manifest.start(params)
+
+    def run(sub):
+        return download_pages(sub['params'], url=url, concurrency=1,
+                              retries=retries, session=session,
+                              on_page=locked_on_page, manifest=manifest,
+                              key_params=sub.get('key'),
+                              n_pages=sub.get('pages'))
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        done = [page for pages in pool.map(run, plan) for page in pages]
+
+    if manifest is not None and params is not None:
+        manifest.finish(params)
+    return done
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
 Generic reader for ATL06.
@@ -7,25 +7,44 @@ Created on Thu Apr 26 14:58:17 2018
 
 Credits: Johan Nilsson, with contribution from Fernando Paolo.
 
+The reader can be imported, e.g.
+
+    from readATL06 import read_atl06
+    tref, data = read_atl06('ATL06_file.h5')
+    h_li = data['gt1l']['h_li']
+
+or run as a script to write filtered ascending/descending tracks.
+
 """
 
-import re
-import sys
 import os
 import warnings
 import argparse
-warnings.filterwarnings('ignore')
 import h5py
 import numpy as np
-import matplotlib.pyplot as plt
-from astropy.time import Time
+from atl06_filter import atl06_at_filter
+from atl06_store import StoreWriter, granule_names, shard_name, shard_names
+from dem_footprint import read_footprint
+from gps_time import gps2dyr
+from granule_catalog import (open_catalog, query_beams, query_status, set_status,
+                             update_catalog)
+import granule_io
+from region import region_mask
+import stage_metrics
+
+# Beam names
+GROUPS = ['gt1l', 'gt1r', 'gt2l', 'gt2r', 'gt3l', 'gt3r']
 
-def gps2dyr(time):
-    """ Converte from GPS time to decimal years. """
-    time = Time(time, format='gps')
-    time = Time(time, format='decimalyear').value
+# Beam indicies
+BEAMS = [1, 2, 3, 4, 5, 6]
+
+# Variables read from /gtx/land_ice_segments (more can be added!)
+FIELDS = ['latitude', 'longitude', 'h_li', 'delta_time',
+          'atl06_quality_summary']
+
+# Returned for granules that can't be read (and their catalogue status)
+FAILED = 'failed'
 
-    return time
 
 def list_files(path, endswith='.h5'):
     """ List files in dir recursively."""
@@ -34,195 +53,493 @@ def list_files(path, endswith='.h5'):
             for f in fnames if f.endswith(endswith)]
 
 
+def track_segments(time, lat, tmax=1):
+    """
+        Splits a track into ascending and descending segments.
+        Segments break at time gaps > tmax and at every latitude
+        turning point (sign change of the along-track lat difference),
+        so granules crossing both poles or with data gaps are handled.
+        The turning point itself starts the next segment.
+
+        Returns (starts, stops, asc): data[starts[k]:stops[k]] is
+        segment k, and asc[k] is True if lat increases w/time in it.
+        Points are assumed to be ordered in time.
+    """
+
+    n = len(lat)
+    if n == 0:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                np.zeros(0, dtype=bool))
+
+    # Time gaps and direction of each step
+    gap = np.diff(time) > tmax
+    step = np.sign(np.diff(lat))
+    step[gap] = 0
+
+    # Carry the last direction over steps with no lat change
+    i_last = np.where(step != 0, np.arange(len(step)), 0)
+    i_last = np.maximum.accumulate(i_last)
+    step = step[i_last]
+
+    # Turning points: direction changes between steps inside a segment
+    turn = np.zeros(len(step), dtype=bool)
+    turn[1:] = ((step[1:] != step[:-1]) & (step[1:] != 0) &
+                (step[:-1] != 0) & ~gap[1:] & ~gap[:-1])
+
+    # Segment boundaries: after a gap, or at a turning point
+    starts = np.concatenate(([0], np.flatnonzero(gap) + 1,
+                             np.flatnonzero(turn)))
+    starts = np.unique(starts)
+    stops = np.append(starts[1:], n)
+
+    # Test if lat increases (asc) or decreases (des) w/time
+    asc = (lat[stops - 1] - lat[starts]) > 0
+
+    return starts, stops, asc
+
+
 def track_type(time, lat, tmax=1):
     """
         Determines ascending and descending tracks.
-        Defines unique tracks as segments with time breaks > tmax,
-        and tests whether lat increases or decreases w/time.
+        Defines unique tracks as segments with time breaks > tmax and
+        latitude turning points, and tests whether lat increases or
+        decreases w/time. See track_segments.
     """
-    
-    # Generate track segment
-    tracks = np.zeros(lat.shape)
-    
-    # Set values for segment
-    tracks[0:np.argmax(np.abs(lat))] = 1
-    
-    # Output index array
-    i_asc = np.zeros(tracks.shape, dtype=bool)
-    
-    # Loop trough individual tracks
-    for track in np.unique(tracks):
-        
-        # Get all points from an individual track
-        i_track, = np.where(track == tracks)
-        
-        # Test tracks length
-        if len(i_track) < 2:
-            continue
-        
-        # Test if lat increases (asc) or decreases (des) w/time
-        i_min = time[i_track].argmin()
-        i_max = time[i_track].argmax()
-        lat_diff = lat[i_track][i_max] - lat[i_track][i_min]
-        
-        # Determine track type
-        if lat_diff > 0:
-            i_asc[i_track] = True
+
+    starts, stops, asc = track_segments(time, lat, tmax=tmax)
 
     # Output index vector's
+    i_asc = np.repeat(asc, stops - starts)
     return i_asc, np.invert(i_asc)
 
 
-# Output description of solution
-description = ('Program for reading ICESat ATL06 data.')
+def read_atl06(ifile, groups=GROUPS, fields=FIELDS, read_direct=False):
+    """
+        Read land ice segment variables for every beam of a granule.
 
-# Define command-line arguments
-parser = argparse.ArgumentParser(description=description)
+        The file is opened once and every requested variable of every
+        beam is read in the same pass. Beams missing from the file are
+        left out of the result; a missing variable in a present beam
+        raises KeyError.
 
-parser.add_argument(
-        'ifiles', metavar='ifile', type=str, nargs='+',
-        help='path for ifile(s) to read (.h5).')
+        The granule is opened with the chunk cache and page buffer set
+        in granule_io. With read_direct=True each variable is read with
+        Dataset.read_direct into an array allocated up front, which
+        avoids h5py's intermediate copy.
 
-parser.add_argument(
-        'ofiles', metavar='ofile', type=str, nargs='+',
-        help='path for ofile(s) to save (.h5).')
+        Returns (tref, data), where tref is the ATLAS SDP GPS epoch (s)
+        and data[group][field] holds the array of each beam.
+    """
 
-parser.add_argument(
-        '-b', metavar=('w','e','s','n'), dest='bbox', type=float, nargs=4,
-        help=('bounding box for geographical region (deg)'),
-        default=[None],)
+    # Output container, one dict per beam
+    data = {}
 
-parser.add_argument(
-        '-n', metavar=('njobs'), dest='njobs', type=int, nargs=1,
-        help="number of cores to use for parallel processing",
-        default=[1],)
+    with granule_io.open_granule(ifile) as fi:
 
-# Parser argument to variable
-args = parser.parse_args()
+        # GPS epoch of delta_time
+        tref = fi['/ancillary_data/atlas_sdp_gps_epoch'][0]
 
-# Read input from terminal
-ipath = args.ifiles[0]
-opath = args.ofiles[0]
-bbox  = args.bbox
-njobs = args.njobs[0]
+        # Loop trough beams
+        for group in groups:
 
-# Get filelist of data to process
-ifiles = list_files(ipath,endswith='.h5')
+            # Skip beams that are not in the granule
+            if group + '/land_ice_segments' not in fi:
+                continue
 
-# Beam namnes
-group = ['./gt1l','./gt1r','./gt2l','./gt2r','./gt3l','./gt3r']
+            beam = {}
+            for field in fields:
+                dset = fi[group + '/land_ice_segments/' + field]
+                if read_direct:
+                    beam[field] = granule_io.read(dset)
+                else:
+                    beam[field] = dset[:]
+            data[group] = beam
 
-# Beam indicies
-beams = [1, 2, 3, 4, 5, 6]
+    return tref, data
 
-# Loop trough and open files
-def main(ifile, n=''):
-    
-    # Check if we already processed the file
-    if ifile.endswith('_A.h5') or ifile.endswith('_D.h5'):
-        return
-    
-    # Create beam index container
-    beam_id = np.empty((0,))
-    
-    # Beam flag error
-    flg_read_err = False
+
+def filter_granule(ifile, bbox=None, groups=GROUPS, polygon=None,
+                   at_threshold=None):
+    """
+        Read the beams in groups of an ATL06 granule and keep good
+        points inside bbox and polygon (an (N, 2) lon/lat array, see
+        dem_footprint). With at_threshold (m), segments must also pass
+        the along-track filter (see atl06_filter).
+
+        Returns (out, runs), where out holds lon, lat, h_li, t_yr and
+        beam of the points of every beam, and runs the beam, asc flag,
+        start and stop (rows of out) of every ascending/descending run.
+        Returns FAILED if the granule can't be read, and None if it has
+        no good data.
+    """
+
+    # Slopes are only needed by the along-track filter
+    fields = FIELDS if at_threshold is None else FIELDS + ['dh_fit_dx']
+
+    stage_metrics.set_context(granule=os.path.basename(ifile))
+
+    # Load full data into memory (only once)
+    try:
+        with stage_metrics.stage('read') as timer:
+            tref, data = read_atl06(ifile, groups=groups, fields=fields)
+            for beam in data.values():
+                timer.add(*beam.values())
+    except (IOError, KeyError, OSError):
+        return FAILED
+
+    # Output containers
+    out = {'lon': [], 'lat': [], 'h_li': [], 't_yr': [], 'beam': []}
+    runs = {'beam': [], 'asc': [], 'start': [], 'stop': []}
+    offset = 0
+
+    # Filter every beam, timed as one stage
+    timer = stage_metrics.stage('filter').start()
 
     # Loop trough beams
-    for k in xrange(len(group)):
-    
-        # Load full data into memory (only once)
-        with h5py.File(ifile, 'r') as fi:
-            
-            # Try to read vars
-            try:
-                
-                # Read in varibales of interest (more can be added!)
-                lat  = fi[group[k]+'/land_ice_segments/latitude'][:]
-                lon  = fi[group[k]+'/land_ice_segments/longitude'][:]
-                h_li = fi[group[k]+'/land_ice_segments/h_li'][:]
-                t_dt = fi[group[k]+'/land_ice_segments/delta_time'][:]
-                flag = fi[group[k]+'/land_ice_segments/atl06_quality_summary'][:]
-                tref = fi['/ancillary_data/atlas_sdp_gps_epoch'][:]
-
-            except:
-                
-                # Set error flag
-                flg_read_err = True
-                pass
-    
-        # Continue to next beam
-        if flg_read_err: return
-
-        # Save beam id for each surface height
-        beam_id = np.hstack((beam_id, np.ones(lat.shape) * beams[k]))
-        
-        # Apply bounding box
-        if bbox[0]:
-        
-            # Extract bounding box
-            (lonmin, lonmax, latmin, latmax) = bbox
-        
-            # Select data inside bounding box
-            ibox = (lon >= lonmin) & (lon <= lonmax) & (lat >= latmin) & (lat <= latmax)
-        
-        else:
-            
-            # Select all boolean
-            ibox = np.ones(lat.shape,dtype=bool)
+    for group, beam in zip(GROUPS, BEAMS):
+
+        # Beam not in file
+        if group not in data:
+            continue
+
+        lat = data[group]['latitude']
+        lon = data[group]['longitude']
+        h_li = data[group]['h_li']
+        t_dt = data[group]['delta_time']
+        flag = data[group]['atl06_quality_summary']
+
+        # Select data inside bounding box and polygon
+        ibox = region_mask(lon, lat, bbox=bbox, polygon=polygon)
 
         # Quality flag, only keep good data and data inside box
         flag = (flag == 0) & ibox & (np.abs(h_li) < 10e3)
-        
+
+        # Along-track consistency with the neighbouring segments
+        if at_threshold is not None:
+            flag &= atl06_at_filter(h_li, data[group]['dh_fit_dx'], at_threshold)
+
         # Only keep good data
         lat, lon, h_li, t_dt = lat[flag], lon[flag], h_li[flag], t_dt[flag]
-        
+        timer.add(h_li)
+
         # Test for no data
-        if len(h_li) == 0: return
-        
+        if len(h_li) == 0: continue
+
         # Time in decimal years
         t_li = gps2dyr(t_dt + tref)
-        
+
         # Time in GPS seconds
         t_gps = t_dt + tref
-        
-        # Determine track type
-        (i_asc, i_des) = track_type(t_gps, lat)
-        
-        # Construct output name and path
-        name, ext = os.path.splitext(os.path.basename(ifile))
-        ofile = os.path.join(opath, name + ext)
-
-        # Save track as ascending
-        if len(lat[i_asc]) > 1:
-            
-            with h5py.File(ofile.replace('.h5', '_A.h5'), 'w') as fa:
-            
-                fa['lon']  = lat[i_asc]
-                fa['lat']  = lon[i_asc]
-                fa['h_li'] = h_li[i_asc]
-                fa['t_yr'] = t_li[i_asc]
-                        # Save track as desending
-        if len(lat[i_des]) > 1:
-            
-            with h5py.File(ofile.replace('.h5', '_D.h5'), 'w') as fa:
-                
-                fa['lon']  = lat[i_des]
-                fa['lat']  = lon[i_des]
-                fa['h_li'] = h_li[i_des]
-                fa['t_yr'] = t_li[i_des]
-                # Do some updates
-                
-        print ofile
-
-# Run main program
-if njobs == 1:
-    
-    print 'running sequential code ...'
-    [main(f) for f in ifiles]
-
-else:
-    
-    print 'running parallel code (%d jobs) ...' % njobs
-    from joblib import Parallel, delayed
-    Parallel(n_jobs=njobs, verbose=5)(delayed(main)(f, n) for n, f in enumerate(ifiles))
+
+        # Determine ascending/descending runs
+        (starts, stops, asc) = track_segments(t_gps, lat)
+
+        # Collect beam data, with beam id for each surface height
+        out['lon'].append(lon)
+        out['lat'].append(lat)
+        out['h_li'].append(h_li)
+        out['t_yr'].append(t_li)
+        out['beam'].append(np.ones(lat.shape) * beam)
+
+        runs['beam'].append(np.full(len(starts), beam))
+        runs['asc'].append(asc)
+        runs['start'].append(starts + offset)
+        runs['stop'].append(stops + offset)
+        offset += len(lat)
+
+    timer.stop()
+
+    # Test for no data
+    if len(out['lat']) == 0: return None
+
+    out = {key: np.hstack(value) for key, value in out.items()}
+    runs = {key: np.hstack(value) for key, value in runs.items()}
+
+    return out, runs
+
+
+def worker_settings():
+    """
+        Settings of this process that joblib workers need (see
+        run_with_settings). Workers are separate processes that don't
+        share this module state, so the settings go with each task.
+    """
+    return {'metrics': stage_metrics.metrics_file(),
+            'granule_io': granule_io.configuration()}
+
+
+def run_with_settings(settings, func, *args):
+    """ Apply worker_settings in a worker and return func(*args). """
+    if settings['metrics'] is not None:
+        stage_metrics.enable(settings['metrics'])
+    granule_io.configure(**settings['granule_io'])
+    return func(*args)
+
+
+def process_file(ifile, opath, bbox=None, groups=GROUPS, polygon=None,
+                 at_threshold=None):
+    """
+        Filter an ATL06 granule and save ascending and descending tracks
+        to <name>_A.h5 and <name>_D.h5 in opath. Returns the output name,
+        None if there was nothing to write, or FAILED if the granule
+        can't be read.
+    """
+
+    # Check if we already processed the file
+    if ifile.endswith('_A.h5') or ifile.endswith('_D.h5'):
+        return
+
+    result = filter_granule(ifile, bbox, groups, polygon, at_threshold)
+    if result is None or result == FAILED: return result
+    out, runs = result
+
+    i_asc = np.repeat(runs['asc'], runs['stop'] - runs['start'])
+    i_des = np.invert(i_asc)
+
+    # Construct output name and path
+    name, ext = os.path.splitext(os.path.basename(ifile))
+    ofile = os.path.join(opath, name + ext)
+
+    # Save track as ascending and desending
+    with stage_metrics.stage('write') as timer:
+        for suffix, i_trk in (('_A.h5', i_asc), ('_D.h5', i_des)):
+
+            if np.sum(i_trk) > 1:
+
+                with h5py.File(ofile.replace('.h5', suffix), 'w') as fa:
+
+                    for key, value in out.items():
+                        fa[key] = value[i_trk]
+        timer.add(*out.values())
+
+    print(ofile)
+    return ofile
+
+
+def store_files(ifiles, store, bbox=None, njobs=1, nshards=1, groups=None,
+                polygon=None, at_threshold=None):
+    """
+        Filter ATL06 granules and append them to an HDF5 store (see
+        atl06_store), split over nshards shard files. Granules are
+        filtered in parallel batches and appended by this process only,
+        so the store is never written by two processes at once.
+
+        groups optionally maps each file to the beams to read. Returns
+        (stored, present, failed): the files that were appended, those
+        that were already in the store, and those that can't be read.
+    """
+
+    if groups is None:
+        groups = {}
+
+    # Skip granules that are already in the store
+    done = set()
+    for shard in shard_names(store, nshards):
+        done.update(granule_names(shard))
+    ifiles = [f for f in ifiles
+              if not (f.endswith('_A.h5') or f.endswith('_D.h5'))]
+    present = [f for f in ifiles if os.path.basename(f) in done]
+    ifiles = [f for f in ifiles if os.path.basename(f) not in done]
+
+    if njobs > 1:
+        from joblib import Parallel, delayed
+        pool = Parallel(n_jobs=njobs, verbose=5)
+        settings = worker_settings()
+
+    # Filter in batches to bound memory, append in this process, with
+    # each shard opened once
+    stored, failed = [], []
+    writers = {}
+    batch = max(njobs, 1) * 4
+    for i in range(0, len(ifiles), batch):
+        files = ifiles[i:i + batch]
+        if njobs > 1:
+            results = pool(delayed(run_with_settings)(
+                               settings, filter_granule, f, bbox,
+                               groups.get(f, GROUPS), polygon, at_threshold)
+                           for f in files)
+        else:
+            results = [filter_granule(f, bbox, groups.get(f, GROUPS), polygon,
+                                      at_threshold) for f in files]
+
+        for ifile, result in zip(files, results):
+            if result is None: continue
+            if result == FAILED:
+                failed.append(ifile)
+                continue
+            ofile = shard_name(store, ifile, nshards)
+            if ofile not in writers:
+                writers[ofile] = StoreWriter(ofile)
+            stage_metrics.set_context(granule=os.path.basename(ifile))
+            with stage_metrics.stage('write') as timer:
+                writers[ofile].append(os.path.basename(ifile), *result)
+                timer.add(*result[0].values())
+            stored.append(ifile)
+            print(ifile, '->', ofile)
+
+    # An interrupted run leaves its shards consistent: a granule's name
+    # is written last, and StoreWriter drops rows without one
+    for writer in writers.values():
+        writer.close()
+
+    return stored, present, failed
+
+
+def main():
+
+    # Output description of solution
+    description = ('Program for reading ICESat ATL06 data.')
+
+    # Define command-line arguments
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument(
+            'ifiles', metavar='ifile', type=str, nargs='+',
+            help='path for ifile(s) to read (.h5).')
+
+    parser.add_argument(
+            'ofiles', metavar='ofile', type=str, nargs='+',
+            help='path for ofile(s) to save (.h5).')
+
+    parser.add_argument(
+            '-b', metavar=('w','e','s','n'), dest='bbox', type=float, nargs=4,
+            help=('bounding box for geographical region (deg)'),
+            default=None,)
+
+    parser.add_argument(
+            '-g', metavar=('polygon'), dest='polygon', type=str, default=None,
+            help=('only keep points inside this polygon: a text file of '
+                  'lon lat vertices, or a DEM whose footprint is used'))
+
+    parser.add_argument(
+            '-a', metavar=('threshold'), dest='at_threshold', type=float,
+            default=None,
+            help=('drop segments that differ by more than this (m) from '
+                  'their neighbours projected along slope (ATL06_AT_filter)'))
+
+    parser.add_argument(
+            '-s', metavar=('store'), dest='store', type=str, default=None,
+            help=('append all granules to this HDF5 store (in ofile dir) '
+                  'instead of writing _A/_D files per granule'))
+
+    parser.add_argument(
+            '-k', metavar=('nshards'), dest='nshards', type=int, default=1,
+            help='number of store shards, with -s')
+
+    parser.add_argument(
+            '-c', metavar=('catalog'), dest='catalog', type=str, default=None,
+            help=('granule catalogue (SQLite) used to skip granules and '
+                  'beams outside the bounding box; updated incrementally'))
+
+    parser.add_argument(
+            '-M', metavar=('metrics'), dest='metrics', type=str, default=None,
+            help=('append the time, bytes read, array sizes and peak memory '
+                  'of each stage to this file as JSON lines'))
+
+    parser.add_argument(
+            '-H', metavar=('cache_mb'), dest='chunk_cache', type=float,
+            default=None,
+            help=('HDF5 chunk cache size (MB) per dataset, default is %g '
+                  '(see granule_io)' % (granule_io.CHUNK_CACHE / 2**20)))
+
+    parser.add_argument(
+            '-n', metavar=('njobs'), dest='njobs', type=int, nargs=1,
+            help="number of cores to use for parallel processing",
+            default=[1],)
+
+    # Parser argument to variable
+    args = parser.parse_args()
+
+    # Read input from terminal
+    ipath = args.ifiles[0]
+    opath = args.ofiles[0]
+    bbox  = args.bbox
+    njobs = args.njobs[0]
+
+    # Per-stage metrics, also recorded by the worker processes (see
+    # worker_settings)
+    if args.metrics is not None:
+        stage_metrics.enable(args.metrics)
+
+    # HDF5 chunk cache, also used by the worker processes (see
+    # worker_settings)
+    if args.chunk_cache is not None:
+        granule_io.configure(chunk_cache=int(args.chunk_cache * 2**20))
+
+    # Region polygon, from a vertex file or a DEM footprint
+    polygon = None
+    if args.polygon is not None:
+        polygon = read_footprint(args.polygon)
+
+    # Get filelist of data to process
+    ifiles = [f for f in list_files(ipath,endswith='.h5')
+              if not (f.endswith('_A.h5') or f.endswith('_D.h5'))]
+
+    # Only open granules and beams that may intersect the bounding box
+    groups = {}
+    if args.catalog is not None:
+        db = open_catalog(args.catalog)
+        update_catalog(db, ifiles)
+        query_bbox = bbox
+        if polygon is not None:
+            poly_bbox = (polygon[:, 0].min(), polygon[:, 0].max(),
+                         polygon[:, 1].min(), polygon[:, 1].max())
+            # The polygon may run past 180 E; don't narrow the search then
+            if bbox is None and poly_bbox[1] <= 180:
+                query_bbox = poly_bbox
+        found = query_beams(db, bbox=query_bbox, product='ATL06')
+        groups = {f: found[os.path.abspath(f)] for f in ifiles
+                  if os.path.abspath(f) in found}
+
+        # Granules the catalogue couldn't read have no beams to find
+        failed = set(query_status(db, FAILED))
+        unreadable = [f for f in ifiles if f not in groups
+                      and os.path.abspath(f) in failed]
+        for f in unreadable:
+            print('catalogue: failed to read', f)
+        print('catalogue: %d of %d granules intersect, %d failed'
+              % (len(groups), len(ifiles), len(unreadable)))
+        ifiles = [f for f in ifiles if f in groups]
+
+    # Append to a consolidated store
+    if args.store is not None:
+        done, present, failed = store_files(
+            ifiles, os.path.join(opath, args.store), bbox=bbox, njobs=njobs,
+            nshards=args.nshards, groups=groups, polygon=polygon,
+            at_threshold=args.at_threshold)
+        done = done + present
+
+    # Run main program
+    elif njobs == 1:
+
+        print('running sequential code ...')
+        ofiles = [process_file(f, opath, bbox, groups.get(f, GROUPS), polygon,
+                               args.at_threshold) for f in ifiles]
+        done = [f for f, o in zip(ifiles, ofiles) if o not in (None, FAILED)]
+        failed = [f for f, o in zip(ifiles, ofiles) if o == FAILED]
+
+    else:
+
+        print('running parallel code (%d jobs) ...' % njobs)
+        from joblib import Parallel, delayed
+        settings = worker_settings()
+        ofiles = Parallel(n_jobs=njobs, verbose=5)(
+            delayed(run_with_settings)(settings, process_file, f, opath, bbox,
+                                       groups.get(f, GROUPS), polygon,
+                                       args.at_threshold) for f in ifiles)
+        done = [f for f, o in zip(ifiles, ofiles) if o not in (None, FAILED)]
+        failed = [f for f, o in zip(ifiles, ofiles) if o == FAILED]
+
+    # Record processing status
+    if args.catalog is not None:
+        set_status(db, ifiles, 'empty')
+        set_status(db, done, 'processed')
+        set_status(db, failed, FAILED)
+
+
+if __name__ == '__main__':
+
+    # Quiet the script, without changing the filters of importers
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        main()
@@ -0,0 +1,164 @@
+"""Spatial selection of ICESat-2 points by bounding box or polygon.
+
+Bounding boxes follow readATL06.py and are given as (west, east, south,
+north) in degrees.  Polygons are (N, 2) arrays of longitude and latitude
+vertices in degrees; the last vertex does not need to repeat the first.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+
+
+def in_bbox(lon, lat, bbox):
+    """Return True for points inside a bounding box.
+
+    Parameters
+    ----------
+    lon, lat : NumPy array
+        Point coordinates in degrees.
+    bbox : sequence of float
+        Bounding box as (west, east, south, north) in degrees.
+
+    Returns
+    -------
+    mask : NumPy array of bool
+
+    """
+    lonmin, lonmax, latmin, latmax = bbox
+    return (lon >= lonmin) & (lon <= lonmax) & (lat >= latmin) & (lat <= latmax)
+
+
+def in_polygon(lon, lat, polygon):
+    """Return True for points inside a polygon.
+
+    Uses the even-odd crossing rule.  The candidate points are sorted by
+    latitude once, so each polygon edge is only tested against the
+    contiguous slice of points in its latitude range and the cost grows
+    with the number of points rather than points times edges; densified
+    footprints with hundreds of edges cost little more than a box.
+    Point longitudes are wrapped into the 360 degrees starting at the
+    polygon's western edge, so polygons may cross the antimeridian.
+
+    Parameters
+    ----------
+    lon, lat : NumPy array
+        Point coordinates in degrees.
+    polygon : NumPy array
+        (N, 2) array of polygon vertex longitudes and latitudes.
+
+    Returns
+    -------
+    mask : NumPy array of bool
+
+    """
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    polygon = np.asarray(polygon, dtype=float)
+    x = polygon[:, 0]
+    y = polygon[:, 1]
+
+    lon = (lon - x.min()) % 360 + x.min()
+    mask = in_bbox(lon, lat, (x.min(), x.max(), y.min(), y.max()))
+    candidates = np.flatnonzero(mask)
+    order = np.argsort(lat.ravel()[candidates], kind="mergesort")
+    candidates = candidates[order]
+    px = lon.ravel()[candidates]
+    py = lat.ravel()[candidates]
+
+    # Points py in [min(y0, y1), max(y0, y1)) of each edge cross it
+    y_prev = np.roll(y, 1)
+    x_prev = np.roll(x, 1)
+    i0 = np.searchsorted(py, np.minimum(y, y_prev), side="left")
+    i1 = np.searchsorted(py, np.maximum(y, y_prev), side="left")
+
+    inside = np.zeros(len(candidates), dtype=bool)
+    for k in np.flatnonzero(i1 > i0):
+        s = slice(i0[k], i1[k])
+        x_cross = (x[k] + (py[s] - y[k]) * (x_prev[k] - x[k]) /
+                   (y_prev[k] - y[k]))
+        inside[s] ^= px[s] < x_cross
+
+    mask.ravel()[candidates] = inside
+    return mask
+
+
+def region_mask(lon, lat, bbox=None, polygon=None):
+    """Return True for points inside a bounding box and/or polygon.
+
+    Parameters
+    ----------
+    lon, lat : NumPy array
+        Point coordinates in degrees.
+    bbox : sequence of float, optional
+        Bounding box as (west, east, south, north) in degrees.
+    polygon : NumPy array, optional
+        (N, 2) array of polygon vertex longitudes and latitudes.
+
+    Returns
+    -------
+    mask : NumPy array of bool
+        All True if neither bbox nor polygon is given.
+
+    """
+    mask = np.ones(np.shape(lon), dtype=bool)
+    if bbox is not None:
+        mask &= in_bbox(lon, lat, bbox)
+    if polygon is not None:
+        mask &= in_polygon(lon, lat, polygon)
+    return mask
+
+
+def runs(mask):
+    """Return start and stop indices of the runs of True in a mask.
+
+    Parameters
+    ----------
+    mask : NumPy array of bool
+        One-dimensional mask.
+
+    Returns
+    -------
+    starts, stops : NumPy array of int
+        mask[starts[i]:stops[i]] is the i-th run of True values.
+
+    """
+    edges = np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8),
+                                    [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def read_polygon(filename):
+    """Read a polygon from a text file of longitude latitude pairs.
+
+    Parameters
+    ----------
+    filename : str
+        Name of a whitespace-delimited text file with one vertex per
+        line.  Lines starting with # are ignored.
+
+    Returns
+    -------
+    polygon : NumPy array
+        (N, 2) array of vertex longitudes and latitudes.
+
+    Raises
+    ------
+    IOError
+        Error reading the file.
+    RuntimeError
+        The file does not describe a polygon.
+
+    """
+    try:
+        polygon = np.loadtxt(filename, ndmin=2)
+    except ValueError as err:
+        raise RuntimeError(filename + " is not a polygon file: " + str(err))
+    if polygon.shape[1] != 2 or len(polygon) < 3:
+        raise RuntimeError(filename + " does not hold a polygon of at least "
+                           "three longitude latitude pairs")
+    return polygon
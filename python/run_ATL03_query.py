@@ -1,40 +1,13 @@
 #! /usr/bin/env python3
 
 import argparse
-import subprocess
-import sys
-import re
 import os
-import shutil
 import numpy as np
-
-def get_bbox(demFile):
-    from osgeo import gdal, gdalconst, osr
-    """
-        Read a raster from a DEM file
-    """   
-    ds=gdal.Open(demFile, gdalconst.GA_ReadOnly)
-    
-    proj=ds.GetProjection()
-    band=ds.GetRasterBand(1)
-    GT=ds.GetGeoTransform()
-    # ii and jj are the pixel center coordinates.  0,0 in GDAL is the upper-left
-    # corner of the first pixel.
-    ii=np.array([0, band.XSize-1])+0.5
-    jj=np.array([0, band.YSize])-0.5
-    x=GT[0]+GT[1]*ii
-    y=GT[3]+GT[5]*jj    
-    # calculate the projection from latlon to the DEM CS
-    llRef = osr.SpatialReference()
-    llRef.ImportFromEPSG(4326)
-    demRef = osr.SpatialReference()
-    demRef.ImportFromWkt(proj)
-    xform = osr.CoordinateTransformation(demRef, llRef)
-    ll=np.array(xform.TransformPoints( np.c_[x, y, np.zeros_like(x)]))[:,0:2]
-    ds=None
-    return np.min(ll[:,0]), np.min(ll[:,1]), np.max(ll[:,0]), np.max(ll[:,1])
-    
-
+import requests
+from dem_footprint import dem_footprint, polygon_bbox, polygon_param
+from nsidc_download import EGI_URL, extract_pages, read_token
+from download_manifest import MANIFEST, Manifest
+from query_planner import CMR_URL, plan_query, print_plan, run_plan
 
 description="Download ATL03 data from NSIDC." +\
     "  To use this, you must generate a token, using the setup_token script, " +\
@@ -47,90 +20,91 @@ parser.add_argument('-b', dest='bbox', type=float, nargs=4, required=False, help
 parser.add_argument('-s', dest='subset', default=False, action='store_true')
 parser.add_argument('-o', dest='output_directory', type=str)
 parser.add_argument('-t', dest='time_str', type=str,default=None, help="Time range for query.  Format is YYYY-MM-DDTHH:MM:SS,YYYY-MM-DDTHH:MM:SS")
-parser.add_argument('-v', dest='version', type=str, default=203, help="data version.  Ex: 203")
+parser.add_argument('-v', dest='version', type=str, default="203", help="data version.  Ex: 203")
 parser.add_argument('-d', dest='dry_run', default=False, action='store_true')
-parser.add_argument('-f', dest='tifFile', type=str, help="tif file giving the bounds of the data to be extracted")
+parser.add_argument('-f', dest='tifFile', type=str, help="DEM file whose footprint (as a lon/lat polygon) gives the region to be extracted")
+parser.add_argument('-c', dest='concurrency', type=int, default=4, help="number of pages to download at once")
+parser.add_argument('-r', dest='retries', type=int, default=3, help="number of retries for each page")
+parser.add_argument('-u', dest='url', type=str, default=EGI_URL, help="EGI request URL (for testing against a local server)")
+parser.add_argument('-T', dest='tile_deg', type=float, default=None, help="split the request into bbox tiles this many degrees on a side")
+parser.add_argument('-D', dest='tile_days', type=float, default=None, help="split the request into time windows this many days long")
+parser.add_argument('--cmr', dest='cmr_url', type=str, default=None, help="CMR granule search URL used to plan a tiled (-T/-D) request, 'none' to plan without it; default is CMR's own URL unless -u is given")
+parser.add_argument('--refresh', dest='refresh', default=False, action='store_true', help="only fetch granules acquired since the last complete run of this query")
 args=parser.parse_args()
 
-# look for a NSIDC_token.txt file in the current directory
-try:
-    fh=open('NSIDC_token.txt','r')
-except(FileNotFoundError):
-    # also look in the script's directory
-    fh=open(sys.path[0]+'/NSIDC_token.txt','r')
-
-token=None
-token_re=re.compile('<id>(.*)</id>')
-for line in fh:
-    m=token_re.search(line)
-    if m is not None:
-        token=m.group(1)
-if token is None:
-    raise RuntimeError('missing token string')
-
-token_str='&token=%s' % token
- 
-if 'out_dir' in args:
+token=read_token()
+
+if args.tifFile is not None:
+    args.tifFile=os.path.abspath(args.tifFile)
+
+if args.output_directory is not None:
     os.chdir(args.output_directory)
 
+# the DEM footprint is densified into a polygon that both the query and
+# the readers (region.in_polygon) can clip to; save it for the readers
+polygon=None
 if args.tifFile is not None:
-    args.bbox=np.zeros(4)
-    args.bbox[0], args.bbox[1], args.bbox[2], args.bbox[3]=get_bbox(args.tifFile)
+    polygon=dem_footprint(args.tifFile)
+    args.bbox=polygon_bbox(polygon)
+    footprint_file=os.path.splitext(os.path.basename(args.tifFile))[0]+'_footprint.txt'
+    np.savetxt(footprint_file, polygon, fmt='%.6f', header='lon lat')
+    print("footprint polygon written to "+footprint_file)
 
-bbox_str="&bbox=%6.4f,%6.4f,%6.4f,%6.4f" % (args.bbox[0], args.bbox[1], args.bbox[2], args.bbox[3])
+bbox_str="%6.4f,%6.4f,%6.4f,%6.4f" % (args.bbox[0], args.bbox[1], args.bbox[2], args.bbox[3])
 
-if 'out_dir' in args:
-    os.chdir(args.output_directory)
+# build the query parameters
+params={'short_name':'ATL03', 'version':args.version, 'page_size':99,
+        'token':token, 'bbox':bbox_str}
 
 if args.subset:
-    subset_str=""
-    bounding_box_str="&bounding_box=%6.4f,%6.4f,%6.4f,%6.4f" % (args.bbox[0], args.bbox[1], args.bbox[2], args.bbox[3])
+    params['bounding_box']=bbox_str
 else:
-    subset_str="&agent=NO"
-    bounding_box_str=""
+    params['agent']='NO'
 
-if args.time_str is not None:
-    time_str="&time=%s" % args.time_str
-else:
-    time_str=''
+if polygon is not None and polygon_param(polygon) is not None:
+    params['polygon']=polygon_param(polygon)
 
-# build the query to submit via curl
-cmd_base='curl -O -J --dump-header response-header.txt "https://n5eil02u.ecs.nsidc.org/egi/request?short_name=ATL03&version=%s&page_size=99' % args.version
-cmd = cmd_base+'%s%s%s%s%s"'  % (token_str, bbox_str, subset_str, bounding_box_str, time_str)
-print("run_ATL03_query: executing command:\n\t"+cmd)
+if args.time_str is not None:
+    params['time']=args.time_str
+
+# the manifest in the output directory records the pages and granules
+# already downloaded, so a rerun picks up where the last one stopped
+manifest=Manifest(MANIFEST)
+base_params=params
+if args.refresh:
+    # not saved until the refresh is run, so a dry run changes nothing
+    params=manifest.refresh_params(params)
+    if params is None:
+        print("query time range ends before the last run, nothing to refresh")
+        exit()
+
+url=requests.Request('GET', args.url, params=params).prepare().url
+print("run_ATL03_query: requesting:\n\t"+url)
+
+if not args.dry_run and manifest.start(params, base=base_params) is None:
+    print("query already complete, use --refresh to look for new granules")
+    exit()
 
-# if this is a dry run, exit after reporting the string
+# split the request into concurrent sub-requests; CMR is only searched
+# for tiled requests, and not by default when testing against another URL
+cmr_url=args.cmr_url
+if cmr_url is None:
+    cmr_url=CMR_URL if args.url==EGI_URL else None
+elif cmr_url=='none':
+    cmr_url=None
+try:
+    plan=plan_query(params, tile_deg=args.tile_deg, tile_days=args.tile_days,
+                    cmr_url=cmr_url)
+except ValueError as err:
+    print("run_ATL03_query: error: "+str(err))
+    exit(1)
+print_plan(plan)
+
+# if this is a dry run, exit after reporting the plan
 if args.dry_run:
     exit()
 
-# run the curl string
-p=subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-text=p.stdout.read()
-retcode=p.wait()
-
-# check the response header to get the filename with the output
-zip_re=re.compile('filename="(.*.zip)"')
-with open('response-header.txt') as ff:
-    for line in ff:
-        m=zip_re.search(line)
-        if m is not None:
-            zip_file=m.group(1)
-zip_str=subprocess.check_output(['unzip',zip_file])
-
-# the output from unzipping the zip file is a set of directories containing the
-# h5 data files. pull the indivicual h5 files into the current directory
-cleanup_list=list()
-for h5_file in re.compile('(\S+\.h5)').findall(zip_str.decode('utf-8')):
-    shutil.move(h5_file,'.')
-    thedir=os.path.dirname(h5_file)
-    if thedir not in cleanup_list:
-        cleanup_list.append( thedir)
-        
-# delete the directories that contained the hdf5 files
-for entry in cleanup_list:
-    os.rmdir(entry)
-os.remove(zip_file)
-    
-    
-
-
+# fetch the sub-requests concurrently over one pooled connection, extracting
+# the granules from each page as it arrives
+run_plan(plan, url=args.url, concurrency=args.concurrency, retries=args.retries,
+         on_page=extract_pages(manifest=manifest), manifest=manifest, params=params)
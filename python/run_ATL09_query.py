@@ -1,11 +1,11 @@
 #! /usr/bin/env python3
 
 import argparse
-import subprocess
-import sys
-import re
 import os
-import shutil
+import requests
+from nsidc_download import EGI_URL, extract_pages, read_token
+from download_manifest import MANIFEST, Manifest
+from query_planner import CMR_URL, plan_query, print_plan, run_plan
 
 description="Download ATL09 data from NSIDC." +\
     "  To use this, you must generate a token, using the setup_token script, which will be saved in a file called NSIDC_token.txt"+\
@@ -16,75 +16,65 @@ parser=argparse.ArgumentParser(description=description)
 parser.add_argument('-f', dest='full_file', default=False, action='store_true')
 parser.add_argument('-o', dest='output_directory', type=str)
 parser.add_argument('-d', dest='dry_run', default=False, action='store_true')
+parser.add_argument('-c', dest='concurrency', type=int, default=4, help="number of pages to download at once")
+parser.add_argument('-r', dest='retries', type=int, default=3, help="number of retries for each page")
+parser.add_argument('-u', dest='url', type=str, default=EGI_URL, help="EGI request URL (for testing against a local server)")
+parser.add_argument('-D', dest='tile_days', type=float, default=None, help="split the request into time windows this many days long")
+parser.add_argument('--cmr', dest='cmr_url', type=str, default=None, help="CMR granule search URL used to plan a tiled (-D) request, 'none' to plan without it; default is CMR's own URL unless -u is given")
+parser.add_argument('--refresh', dest='refresh', default=False, action='store_true', help="only fetch granules acquired since the last complete run of this query")
 parser.add_argument('-t', dest='time_str', required=True, default=None, help="Time range for query.  Format is YYYY-MM-DDTHH:MM:SS,YYYY-MM-DDTHH:MM:SS")
 args=parser.parse_args()
 
-# look for a NSIDC_identity.txt file in the current directory
-try:
-    fh=open('NSIDC_token.txt','r')
-except(FileNotFoundError):
-    # also look in the script's directory
-    fh=open(sys.path[0]+'/NSIDC_token.txt','r')
-
-token=None
-token_re=re.compile('<id>(.*)</id>')
-for line in fh:
-    m=token_re.search(line)
-    if m is not None:
-        token=m.group(1)
-if token is None:
-    raise RuntimeError('missing token string')
+token=read_token()
 
-token_str='&token=%s' % token
- 
-if 'out_dir' in args:
+if args.output_directory is not None:
     os.chdir(args.output_directory)
 
+# build the query parameters
+params={'short_name':'ATL09', 'version':'200', 'page_size':1000,
+        'token':token, 'time':args.time_str}
+
 if args.full_file:
-    subset_str="&agent=NO"
-else:
-    subset_str=""
+    params['agent']='NO'
 
-time_str="&time=%s" % args.time_str
- 
-# build the query to submit via curl
-cmd_base='curl -O -J --dump-header response-header.txt "https://n5eil02u.ecs.nsidc.org/egi/request?short_name=ATL09&version=200&page_size=1000' 
-cmd=cmd_base+'%s%s%s"' % (token_str, subset_str, time_str)
+# the manifest in the output directory records the pages and granules
+# already downloaded, so a rerun picks up where the last one stopped
+manifest=Manifest(MANIFEST)
+base_params=params
+if args.refresh:
+    # not saved until the refresh is run, so a dry run changes nothing
+    params=manifest.refresh_params(params)
+    if params is None:
+        print("query time range ends before the last run, nothing to refresh")
+        exit()
 
-print(cmd)
+url=requests.Request('GET', args.url, params=params).prepare().url
+print(url)
 
-if args.dry_run:
-    # if this is a dry run, exit after reporting the string
+if not args.dry_run and manifest.start(params, base=base_params) is None:
+    print("query already complete, use --refresh to look for new granules")
     exit()
 
-# run the curl string
-p=subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-text=p.stdout.read()
-retcode=p.wait()
-
-# check the response header to get the filename with the output
-zip_re=re.compile('filename="(.*.zip)"')
-with open('response-header.txt') as ff:
-    for line in ff:
-        m=zip_re.search(line)
-        if m is not None:
-            zip_file=m.group(1)
-zip_str=subprocess.check_output(['unzip',zip_file])
-
-# the output from unzipping the zip file is a set of directories containing the
-# h5 data files. pull the indivicual h5 files into the current directory
-cleanup_list=list()
-for h5_file in re.compile('(\S+\.h5)').findall(zip_str.decode('utf-8')):
-    shutil.move(h5_file,'.')
-    thedir=os.path.dirname(h5_file)
-    if thedir not in cleanup_list:
-        cleanup_list.append( thedir)
-        
-# delete the directories that contained the hdf5 files
-for entry in cleanup_list:
-    os.rmdir(entry)
-os.remove(zip_file)
-    
-    
+# split the request into concurrent sub-requests; CMR is only searched
+# for tiled requests, and not by default when testing against another URL
+cmr_url=args.cmr_url
+if cmr_url is None:
+    cmr_url=CMR_URL if args.url==EGI_URL else None
+elif cmr_url=='none':
+    cmr_url=None
+try:
+    plan=plan_query(params, tile_days=args.tile_days,
+                    cmr_url=cmr_url)
+except ValueError as err:
+    print("run_ATL09_query: error: "+str(err))
+    exit(1)
+print_plan(plan)
 
+if args.dry_run:
+    # if this is a dry run, exit after reporting the plan
+    exit()
 
+# fetch the sub-requests concurrently over one pooled connection, extracting
+# the granules from each page as it arrives
+run_plan(plan, url=args.url, concurrency=args.concurrency, retries=args.retries,
+         on_page=extract_pages(manifest=manifest), manifest=manifest, params=params)
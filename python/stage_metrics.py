@@ -0,0 +1,248 @@
+"""Per-stage timing and memory records for the processing scripts.
+
+The scripts mark their stages (open, read, distance, mask, write, plot,
+...) with stage_metrics.stage, and when recording is enabled each stage
+appends one JSON line to the metrics file when it ends:
+
+    {"granule": "ATL03_....h5", "beam": "gt1l", "stage": "read",
+     "seconds": 0.41, "calls": 1, "read_bytes": 52428800,
+     "array_bytes": 98304000, "items": 12288000, "peak_rss_mb": 512.3,
+     "pid": 4242, "time": 1700000000.0}
+
+read_bytes is what the process read through system calls during the
+stage (Linux /proc/self/io rchar; None elsewhere), so for HDF5 reads it
+is the compressed bytes.  array_bytes and items add up the nbytes and
+lengths of the arrays the stage reports with add.  peak_rss_mb is the
+process's peak resident set size when the stage ends.  granule and
+beam come from set_context.
+
+Stages of a loop, such as the windows of photon_height.py's streaming
+mode, are added up with totals and written once per stage name.  A
+stage can also be started and stopped explicitly, around a loop say.
+
+When recording is disabled, stage and totals return a shared object
+whose methods do nothing, so instrumented code pays one function call
+per stage.  Worker processes record only if enable is called in them
+too: pools pass metrics_file to their workers.  Each record is one
+append write, so the lines of different processes don't mix.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import sys
+import time
+
+_path = None
+_context = {}
+
+
+def enable(path):
+    """Append stage records of this process to path."""
+    global _path
+    _path = path
+
+
+def disable():
+    """Stop recording stages."""
+    global _path
+    _path = None
+
+
+def enabled():
+    """Return True if stages are being recorded."""
+    return _path is not None
+
+
+def metrics_file():
+    """Return the metrics file, or None if recording is disabled."""
+    return _path
+
+
+def set_context(**fields):
+    """Set the fields, such as granule and beam, of the records to come.
+
+    Each task (a granule, or a beam of one) sets its own context when it
+    starts, replacing the previous one.
+
+    """
+    _context.clear()
+    _context.update(fields)
+
+
+def stage(name, **fields):
+    """Return a context manager that records one stage.
+
+    Parameters
+    ----------
+    name : str
+        Stage name.
+    **fields
+        Extra fields of the record.
+
+    Returns
+    -------
+    stage : object
+        Use in a with statement, or call its start and stop methods;
+        its add(*arrays) method counts arrays toward array_bytes and
+        items.
+
+    """
+    if _path is None:
+        return _NULL
+    return _Stage(name, fields, emit=True)
+
+
+def totals():
+    """Return an object that adds up repeated stages of a loop.
+
+    Its stage(name) method returns a context manager like
+    stage_metrics.stage that can be entered many times, and its emit
+    method writes one record per stage name.
+
+    """
+    if _path is None:
+        return _NULL
+    return _Totals()
+
+
+class _Null(object):
+    """Stand-in for stages and totals when recording is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def add(self, *arrays):
+        pass
+
+    def stage(self, name, **fields):
+        return self
+
+    def emit(self):
+        pass
+
+
+_NULL = _Null()
+
+
+class _Stage(object):
+
+    def __init__(self, name, fields, emit=False):
+        self.record = dict(_context, stage=name, seconds=0.0, calls=0,
+                           read_bytes=None, array_bytes=0, items=0)
+        self.record.update(fields)
+        self._emit = emit
+
+    def __enter__(self):
+        self._start = time.time()
+        self._read = read_bytes()
+        if "time" not in self.record:
+            self.record["time"] = self._start
+        return self
+
+    def __exit__(self, *exc):
+        self.record["seconds"] += time.time() - self._start
+        self.record["calls"] += 1
+        read = read_bytes()
+        if read is not None and self._read is not None:
+            self.record["read_bytes"] = (self.record["read_bytes"] or 0) + \
+                read - self._read
+        if self._emit:
+            self.emit()
+        return False
+
+    def start(self):
+        return self.__enter__()
+
+    def stop(self):
+        self.__exit__(None, None, None)
+
+    def add(self, *arrays):
+        for data in arrays:
+            self.record["array_bytes"] += int(getattr(data, "nbytes", 0))
+        if arrays:
+            self.record["items"] += len(arrays[0])
+
+    def emit(self):
+        self.record["peak_rss_mb"] = peak_rss()
+        self.record["pid"] = os.getpid()
+        write_record(self.record)
+
+
+class _Totals(object):
+
+    def __init__(self):
+        self.stages = {}
+
+    def stage(self, name, **fields):
+        if name not in self.stages:
+            self.stages[name] = _Stage(name, fields)
+        return self.stages[name]
+
+    def emit(self):
+        for item in self.stages.values():
+            item.emit()
+
+
+def write_record(record):
+    """Append one record to the metrics file as a JSON line."""
+    line = json.dumps(record, sort_keys=True) + "\n"
+    try:
+        fd = os.open(_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+    except (OSError, TypeError) as err:
+        print("{0}: warning: can't write metrics: {1}".format(__file__, err),
+              file=sys.stderr)
+
+
+def read_bytes():
+    """Return the bytes this process has read (Linux), or None."""
+    try:
+        with open("/proc/self/io") as f_io:
+            for line in f_io:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def peak_rss(reset=False):
+    """Return the peak resident set size of this process in MB.
+
+    On Linux the peak (VmHWM) can be reset with reset=True, so the next
+    call gives the peak since then.  Elsewhere the lifetime maximum is
+    returned and reset has no effect.
+
+    """
+    try:
+        if reset:
+            with open("/proc/self/clear_refs", "w") as f_refs:
+                f_refs.write("5")
+        with open("/proc/self/status") as f_status:
+            for line in f_status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return rss / (1 << 20) if sys.platform == "darwin" else rss / 1024.0
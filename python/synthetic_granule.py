@@ -0,0 +1,400 @@
+"""Synthetic ATL03 and ATL06 granules for testing and benchmarking.
+
+The files have the groups, dataset names, types, attributes, chunking
+and compression of the real products that the scripts in this
+directory read, so they can be timed at any size without downloading
+multi-GB granules:
+
+ATL03
+    /gtx/heights/{dist_ph_along, h_ph, signal_conf_ph, lat_ph, lon_ph,
+    delta_time} and /gtx/geolocation/{ph_index_beg, segment_ph_cnt,
+    segment_dist_x, segment_id, segment_length, reference_photon_lat,
+    reference_photon_lon, delta_time}.
+ATL06
+    /gtx/land_ice_segments/{latitude, longitude, h_li, h_li_sigma,
+    delta_time, atl06_quality_summary, dh_fit_dx, segment_id}.
+
+Both have /ancillary_data/atlas_sdp_gps_epoch and /orbit_info/{rgt,
+cycle_number}, and file names in the NSIDC pattern.
+
+The ground track follows a great circle from the equator crossing at
+92 degrees inclination, and the surface is a smooth ice sheet with
+kilometre-scale undulations.  ATL03 segments hold Poisson numbers of
+signal photons near the surface and background photons spread over the
+telemetry window, with signal confidences to match.  ATL06 segments
+have a fraction of flagged segments with fill values and of blunders.
+Granules are written a block of segments at a time, so memory use does
+not grow with the granule size.
+
+    python synthetic_granule.py atl03 outdir -n 100000
+    python synthetic_granule.py atl06 outdir -n 100000
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import sys
+
+import h5py
+import numpy as np
+
+TRACKS = ("gt1l", "gt1r", "gt2l", "gt2r", "gt3l", "gt3r")
+
+# Cross-track offset (m) of each beam from the reference ground track.
+BEAM_OFFSETS = {"gt1l": -3345.0, "gt1r": -3255.0, "gt2l": -45.0,
+                "gt2r": 45.0, "gt3l": 3255.0, "gt3r": 3345.0}
+
+ATLAS_SDP_GPS_EPOCH = 1198800018.0  # 2018-01-01T00:00:00 UTC in GPS s
+EARTH_RADIUS = 6371000.0
+INCLINATION = np.radians(92.0)
+GROUND_SPEED = 6900.0  # m/s
+SEGMENT_LENGTH = 20.0  # m
+TELEMETRY_WINDOW = 500.0  # m
+FILL_VALUE = np.float32(3.4028235e38)
+
+# Real ATL03 heights datasets are chunked by 10000 photons.
+CHUNK = 10000
+# Segments generated and written at a time.
+BLOCK = 100000
+
+
+def granule_name(product, rgt=1234, cycle=5, region=1, release=6):
+    """Return an NSIDC style file name for a synthetic granule."""
+    return "%s_20191015103210_%04d%02d%02d_%03d_01.h5" % (
+        product.upper(), rgt, cycle, region, release)
+
+
+def ground_track(distance, track="gt2l"):
+    """Return latitude and longitude along a ground track.
+
+    Parameters
+    ----------
+    distance : NumPy array
+        Along-track distance from the equator crossing (m).
+    track : str, optional
+        Ground track, for its cross-track offset.
+
+    Returns
+    -------
+    lat, lon : NumPy array
+        Degrees, longitude between -180 and 180.
+
+    """
+    theta = np.asarray(distance) / EARTH_RADIUS
+    lat = np.degrees(np.arcsin(np.sin(INCLINATION) * np.sin(theta)))
+    lon = np.degrees(np.arctan2(np.cos(INCLINATION) * np.sin(theta),
+                                np.cos(theta)))
+    coslat = np.maximum(np.cos(np.radians(lat)), 0.01)
+    lon += np.degrees(BEAM_OFFSETS.get(track, 0.0) / (EARTH_RADIUS * coslat))
+    return lat, (lon + 180) % 360 - 180
+
+
+def start_distance(lat0=-75.0):
+    """Return the along-track distance of the first ascending lat0.
+
+    Like ATL03 segment_dist_x, the distance is measured from the
+    ascending equator crossing and is never negative.  For a southern
+    lat0, that is near the end of the orbit, before the next crossing.
+
+    """
+    distance = EARTH_RADIUS * np.arcsin(np.sin(np.radians(lat0)) /
+                                        np.sin(INCLINATION))
+    if distance < 0:
+        distance += 2 * np.pi * EARTH_RADIUS
+    return distance
+
+
+def surface(distance):
+    """Return ice sheet surface height and slope at along-track distances."""
+    x = np.asarray(distance, dtype=np.float64)
+    k1, k2 = 2 * np.pi / 300e3, 2 * np.pi / 7e3
+    height = 2000 + 500 * np.sin(k1 * x) + 30 * np.sin(k2 * x)
+    slope = 500 * k1 * np.cos(k1 * x) + 30 * k2 * np.cos(k2 * x)
+    return height, slope
+
+
+def _create(group, name, dtype, shape=(0,), attrs=None, chunks=None):
+    dset = group.create_dataset(name, shape=shape,
+                                maxshape=(None,) + tuple(shape[1:]),
+                                dtype=dtype,
+                                chunks=chunks or (CHUNK,) + tuple(shape[1:]),
+                                compression="gzip", compression_opts=6)
+    for key, value in (attrs or {}).items():
+        dset.attrs[key] = value
+    return dset
+
+
+def _append(dset, data):
+    n = dset.shape[0]
+    dset.resize((n + len(data),) + dset.shape[1:])
+    dset[n:] = data
+
+
+def _write_common(f_out, rgt, cycle):
+    f_out["ancillary_data/atlas_sdp_gps_epoch"] = \
+        np.array([ATLAS_SDP_GPS_EPOCH])
+    f_out["ancillary_data/atlas_sdp_gps_epoch"].attrs["units"] = "seconds"
+    f_out["orbit_info/rgt"] = np.array([rgt], dtype=np.int16)
+    f_out["orbit_info/cycle_number"] = np.array([cycle], dtype=np.int8)
+
+
+def write_atl03(filename, n_segments=100000, tracks=TRACKS,
+                photons_per_segment=10.0, signal_fraction=0.5, lat0=-75.0,
+                rgt=1234, cycle=5, seed=0):
+    """Write a synthetic ATL03 granule.
+
+    Parameters
+    ----------
+    filename : str
+        Output HDF5 file.
+    n_segments : int, optional
+        Geolocation segments per ground track.
+    tracks : sequence of str, optional
+        Ground tracks to write.
+    photons_per_segment : float, optional
+        Mean photons per 20 m segment, signal and background.
+    signal_fraction : float, optional
+        Mean fraction of signal photons.
+    lat0 : float, optional
+        Latitude of the first segment, on an ascending track.
+    rgt, cycle : int, optional
+        Reference ground track and cycle written to orbit_info.
+    seed : int, optional
+        Random seed.
+
+    Returns
+    -------
+    n_photons : int
+        Photons written over all ground tracks.
+
+    """
+    rng = np.random.default_rng(seed)
+    x0 = start_distance(lat0)
+    n_total = 0
+    with h5py.File(filename, "w") as f_out:
+        _write_common(f_out, rgt, cycle)
+        for track in tracks:
+            geo = f_out.create_group(track + "/geolocation")
+            hts = f_out.create_group(track + "/heights")
+            meters = {"units": "meters"}
+            dsets = {
+                "ph_index_beg": _create(geo, "ph_index_beg", np.int64),
+                "segment_ph_cnt": _create(geo, "segment_ph_cnt", np.int32),
+                "segment_dist_x": _create(geo, "segment_dist_x", np.float64,
+                                          attrs=meters),
+                "segment_id": _create(geo, "segment_id", np.int32),
+                "segment_length": _create(geo, "segment_length", np.float64,
+                                          attrs=meters),
+                "reference_photon_lat": _create(geo, "reference_photon_lat",
+                                                np.float64),
+                "reference_photon_lon": _create(geo, "reference_photon_lon",
+                                                np.float64),
+                "geo_delta_time": _create(geo, "delta_time", np.float64),
+                "dist_ph_along": _create(
+                    hts, "dist_ph_along", np.float32,
+                    attrs={"long_name": "Distance off RPT along-track",
+                           "units": "meters"}),
+                "h_ph": _create(hts, "h_ph", np.float32,
+                                attrs={"long_name": "Photon WGS84 Height",
+                                       "units": "meters"}),
+                "signal_conf_ph": _create(hts, "signal_conf_ph", np.int8,
+                                          shape=(0, 5)),
+                "lat_ph": _create(hts, "lat_ph", np.float64),
+                "lon_ph": _create(hts, "lon_ph", np.float64),
+                "delta_time": _create(hts, "delta_time", np.float64),
+            }
+
+            n_photons = 0
+            for s0 in range(0, n_segments, BLOCK):
+                block = _atl03_block(rng, s0, min(s0 + BLOCK, n_segments),
+                                     x0, track, photons_per_segment,
+                                     signal_fraction, n_photons)
+                for name, data in block.items():
+                    _append(dsets[name], data)
+                n_photons += len(block["h_ph"])
+            n_total += n_photons
+    return n_total
+
+
+def _atl03_block(rng, s0, s1, x0, track, photons_per_segment,
+                 signal_fraction, first_photon):
+    seg = np.arange(s0, s1)
+    seg_x = x0 + SEGMENT_LENGTH * seg
+    n_seg = len(seg)
+
+    # Clouds: a few long stretches without signal
+    clear = (np.sin(seg_x / 37e3) + np.sin(seg_x / 11e3)) > -1.6
+    n_signal = rng.poisson(photons_per_segment * signal_fraction, n_seg)
+    n_signal[~clear] = 0
+    count = n_signal + rng.poisson(photons_per_segment *
+                                   (1 - signal_fraction), n_seg)
+    n = int(count.sum())
+
+    # Photons by segment, then distance, first n_signal of each signal
+    segment = np.repeat(np.arange(n_seg), count)
+    start = np.cumsum(count) - count
+    signal = (np.arange(n) - np.repeat(start, count)) < \
+        np.repeat(n_signal, count)
+    dist = rng.uniform(0, SEGMENT_LENGTH, n)
+    order = np.lexsort((dist, segment))
+    dist, signal = dist[order], signal[order]
+
+    x = seg_x[segment] + dist
+    h_surf, _ = surface(x)
+    height = np.where(signal, h_surf + rng.normal(0, 0.3, n),
+                      h_surf + rng.uniform(-0.5, 0.5, n) * TELEMETRY_WINDOW)
+    conf = np.full((n, 5), -1, dtype=np.int8)
+    level = np.where(signal, rng.choice([2, 3, 4], n, p=[0.1, 0.2, 0.7]),
+                     rng.choice([0, 1], n, p=[0.95, 0.05]))
+    conf[:, 0] = level  # land
+    conf[:, 3] = level  # land_ice
+    lat_ph, lon_ph = ground_track(x, track)
+    lat_ref, lon_ref = ground_track(seg_x, track)
+
+    return {
+        "ph_index_beg": np.where(count > 0, first_photon + start + 1, 0),
+        "segment_ph_cnt": count,
+        "segment_dist_x": seg_x,
+        "segment_id": seg + 1,
+        "segment_length": np.full(n_seg, SEGMENT_LENGTH),
+        "reference_photon_lat": lat_ref,
+        "reference_photon_lon": lon_ref,
+        "geo_delta_time": seg_x / GROUND_SPEED + 5.4e7,
+        "dist_ph_along": dist.astype(np.float32),
+        "h_ph": height.astype(np.float32),
+        "signal_conf_ph": conf,
+        "lat_ph": lat_ph,
+        "lon_ph": lon_ph,
+        "delta_time": x / GROUND_SPEED + 5.4e7,
+    }
+
+
+def write_atl06(filename, n_segments=100000, tracks=TRACKS, lat0=-75.0,
+                bad_fraction=0.05, blunder_fraction=0.01, rgt=1234, cycle=5,
+                seed=0):
+    """Write a synthetic ATL06 granule.
+
+    Parameters
+    ----------
+    filename : str
+        Output HDF5 file.
+    n_segments : int, optional
+        Land ice segments per ground track, 20 m apart.
+    tracks : sequence of str, optional
+        Ground tracks to write.
+    lat0 : float, optional
+        Latitude of the first segment, on an ascending track.
+    bad_fraction : float, optional
+        Fraction of segments with atl06_quality_summary 1 and fill
+        values.
+    blunder_fraction : float, optional
+        Fraction of segments with good quality but a height blunder,
+        for the along-track filter.
+    rgt, cycle : int, optional
+        Reference ground track and cycle written to orbit_info.
+    seed : int, optional
+        Random seed.
+
+    Returns
+    -------
+    n_segments : int
+        Segments written over all ground tracks.
+
+    """
+    rng = np.random.default_rng(seed)
+    x0 = start_distance(lat0)
+    meters = {"units": "meters"}
+    with h5py.File(filename, "w") as f_out:
+        _write_common(f_out, rgt, cycle)
+        for track in tracks:
+            grp = f_out.create_group(track + "/land_ice_segments")
+            dsets = {
+                "latitude": _create(grp, "latitude", np.float64),
+                "longitude": _create(grp, "longitude", np.float64),
+                "h_li": _create(grp, "h_li", np.float32, attrs=meters),
+                "h_li_sigma": _create(grp, "h_li_sigma", np.float32,
+                                      attrs=meters),
+                "delta_time": _create(grp, "delta_time", np.float64),
+                "atl06_quality_summary": _create(
+                    grp, "atl06_quality_summary", np.int8),
+                "dh_fit_dx": _create(grp, "dh_fit_dx", np.float32),
+                "segment_id": _create(grp, "segment_id", np.int32),
+            }
+            for name in ("h_li", "h_li_sigma", "dh_fit_dx"):
+                dsets[name].attrs["_FillValue"] = FILL_VALUE
+
+            for s0 in range(0, n_segments, BLOCK):
+                seg = np.arange(s0, min(s0 + BLOCK, n_segments))
+                x = x0 + SEGMENT_LENGTH * seg
+                n = len(seg)
+                h, slope = surface(x)
+                h = h + rng.normal(0, 0.05, n)
+                blunder = rng.random(n) < blunder_fraction
+                h[blunder] += rng.normal(0, 30, blunder.sum())
+                slope = slope + rng.normal(0, 0.001, n)
+                bad = rng.random(n) < bad_fraction
+                lat, lon = ground_track(x, track)
+                block = {
+                    "latitude": lat, "longitude": lon,
+                    "h_li": np.where(bad, FILL_VALUE, h).astype(np.float32),
+                    "h_li_sigma": np.where(bad, FILL_VALUE,
+                                           rng.uniform(0.02, 0.2, n)),
+                    "delta_time": x / GROUND_SPEED + 5.4e7,
+                    "atl06_quality_summary": bad.astype(np.int8),
+                    "dh_fit_dx": np.where(bad, FILL_VALUE, slope),
+                    "segment_id": seg + 1,
+                }
+                for name, data in block.items():
+                    _append(dsets[name], data.astype(dsets[name].dtype))
+    return n_segments * len(tracks)
+
+
+def cl_args(description):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("product", choices=("atl03", "atl06"),
+                        help="product to write")
+    parser.add_argument("outdir", type=str,
+                        help="output directory")
+    parser.add_argument("-n", type=int, default=100000,
+                        help="segments per ground track, default is 100000")
+    parser.add_argument("-t", type=str, nargs="+", default=list(TRACKS),
+                        choices=TRACKS,
+                        help="ground tracks to write, default is all")
+    parser.add_argument("-r", type=float, default=10.0,
+                        help="ATL03 mean photons per segment, default is 10")
+    parser.add_argument("-l", type=float, default=-75.0,
+                        help="latitude of the first segment, default is -75")
+    parser.add_argument("-s", type=int, default=0,
+                        help="random seed, default is 0")
+    return parser.parse_args()
+
+
+def main():
+    """Write a synthetic granule and report its size."""
+    args = cl_args(__doc__)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    filename = os.path.join(args.outdir, granule_name(args.product))
+    if args.product == "atl03":
+        n = write_atl03(filename, n_segments=args.n, tracks=args.t,
+                        photons_per_segment=args.r, lat0=args.l, seed=args.s)
+        what = "photons"
+    else:
+        n = write_atl06(filename, n_segments=args.n, tracks=args.t,
+                        lat0=args.l, seed=args.s)
+        what = "segments"
+    print("wrote %d %s to %s (%.1f MB)"
+          % (n, what, filename, os.path.getsize(filename) / 1e6))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())